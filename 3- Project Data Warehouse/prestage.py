@@ -0,0 +1,309 @@
+import argparse
+import configparser
+import csv
+import glob
+import gzip
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# columns of the staging tables in table order, with the JSON key they come from and their type
+EVENT_COLUMNS = [
+    ('artist', 'artist', 'text'),
+    ('auth', 'auth', 'text'),
+    ('first_name', 'firstName', 'text'),
+    ('gender', 'gender', 'text'),
+    ('item_in_session', 'itemInSession', 'int'),
+    ('last_name', 'lastName', 'text'),
+    ('length', 'length', 'real'),
+    ('level', 'level', 'text'),
+    ('location', 'location', 'text'),
+    ('method', 'method', 'text'),
+    ('page', 'page', 'text'),
+    ('registration', 'registration', 'text'),
+    ('session_id', 'sessionId', 'int'),
+    ('song', 'song', 'text'),
+    ('status', 'status', 'int'),
+    ('ts', 'ts', 'bigint'),
+    ('user_agent', 'userAgent', 'text'),
+    ('user_id', 'userId', 'text'),
+]
+
+SONG_COLUMNS = [
+    ('song_id', 'song_id', 'text'),
+    ('title', 'title', 'text'),
+    ('duration', 'duration', 'real'),
+    ('year', 'year', 'smallint'),
+    ('artist_id', 'artist_id', 'text'),
+    ('artist_name', 'artist_name', 'text'),
+    ('artist_latitude', 'artist_latitude', 'real'),
+    ('artist_longitude', 'artist_longitude', 'real'),
+    ('artist_location', 'artist_location', 'text'),
+    ('num_songs', 'num_songs', 'int'),
+]
+
+# staging table -> (columns, [S3] key of its JSON tree, [PRESTAGE] key of the local copy)
+STAGING_TABLES = {
+    'stage_event': (EVENT_COLUMNS, 'LOG_DATA', 'LOCAL_LOG_DATA'),
+    'stage_song': (SONG_COLUMNS, 'SONG_DATA', 'LOCAL_SONG_DATA'),
+}
+
+# objects fetched at the same time from S3, song_data is thousands of small files
+S3_READERS = 16
+
+EXTENSIONS = {'csv': '.csv.gz', 'parquet': '.parquet'}
+
+
+def manifest_url(prefix, table):
+    """
+    Description: This function is responsible for the location of the manifest of a staging table's shards,
+                 the COPY statements of sql_queries.py read it
+    """
+    return '{}/{}.manifest'.format(prefix.rstrip('/'), table)
+
+
+def read_s3_files(url):
+    """
+    Description: This function is responsible for the text of the JSON files under an S3 prefix, in key order.
+                 boto3 is only needed for S3 sources, with the default credentials of the environment.
+
+    Arguments:
+        url: s3://bucket/prefix of the JSON files.
+
+    Returns:
+        iterator of file contents
+    """
+    import boto3
+
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    s3 = boto3.client('s3')
+    keys = sorted(obj['Key'] for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix)
+                  for obj in page.get('Contents', []) if obj['Key'].endswith('.json'))
+
+    def fetch(key):
+        return s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+
+    with ThreadPoolExecutor(max_workers=S3_READERS) as executor:
+        for text in executor.map(fetch, keys):
+            yield text
+
+
+def read_local_files(path):
+    """
+    Description: This function is responsible for the text of the JSON files of a local tree, in path order
+
+    Returns:
+        iterator of file contents
+    """
+    for filepath in sorted(glob.glob(os.path.join(path, '**', '*.json'), recursive=True)):
+        with open(filepath) as f:
+            yield f.read()
+
+
+def read_records(path):
+    """
+    Description: This function is responsible for reading the JSON records of a tree of files, one object per line
+                 (log data) or one object per file (song data)
+
+    Arguments:
+        path: s3:// prefix or local root directory of the JSON files.
+
+    Returns:
+        iterator of dictionaries
+    """
+    files = read_s3_files(path) if path.startswith('s3://') else read_local_files(path)
+    for text in files:
+        for line in text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def to_row(record, columns):
+    """
+    Description: This function is responsible for turning a JSON record into the values of the staging columns.
+                 An empty string is a null (an unquoted empty CSV field), whole floats of a text column such as
+                 registration are written without their .0
+
+    Returns:
+        list of values
+    """
+    row = []
+    for _, key, kind in columns:
+        value = record.get(key)
+        if value is None or value == '':
+            value = None
+        elif kind == 'text':
+            value = str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+        elif kind == 'real':
+            value = float(value)
+        else:
+            value = int(value)
+        row.append(value)
+    return row
+
+
+def write_csv_shards(rows, directory, table, shards):
+    """
+    Description: This function is responsible for writing rows round robin to gzip CSV shards, so the shards are
+                 of similar size and each slice of the cluster loads one
+
+    Returns:
+        list of the shard paths
+    """
+    paths = [os.path.join(directory, '{}-{:04d}{}'.format(table, i, EXTENSIONS['csv'])) for i in range(shards)]
+    files = [io.TextIOWrapper(gzip.open(path, 'wb'), encoding='utf-8', newline='') for path in paths]
+    writers = [csv.writer(f) for f in files]
+    try:
+        for i, row in enumerate(rows):
+            writers[i % shards].writerow(row)
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def write_parquet_shards(rows, directory, table, shards, columns):
+    """
+    Description: This function is responsible for writing rows round robin to parquet shards, with the types of
+                 the staging table. pyarrow is only needed for this format.
+
+    Returns:
+        list of the shard paths
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {'text': pa.string(), 'int': pa.int32(), 'smallint': pa.int16(), 'bigint': pa.int64(),
+             'real': pa.float32()}
+    schema = pa.schema([(name, types[kind]) for name, _, kind in columns])
+    parts = [[] for _ in range(shards)]
+    for i, row in enumerate(rows):
+        parts[i % shards].append(row)
+
+    paths = []
+    for i, part in enumerate(parts):
+        path = os.path.join(directory, '{}-{:04d}{}'.format(table, i, EXTENSIONS['parquet']))
+        arrays = [pa.array([row[j] for row in part], type=field.type) for j, field in enumerate(schema)]
+        pq.write_table(pa.Table.from_arrays(arrays, schema=schema), path)
+        paths.append(path)
+    return paths
+
+
+def write_manifest(paths, directory, table, prefix):
+    """
+    Description: This function is responsible for the COPY manifest of the shards, their urls under the S3 prefix
+                 the prestaged directory is copied to, and their size (required for parquet)
+
+    Returns:
+        path of the manifest
+    """
+    entries = [{'url': '{}/{}'.format(prefix.rstrip('/'), os.path.basename(path)),
+                'mandatory': True,
+                'meta': {'content_length': os.path.getsize(path)}} for path in paths]
+    path = os.path.join(directory, '{}.manifest'.format(table))
+    with open(path, 'w') as f:
+        json.dump({'entries': entries}, f, indent=2)
+    return path
+
+
+def prestage(source, directory, table, columns, shards, file_format, prefix):
+    """
+    Description: This function is responsible for converting the JSON tree of a staging table to shards and their
+                 manifest
+
+    Arguments:
+        source: s3:// prefix or local root directory of the JSON files.
+        directory: local directory of the shards.
+        table: staging table.
+        columns: columns of the staging table, see EVENT_COLUMNS.
+        shards: number of shards, the number of slices of the cluster.
+        file_format: csv (gzip) or parquet.
+        prefix: S3 prefix the directory is copied to.
+
+    Returns:
+        path of the manifest
+    """
+    os.makedirs(directory, exist_ok=True)
+    for old in glob.glob(os.path.join(directory, '{}-*{}'.format(table, EXTENSIONS[file_format]))):
+        os.remove(old)
+    rows = (to_row(record, columns) for record in read_records(source))
+    if file_format == 'parquet':
+        paths = write_parquet_shards(rows, directory, table, shards, columns)
+    else:
+        paths = write_csv_shards(rows, directory, table, shards)
+    return write_manifest(paths, directory, table, prefix)
+
+
+def copy_local(cur, conn, table, manifest, directory):
+    """
+    Description: This function is responsible for loading the CSV shards of a manifest into a local Postgres
+                 staging table with COPY ... CSV, the test target of the Redshift COPY
+
+    Arguments:
+        cur: cursor to the local database
+        conn: connection to the local database
+        table: staging table.
+        manifest: path of the manifest.
+        directory: local directory of the shards.
+
+    Returns:
+        None
+    """
+    with open(manifest) as f:
+        entries = json.load(f)['entries']
+    for entry in entries:
+        with gzip.open(os.path.join(directory, os.path.basename(entry['url'])), 'rt', encoding='utf-8') as shard:
+            cur.copy_expert("COPY {} FROM STDIN WITH (FORMAT csv)".format(table), shard)
+    conn.commit()
+
+
+def main():
+    """
+    Description: This function is responsible for
+    - Reading the [PRESTAGE] section of dwh.cfg.
+    - Converting the log and song JSON trees of [S3] (or their local copies with --local) to shards and manifests.
+    - Optionally loading the CSV shards into a local Postgres database.
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Converts the Sparkify JSON to COPY shards of the staging tables')
+    parser.add_argument('--local', action='store_true',
+                        help='convert the local JSON trees of [PRESTAGE] instead of the [S3] ones, e.g. the sample data')
+    parser.add_argument('--load-local', metavar='DSN',
+                        help='load the CSV shards into a local Postgres, e.g. "host=127.0.0.1 dbname=sparkifydb"')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    settings = config['PRESTAGE']
+    directory = settings['OUTPUT']
+    manifests = {}
+    for table, (columns, s3_key, local_key) in STAGING_TABLES.items():
+        source = settings[local_key] if args.local else config['S3'][s3_key].strip("'")
+        manifests[table] = prestage(source, directory, table, columns, int(settings['SLICES']),
+                                    settings['FORMAT'], settings['S3_PREFIX'])
+        print('{} -> {}'.format(table, manifests[table]))
+
+    if args.load_local:
+        import psycopg2
+        from sql_queries import staging_events_table_create, staging_songs_table_create
+
+        conn = psycopg2.connect(args.load_local)
+        cur = conn.cursor()
+        for query in (staging_events_table_create, staging_songs_table_create):
+            cur.execute(query)
+        for table, manifest in manifests.items():
+            cur.execute("TRUNCATE {}".format(table))
+            copy_local(cur, conn, table, manifest, directory)
+            cur.execute("SELECT COUNT(*) FROM {}".format(table))
+            print('{}: {} rows'.format(table, cur.fetchone()[0]))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
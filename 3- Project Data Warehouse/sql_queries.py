@@ -1,5 +1,7 @@
 import configparser
 
+from prestage import manifest_url
+
 
 # CONFIG
 config = configparser.ConfigParser()
@@ -117,28 +119,50 @@ time_table_create = ("""
 """)
 
 # STAGING TABLES
-staging_events_copy = ("""
+# the staging tables are copied from the JSON of [S3]. With ENABLED=true in [PRESTAGE] they are loaded from the
+# shards prestage.py converted the JSON to instead, one per slice, through their manifest
+def staging_copy(table):
+    """
+    Description: This function is responsible for the COPY of a staging table, from the JSON of [S3] or from its
+                 prestaged shards
+
+    Arguments:
+     table: staging table, the name of its manifest
+
+    Returns:
+        COPY statement
+    """
+    if not config.getboolean('PRESTAGE', 'ENABLED', fallback=False):
+        if table == 'stage_event':
+            return ("""
     COPY {} FROM {}
     IAM_ROLE '{}'
     JSON {} region '{}';
-""").format(
-    'stage_event',
-    config['S3']['LOG_DATA'],
-    config['IAM_ROLE']['ARN'],
-    config['S3']['LOG_JSONPATH'],
-    config['CLUSTER']['REGION']
-)
-
-staging_songs_copy = ("""
+""").format(table, config['S3']['LOG_DATA'], config['IAM_ROLE']['ARN'], config['S3']['LOG_JSONPATH'],
+            config['CLUSTER']['REGION'])
+        return ("""
     COPY {} FROM {}
     IAM_ROLE '{}'
     JSON 'auto' region '{}';
-""").format(
-    'stage_song',
-    config['S3']['SONG_DATA'],
-    config['IAM_ROLE']['ARN'],
-    config['CLUSTER']['REGION']
-)
+""").format(table, config['S3']['SONG_DATA'], config['IAM_ROLE']['ARN'], config['CLUSTER']['REGION'])
+
+    manifest = manifest_url(config['PRESTAGE']['S3_PREFIX'], table)
+    if config['PRESTAGE']['FORMAT'] == 'parquet':
+        return ("""
+    COPY {} FROM '{}'
+    IAM_ROLE '{}'
+    FORMAT AS PARQUET MANIFEST;
+""").format(table, manifest, config['IAM_ROLE']['ARN'])
+    return ("""
+    COPY {} FROM '{}'
+    IAM_ROLE '{}'
+    CSV GZIP EMPTYASNULL MANIFEST region '{}';
+""").format(table, manifest, config['IAM_ROLE']['ARN'], config['CLUSTER']['REGION'])
+
+
+staging_events_copy = staging_copy('stage_event')
+
+staging_songs_copy = staging_copy('stage_song')
 
 # FINAL TABLES
 songplay_table_insert = ("""
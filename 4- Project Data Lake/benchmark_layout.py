@@ -0,0 +1,119 @@
+import argparse
+import glob
+import os
+import time
+from datetime import datetime, timezone
+
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+def row_group_may_match(row_group, column, low, high):
+    """
+    Description: This function is responsible for deciding from the min/max statistics whether a row group
+                 can contain values of a column between low and high (both inclusive)
+
+    Arguments:
+            row_group : pyarrow row group metadata.
+            column    : column name.
+            low, high : bounds of the predicate, None for an open bound.
+
+    Returns:
+            False only when the statistics prove that no row matches
+    """
+    for i in range(row_group.num_columns):
+        chunk = row_group.column(i)
+        if chunk.path_in_schema != column:
+            continue
+        stats = chunk.statistics
+        if stats is None or not stats.has_min_max:
+            return True
+        if low is not None and stats.max < low:
+            return False
+        if high is not None and stats.min > high:
+            return False
+    return True
+
+
+def count_row_groups(path, column, low, high):
+    """
+    Description: This function is responsible for counting the row groups of a parquet table and how many of them
+                 a reader has to open for the predicate low <= column <= high
+
+    Arguments:
+            path      : root directory of the parquet table.
+            column    : column name.
+            low, high : bounds of the predicate.
+
+    Returns:
+            (total row groups, row groups that may match)
+    """
+    total, scanned = 0, 0
+    for filepath in glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True):
+        metadata = pq.ParquetFile(filepath).metadata
+        for i in range(metadata.num_row_groups):
+            total += 1
+            if row_group_may_match(metadata.row_group(i), column, low, high):
+                scanned += 1
+    return total, scanned
+
+
+def timed_read(path, column, low, high):
+    """
+    Description: This function is responsible for reading the rows matching the predicate with pyarrow,
+                 which prunes partitions and row groups by their statistics
+
+    Returns:
+            (number of rows, seconds)
+    """
+    field = ds.field(column)
+    predicate = (field >= low) & (field <= high)
+    start = time.perf_counter()
+    table = ds.dataset(path, format='parquet', partitioning='hive').to_table(filter=predicate)
+    return table.num_rows, time.perf_counter() - start
+
+
+def parse_bound(value, column):
+    """
+    Description: This function is responsible for turning a command line bound into the column's python type
+    """
+    if value is None:
+        return None
+    if column == 'start_time':
+        # start_time is written adjusted to UTC, a bound without an offset is taken as UTC
+        bound = datetime.fromisoformat(value)
+        return bound.replace(tzinfo=timezone.utc) if bound.tzinfo is None else bound
+    return value
+
+
+def main():
+    """
+    Description: This function is responsible for reporting how many row groups the layout lets a reader skip
+                 for a point or range filter on a songplays or time table written by etl.py
+
+    Arguments: None
+
+    Returns: None
+    """
+    parser = argparse.ArgumentParser(description='Row group skipping benchmark for the data lake parquet layout')
+    parser.add_argument('path', help='root directory of the parquet table, e.g. output/songplays')
+    parser.add_argument('--column', default='user_id', help='filtered column (user_id, song_id, start_time)')
+    parser.add_argument('--low', required=True, help='lower bound, equal to --high for a point lookup')
+    parser.add_argument('--high', help='upper bound, defaults to --low')
+    args = parser.parse_args()
+
+    low = parse_bound(args.low, args.column)
+    high = parse_bound(args.high or args.low, args.column)
+
+    total, scanned = count_row_groups(args.path, args.column, low, high)
+    rows, seconds = timed_read(args.path, args.column, low, high)
+    skipped = total - scanned
+
+    print('{} between {} and {}'.format(args.column, low, high))
+    print('row groups: {} total, {} scanned, {} skipped ({:.1f}%)'.format(
+        total, scanned, skipped, 100.0 * skipped / total if total else 0.0))
+    print('matched {} rows in {:.3f}s'.format(rows, seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
+import argparse
 import configparser
-from datetime import datetime
 import os
+import sys
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, monotonically_increasing_id
+from pyspark.sql import Window
+from pyspark.sql.functions import col, lit, shiftLeft, shiftRight, coalesce, percent_rank
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format, dayofweek
 from pyspark.sql.types import TimestampType
+from layout import PARQUET_LAYOUT, ROW_GROUP_SIZE
+
+# spark_metrics.py is shared with the capstone, in the common directory of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from spark_metrics import metrics_collector
+from surrogate_keys import SONGPLAY_KEY, with_hash_key
 
 #Set AWS credentials
 config = configparser.ConfigParser()
@@ -13,10 +21,46 @@ config.read('dl.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS_SECRET_ACCESS_KEY']
 
+# local directory of the JSON run reports written by the metrics collector of the session
+METRICS_DIR = 'metrics'
+
+# inputs smaller than this (in bytes) are processed by local_engine, without starting spark
+LOCAL_ENGINE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def input_size(path, limit=None):
+    """
+    Description: This function is responsible for summing the size in bytes of the json files below a local
+                 directory or an S3 prefix, used to pick the engine. An S3 prefix is listed with boto3 a page of
+                 1000 keys at a time and the listing stops once limit is reached, so a large input costs a
+                 few requests.
+
+    Arguments:
+            path  : local path or s3/s3a url of the directory.
+            limit : size past which the exact total doesn't matter.
+
+    Returns:
+            size in bytes, at least limit when the listing stopped early
+    """
+    if '://' not in path:
+        return sum(os.path.getsize(os.path.join(directory, name))
+                   for directory, _, names in os.walk(path) for name in names if name.endswith('.json'))
+
+    import boto3
+
+    bucket, _, prefix = path.split('://', 1)[1].partition('/')
+    size = 0
+    for page in boto3.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        size += sum(obj['Size'] for obj in page.get('Contents', []) if obj['Key'].endswith('.json'))
+        if limit is not None and size >= limit:
+            break
+    return size
+
 
 def create_spark_session():
     """
-    Description: This function is responsible for creating and returning a Spark session
+    Description: This function is responsible for creating and returning a Spark session, with a metrics
+                 collector attached (see spark_metrics.metrics_collector)
     
     Arguments: None
      
@@ -25,10 +69,94 @@ def create_spark_session():
     spark = SparkSession \
         .builder \
         .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.sql.parquet.outputTimestampType", "TIMESTAMP_MICROS") \
+        .config("spark.sql.session.timeZone", "UTC") \
         .getOrCreate()
+    metrics_collector(spark)
     return spark
 
 
+def rank_bucket(name, bits, partition_by):
+    """
+    Description: This function is responsible for mapping a column to its percent rank inside the output
+                 partition, scaled to bits bits, so every column of a Z-order key spans the same range
+                 whatever its raw values (epoch seconds vary over ~2^21 in a month, user ids over ~2^7)
+
+    Arguments:
+            name         : name of the column.
+            bits         : width of the bucket.
+            partition_by : list of partition columns, the rank is computed per partition.
+
+    Returns:
+            spark column holding a long between 0 and 2^bits - 1
+    """
+    window = Window.partitionBy(*partition_by).orderBy(coalesce(col(name).cast('long'), lit(0)))
+    return (percent_rank().over(window) * ((1 << bits) - 1)).cast('long')
+
+
+def zorder(*columns):
+    """
+    Description: This function is responsible for building a Z-order (Morton) key by interleaving
+                 the bits of the given numeric or timestamp columns, so that sorting on it keeps
+                 rows close in every column close on disk. The columns are expected to be of the same
+                 width already, see rank_bucket.
+    
+    Arguments: 
+            columns : names of the columns to interleave.
+     
+    Returns: 
+            spark column holding a non negative long sort key
+    """
+    bits = 63 // len(columns)
+    key = lit(0).cast('long')
+    for bit in range(bits):
+        for i, name in enumerate(columns):
+            value = col(name).cast('long')
+            key = key.bitwiseOR(shiftLeft(shiftRight(value, bit).bitwiseAND(1), bit * len(columns) + i))
+    return key
+
+
+def write_parquet(df, path, partition_by=None, layout=None, mode="overwrite"):
+    """
+    Description: This function is responsible for writing a table to parquet, optionally clustering the rows
+                 of every partition by the table layout so readers can skip row groups by their statistics
+    
+    Arguments: 
+            df           : spark dataframe to write.
+            path         : output path for the parquet files.
+            partition_by : list of partition columns.
+            layout       : entry of PARQUET_LAYOUT, None writes the rows unsorted.
+            mode         : spark save mode.
+     
+    Returns: 
+            None
+    """
+    partition_by = partition_by or []
+    writer_options = {}
+    
+    if layout:
+        sort_by = layout['sort_by']
+        sort_key = sort_by
+        buckets = []
+        if layout['zorder'] and len(sort_by) > 1:
+            bits = 63 // len(sort_by)
+            buckets = ['_zorder_' + name for name in sort_by]
+            for name, bucket in zip(sort_by, buckets):
+                df = df.withColumn(bucket, rank_bucket(name, bits, partition_by))
+            sort_key = [zorder(*buckets)]
+        
+        # one task per output partition, rows sorted by partition columns first so spark keeps the order on write
+        if partition_by:
+            df = df.repartition(*partition_by)
+        df = df.sortWithinPartitions(*(partition_by + sort_key)).drop(*buckets)
+        
+        writer_options['parquet.block.size'] = str(ROW_GROUP_SIZE)
+        for column in layout['bloom_filter']:
+            writer_options['parquet.bloom.filter.enabled#' + column] = 'true'
+
+    df.write.options(**writer_options).parquet(path, mode=mode, partitionBy=partition_by)
+
+
 def process_song_data(spark, input_data, output_data):
     """
     Description: This function is responsible for extracting song data json files from S3 and writing result in parquet in S3
@@ -91,8 +219,8 @@ def process_log_data(spark, input_data, output_data):
 
 
     # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda x : datetime.utcfromtimestamp(int(x)/1000), TimestampType())
-    log_df = log_df.withColumn("start_time", get_timestamp("ts"))
+    # the instant of ts, hour/day/... are taken in the session time zone (UTC)
+    log_df = log_df.withColumn("start_time", (col("ts") / 1000).cast(TimestampType()))
     
     # extract columns to create time table
     time_table = log_df.withColumn("hour",hour("start_time"))\
@@ -105,7 +233,7 @@ def process_log_data(spark, input_data, output_data):
 
     
     # write time table to parquet files partitioned by year and month
-    time_table.write.parquet(os.path.join(output_data, 'time'),mode="overwrite", partitionBy=['year', 'month'])
+    write_parquet(time_table, os.path.join(output_data, 'time'), ['year', 'month'], PARQUET_LAYOUT['time'])
 
 
     # read in song data to use for songplays table
@@ -113,9 +241,11 @@ def process_log_data(spark, input_data, output_data):
  
 
     # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = log_df.join(song_df,(log_df.song == song_df.title) & (log_df.artist == song_df.artist_name) & (log_df.length == song_df.duration), how='inner').distinct() \
-                        .select("userId", "start_time", "song_id", "artist_id", "level", "sessionId", "location", "userAgent" ) \
-                        .withColumn("songplay_id",monotonically_increasing_id()) \
+    songplays_table = log_df.join(song_df,(log_df.song == song_df.title) & (log_df.artist == song_df.artist_name) & (log_df.length == song_df.duration), how='inner').distinct()
+    
+    # songplay_id is a hash of the play event, so it stays the same across runs
+    songplays_table = with_hash_key(songplays_table, "songplay_id", SONGPLAY_KEY) \
+                        .select("userId", "start_time", "song_id", "artist_id", "level", "sessionId", "location", "userAgent", "songplay_id") \
                         .withColumn("month",month("start_time")) \
                         .withColumn("year",year("start_time")) \
                         .withColumnRenamed("userId","user_id")        \
@@ -124,30 +254,58 @@ def process_log_data(spark, input_data, output_data):
 
 
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.parquet(os.path.join(output_data, "songplays"), mode="overwrite", partitionBy=["year","month"])
+    write_parquet(songplays_table, os.path.join(output_data, "songplays"), ["year","month"], PARQUET_LAYOUT['songplays'])
 
 
 def main():
     """
-    Description: This function is responsible for running the ETL to process the song_data and the log_data files and save result to s3
+    Description: This function is responsible for running the ETL to process the song_data and the log_data files and save result to s3.
+                 --engine local runs local_engine (pyarrow/pandas) to skip the spark startup, --engine auto does so
+                 for local or S3 inputs below LOCAL_ENGINE_MAX_BYTES. With spark a JSON report of the spark jobs
+                 and stages of the run is written to METRICS_DIR
 
     Arguments: None
      
     Returns: None
     """
-    # Create a Spark Session
-    spark = create_spark_session()
-    
+    parser = argparse.ArgumentParser(description='Sparkify data lake ETL')
+    parser.add_argument('--engine', choices=['auto', 'spark', 'local'], default='auto',
+                        help='auto picks local for inputs below LOCAL_ENGINE_MAX_BYTES, spark otherwise')
     #paths to input and output data
-    input_data = "s3a://udacity-dend/"
+    parser.add_argument('--input', default="s3a://udacity-dend/")
     #the created bucket name udacity-sparkify-data-lake to store all parquet files
-    output_data  = "s3a://udacity-sparkify-data-lake/" 
+    parser.add_argument('--output', default="s3a://udacity-sparkify-data-lake/")
+    args = parser.parse_args()
+    input_data, output_data = args.input, args.output
+
+    engine = args.engine
+    if engine == 'auto':
+        size = input_size(input_data + "song_data", LOCAL_ENGINE_MAX_BYTES)
+        if size < LOCAL_ENGINE_MAX_BYTES:
+            size += input_size(input_data + "log_data", LOCAL_ENGINE_MAX_BYTES - size)
+        engine = 'local' if size < LOCAL_ENGINE_MAX_BYTES else 'spark'
+    if engine == 'local':
+        # pandas, pyarrow and xxhash are only needed here, not on the spark cluster
+        import local_engine
+
+        print('Running the local engine')
+        local_engine.process_song_data(None, input_data, output_data)
+        local_engine.process_log_data(None, input_data, output_data)
+        return
     
-    #run ELT process
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    # Create a Spark Session and collect the metrics of every ETL step
+    spark = create_spark_session()
+    metrics = metrics_collector(spark)
     
-    spark.stop()
+    #run ELT process
+    try:
+        with metrics.track('process_song_data'):
+            process_song_data(spark, input_data, output_data)    
+        with metrics.track('process_log_data'):
+            process_log_data(spark, input_data, output_data)
+    finally:
+        print('Run report written to {}'.format(metrics.write_report(METRICS_DIR)))
+        spark.stop()
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
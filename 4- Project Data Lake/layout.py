@@ -0,0 +1,11 @@
+# Parquet layout of the tables that are filtered on point/range columns.
+#   sort_by      : columns to cluster the rows on inside every output partition
+#   zorder       : interleave the bits of the sort_by columns instead of a plain sort
+#   bloom_filter : columns written with a parquet bloom filter (Spark 3.2+, ignored before)
+PARQUET_LAYOUT = {
+    'songplays': {'sort_by': ['user_id', 'start_time'], 'zorder': True, 'bloom_filter': ['user_id', 'song_id']},
+    'time': {'sort_by': ['start_time'], 'zorder': False, 'bloom_filter': []},
+}
+
+# Parquet row group size in bytes, smaller row groups give finer min/max statistics
+ROW_GROUP_SIZE = 32 * 1024 * 1024
@@ -0,0 +1,291 @@
+import posixpath
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.json as pajson
+
+from layout import PARQUET_LAYOUT, ROW_GROUP_SIZE
+from surrogate_keys import SONGPLAY_KEY, check_collisions_pandas, hash_key_pandas
+
+# Schemas spark infers for the song and log json files (fields sorted by name, integers as long)
+SONG_SCHEMA = pa.schema([
+    ('artist_id', pa.string()),
+    ('artist_latitude', pa.float64()),
+    ('artist_location', pa.string()),
+    ('artist_longitude', pa.float64()),
+    ('artist_name', pa.string()),
+    ('duration', pa.float64()),
+    ('num_songs', pa.int64()),
+    ('song_id', pa.string()),
+    ('title', pa.string()),
+    ('year', pa.int64()),
+])
+
+LOG_SCHEMA = pa.schema([
+    ('artist', pa.string()),
+    ('auth', pa.string()),
+    ('firstName', pa.string()),
+    ('gender', pa.string()),
+    ('itemInSession', pa.int64()),
+    ('lastName', pa.string()),
+    ('length', pa.float64()),
+    ('level', pa.string()),
+    ('location', pa.string()),
+    ('method', pa.string()),
+    ('page', pa.string()),
+    ('registration', pa.float64()),
+    ('sessionId', pa.int64()),
+    ('song', pa.string()),
+    ('status', pa.int64()),
+    ('ts', pa.int64()),
+    ('userAgent', pa.string()),
+    ('userId', pa.string()),
+])
+
+# Number of json files read concurrently, S3 reads are latency bound
+READ_THREADS = 16
+
+
+def resolve(path):
+    """
+    Description: This function is responsible for resolving a local or S3 path to a pyarrow filesystem
+
+    Arguments:
+            path : local path or s3/s3a url.
+
+    Returns:
+            (pyarrow filesystem, path inside the filesystem)
+    """
+    if path.startswith('s3a://'):
+        path = 's3://' + path[len('s3a://'):]
+    if '://' not in path:
+        return pafs.LocalFileSystem(), posixpath.abspath(path)
+    return pafs.FileSystem.from_uri(path)
+
+
+def list_json_files(path):
+    """
+    Description: This function is responsible for listing the json files below a directory
+
+    Arguments:
+            path : local path or s3/s3a url of the directory.
+
+    Returns:
+            (pyarrow filesystem, list of file infos)
+    """
+    fs, base = resolve(path)
+    selector = pafs.FileSelector(base, allow_not_found=True, recursive=True)
+    files = [info for info in fs.get_file_info(selector)
+             if info.type == pafs.FileType.File and info.path.endswith('.json')]
+    return fs, sorted(files, key=lambda info: info.path)
+
+
+def read_json(path, schema):
+    """
+    Description: This function is responsible for reading all the json files below a directory into a pandas dataframe
+                 with the column types spark would infer
+
+    Arguments:
+            path   : local path or s3/s3a url of the directory.
+            schema : pyarrow schema of the json records.
+
+    Returns:
+            pandas dataframe
+    """
+    fs, files = list_json_files(path)
+    parse_options = pajson.ParseOptions(explicit_schema=schema, unexpected_field_behavior='ignore')
+
+    def read_file(info):
+        with fs.open_input_stream(info.path) as stream:
+            return pajson.read_json(stream, parse_options=parse_options)
+
+    with ThreadPoolExecutor(READ_THREADS) as executor:
+        tables = list(executor.map(read_file, files))
+    if not tables:
+        return schema.empty_table().to_pandas()
+    return pa.concat_tables(tables).to_pandas()
+
+
+def zorder(*columns):
+    """
+    Description: This function is responsible for building the same Z-order (Morton) key as etl.zorder
+                 from numpy integer arrays of the same width, see rank_bucket
+
+    Arguments:
+            columns : integer arrays to interleave.
+
+    Returns:
+            int64 numpy array
+    """
+    bits = 63 // len(columns)
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for bit in range(bits):
+        for i, values in enumerate(columns):
+            key |= ((values >> bit) & 1) << (bit * len(columns) + i)
+    return key
+
+
+def sort_key(df, column):
+    """
+    Description: This function is responsible for casting a column to long the way spark casts it,
+                 timestamps become epoch seconds
+    """
+    values = df[column]
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.astype('int64').to_numpy() // 10 ** 9
+    return pd.to_numeric(values, errors='coerce').fillna(0).astype('int64').to_numpy()
+
+
+def rank_bucket(df, column, bits, partition_by):
+    """
+    Description: This function is responsible for the same bucket as etl.rank_bucket, the percent rank
+                 ((rank - 1) / (rows - 1)) of the column inside its output partition scaled to bits bits
+
+    Returns:
+            int64 numpy array
+    """
+    values = pd.Series(sort_key(df, column), index=df.index)
+    groups = values.groupby([df[c] for c in partition_by]) if partition_by else values.groupby(np.zeros(len(df)))
+    rank = groups.rank(method='min') - 1
+    rows = groups.transform('size') - 1
+    percent = (rank / rows.where(rows > 0, 1)).fillna(0)
+    return (percent * ((1 << bits) - 1)).astype('int64').to_numpy()
+
+
+def write_parquet(df, path, partition_by=None, layout=None, mode="overwrite", schema=None, required=None):
+    """
+    Description: This function is responsible for writing a pandas dataframe to parquet with the same
+                 hive partition layout, column types and save modes as the spark writer in etl.py
+
+    Arguments:
+            df           : pandas dataframe to write.
+            path         : output path for the parquet files.
+            partition_by : list of partition columns.
+            layout       : entry of PARQUET_LAYOUT, None writes the rows unsorted.
+            mode         : "overwrite" or "error" (spark's default), as in spark.
+            schema       : pyarrow schema of the table, inferred when None.
+            required     : columns spark writes as non nullable.
+
+    Returns:
+            None
+    """
+    partition_by = partition_by or []
+    fs, base = resolve(path)
+
+    if fs.get_file_info(base).type != pafs.FileType.NotFound:
+        if mode != "overwrite":
+            raise FileExistsError("path {} already exists.".format(path))
+        fs.delete_dir(base)
+
+    if layout:
+        sort_by = layout['sort_by']
+        if layout['zorder'] and len(sort_by) > 1:
+            bits = 63 // len(sort_by)
+            df = df.assign(_zorder=zorder(*[rank_bucket(df, column, bits, partition_by) for column in sort_by]))
+            df = df.sort_values(partition_by + ['_zorder'], kind='stable').drop(columns='_zorder')
+        else:
+            df = df.sort_values(partition_by + sort_by, kind='stable')
+
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False).replace_schema_metadata(None)
+    # spark writes plain utf8 strings, newer pandas hands over large_string columns
+    required = required or []
+    table = table.cast(pa.schema([pa.field(field.name,
+                                           pa.string() if pa.types.is_large_string(field.type) else field.type,
+                                           nullable=field.name not in required)
+                                  for field in table.schema]))
+    rows_per_group = max(1, ROW_GROUP_SIZE * table.num_rows // max(table.nbytes, 1))
+    partitioning = None
+    if partition_by:
+        partitioning = ds.partitioning(table.select(partition_by).schema, flavor='hive')
+
+    ds.write_dataset(table, base, filesystem=fs, format='parquet',
+                     partitioning=partitioning,
+                     basename_template='part-{{i}}-{}.snappy.parquet'.format(uuid.uuid4()),
+                     max_rows_per_group=min(rows_per_group, 1024 * 1024),
+                     min_rows_per_group=0,
+                     existing_data_behavior='overwrite_or_ignore',
+                     file_options=ds.ParquetFileFormat().make_write_options(compression='snappy'))
+
+    # spark marks a finished write with an empty _SUCCESS file
+    with fs.open_output_stream(posixpath.join(base, '_SUCCESS')):
+        pass
+
+
+def process_song_data(spark, input_data, output_data):
+    """
+    Description: This function is responsible for extracting song data json files and writing the songs and
+                 artists tables in parquet, without a spark session
+
+    Arguments:
+            spark      : unused, kept so both engines share the same interface.
+            input_data : input path for json files (local or S3).
+            output_data: output path for parquet files (local or S3).
+
+    Returns:
+            None
+    """
+    df = read_json(posixpath.join(input_data, 'song_data'), SONG_SCHEMA)
+
+    songs_table = df[["song_id", "title", "artist_id", "year", "duration"]].drop_duplicates()
+    write_parquet(songs_table, posixpath.join(output_data, 'songs'), ['year', 'artist_id'])
+
+    artists_table = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
+    write_parquet(artists_table.drop_duplicates(), posixpath.join(output_data, 'artists'), ['artist_id'])
+
+
+def process_log_data(spark, input_data, output_data):
+    """
+    Description: This function is responsible for extracting log data json files and writing the users, time and
+                 songplays tables in parquet, without a spark session
+
+    Arguments:
+            spark      : unused, kept so both engines share the same interface.
+            input_data : input path for json files (local or S3).
+            output_data: output path for parquet files (local or S3).
+
+    Returns:
+            None
+    """
+    log_df = read_json(posixpath.join(input_data, 'log_data'), LOG_SCHEMA)
+    log_df = log_df[log_df.page == "NextSong"]
+
+    users_table = log_df[["userId", "firstName", "lastName", "gender", "level"]].drop_duplicates(subset=['userId'])
+    write_parquet(users_table, posixpath.join(output_data, 'users'), mode="error")
+
+    log_df = log_df.assign(start_time=pd.to_datetime(log_df.ts, unit='ms', utc=True).astype('datetime64[us, UTC]'))
+
+    # same fields as spark: dayofweek counts from sunday = 1, weekofyear is the ISO week
+    start_time = log_df.start_time.dt
+    time_table = pd.DataFrame({
+        'start_time': log_df.start_time,
+        'hour': start_time.hour.astype('int32'),
+        'day': start_time.day.astype('int32'),
+        'week': start_time.isocalendar().week.astype('int32'),
+        'month': start_time.month.astype('int32'),
+        'year': start_time.year.astype('int32'),
+        'weekday': ((start_time.dayofweek + 1) % 7 + 1).astype('int32'),
+    }).drop_duplicates(subset=['start_time'])
+    write_parquet(time_table, posixpath.join(output_data, 'time'), ['year', 'month'], PARQUET_LAYOUT['time'])
+
+    song_df = read_json(posixpath.join(input_data, 'song_data'), SONG_SCHEMA)
+
+    songplays_table = log_df.merge(song_df, how='inner',
+                                   left_on=['song', 'artist', 'length'],
+                                   right_on=['title', 'artist_name', 'duration']).drop_duplicates()
+    songplays_table = songplays_table.assign(songplay_id=np.array(hash_key_pandas(songplays_table, SONGPLAY_KEY),
+                                                                  dtype='int64'))
+    check_collisions_pandas(songplays_table, 'songplay_id', SONGPLAY_KEY)
+    songplays_table = songplays_table[["userId", "start_time", "song_id", "artist_id", "level",
+                                       "sessionId", "location", "userAgent", "songplay_id"]]
+    songplays_table = songplays_table.assign(month=songplays_table.start_time.dt.month.astype('int32'),
+                                             year=songplays_table.start_time.dt.year.astype('int32'))
+    songplays_table = songplays_table.rename(columns={"userId": "user_id",
+                                                      "sessionId": "session_id",
+                                                      "userAgent": "user_agent"})
+    write_parquet(songplays_table, posixpath.join(output_data, "songplays"), ["year", "month"],
+                  PARQUET_LAYOUT['songplays'], required=["songplay_id"])
@@ -0,0 +1,107 @@
+from pyspark.sql.functions import col, xxhash64
+
+# seed of spark's xxhash64, the pandas implementation chains from the same value.
+# pandas and xxhash are imported by the pandas functions only, the spark job doesn't need them
+KEY_SEED = 42
+
+_UINT64 = 1 << 64
+
+# natural key of a songplay: the log event (user, session, timestamp) and the matched song
+SONGPLAY_KEY = ["userId", "sessionId", "ts", "song_id"]
+
+
+def hash_key(*columns):
+    """
+    Description: This function is responsible for deriving a stable 64 bit surrogate key from natural key columns.
+                 The columns are hashed as strings with xxhash64, so the same natural key gets the same id on every
+                 run regardless of partitioning (unlike monotonically_increasing_id). Requires Spark 3.0+.
+
+    Arguments:
+            columns : names of the natural key columns.
+
+    Returns:
+            spark column of the signed 64 bit key
+    """
+    return xxhash64(*[col(name).cast('string') for name in columns])
+
+
+def check_collisions(df, key, columns):
+    """
+    Description: This function is responsible for failing when two different natural keys got the same surrogate key
+
+    Arguments:
+            df      : spark dataframe holding the key and the natural key columns.
+            key     : name of the surrogate key column.
+            columns : names of the natural key columns.
+
+    Returns:
+            None
+    """
+    collisions = df.select(key, *columns).distinct().groupBy(key).count().filter(col('count') > 1)
+    if collisions.limit(1).count():
+        raise ValueError("Surrogate key {} collides for different values of {}".format(key, columns))
+
+
+def with_hash_key(df, key, columns, check=True):
+    """
+    Description: This function is responsible for adding a hash surrogate key column to a spark dataframe
+
+    Arguments:
+            df      : spark dataframe.
+            key     : name of the surrogate key column.
+            columns : names of the natural key columns.
+            check   : run check_collisions, costs one aggregation over the table.
+
+    Returns:
+            spark dataframe with the key column
+    """
+    df = df.withColumn(key, hash_key(*columns))
+    if check:
+        check_collisions(df, key, columns)
+    return df
+
+
+def hash_values(*values):
+    """
+    Description: This function is responsible for computing the key of one row exactly as hash_key does in spark:
+                 every non null value is hashed as utf8 text, seeded with the hash of the previous values
+
+    Arguments:
+            values : natural key values of the row.
+
+    Returns:
+            signed 64 bit key
+    """
+    import pandas as pd
+    import xxhash
+
+    seed = KEY_SEED
+    for value in values:
+        if pd.isna(value):
+            continue
+        seed = xxhash.xxh64_intdigest(str(value).encode('utf-8'), seed=seed)
+    return seed - _UINT64 if seed >= 1 << 63 else seed
+
+
+def hash_key_pandas(df, columns):
+    """
+    Description: This function is responsible for computing hash_key over the rows of a pandas dataframe
+
+    Arguments:
+            df      : pandas dataframe.
+            columns : names of the natural key columns.
+
+    Returns:
+            list of signed 64 bit keys
+    """
+    rows = df[columns].astype(object).itertuples(index=False, name=None)
+    return [hash_values(*row) for row in rows]
+
+
+def check_collisions_pandas(df, key, columns):
+    """
+    Description: This function is responsible for check_collisions over a pandas dataframe
+    """
+    keys = df[[key] + columns].drop_duplicates()
+    if keys[key].duplicated().any():
+        raise ValueError("Surrogate key {} collides for different values of {}".format(key, columns))
@@ -82,6 +82,17 @@ CREATE TABLE public.users (
 	CONSTRAINT users_pkey PRIMARY KEY (userid)
 );
 
+CREATE TABLE public.load_metrics (
+	dag_id varchar(256),
+	task_id varchar(256),
+	execution_date timestamp,
+	table_name varchar(256),
+	step varchar(32),
+	seconds numeric(18,3),
+	row_count int8,
+	byte_count int8
+);
+
 
 
 
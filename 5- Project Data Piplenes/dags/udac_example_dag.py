@@ -1,114 +1,127 @@
 from datetime import datetime, timedelta
 import os
-from airflow import DAG
-from airflow.operators.dummy_operator import DummyOperator
-from airflow.operators import (StageToRedshiftOperator, LoadFactOperator,
-                                LoadDimensionOperator, DataQualityOperator)
 from helpers import SqlQueries
+from helpers.dag_factory import build_dag
+from helpers.load_metrics import TableSink
 
 # AWS_KEY = os.environ.get('AWS_KEY')
 # AWS_SECRET = os.environ.get('AWS_SECRET')
 
+# Staging and loads run in the redshift_copy / redshift_load pools and the fused load in the single slot
+# redshift_publish pool (see helpers/dag_factory.py), create them before a backfill.
+# The events manifests are written under the sparkify_manifest_path Variable, a bucket the Redshift role can read:
+#   airflow variables -s sparkify_manifest_path s3://<bucket>/manifests
+# log_data lands as one file per day, so a run covers a day and stages only that day's partition: runs of different
+# days never touch the same rows, and a backfill runs up to max_active_runs days in parallel:
+#   airflow backfill -s 2018-11-01 -e 2018-11-30 udac_example_dag
+
 default_args = {
     'owner': 'Dina-Samir',
     'depends_on_past': False,
-    'start_date': datetime.datetime.now(),
+    'start_date': datetime(2018, 11, 1),
     'email_on_failure': False,
     'email_on_retry': False,
     'retries': 3,
     'retry_delay': timedelta(minutes=5),
-    'catchup': False,
 }
 
-dag = DAG('udac_example_dag',
-          default_args=default_args,
-          description='Load and transform data in Redshift with Airflow',
-          schedule_interval='@hourly',
-        )
-
-start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
-
-
-stage_events_to_redshift = StageToRedshiftOperator(
-    task_id='Stage_events',
-    dag=dag,
-    redshift_conn_id="redshift",
-    aws_credentials_id="aws_credentials",    
-    table = "staging_events",
-    s3_path = "s3://udacity-dend/log_data",
-    json_path="s3://udacity-dend/log_json_path.json"
-)
-
-stage_songs_to_redshift = StageToRedshiftOperator(
-    task_id='Stage_songs',
-    dag=dag,
-    redshift_conn_id="redshift",
-    aws_credentials_id="aws_credentials",    
-    table = "staging_songs",
-    s3_path = "s3://udacity-dend/song_data",
-    json_path="auto"
-)
-
-load_songplays_table = LoadFactOperator(
-    task_id='Load_songplays_fact_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    table="songplays",
-    sql=SqlQueries.songplay_table_insert,
-    append_only=False
-)
-
-load_user_dimension_table = LoadDimensionOperator(
-    task_id='Load_user_dim_table',
-    dag=dag,   
-    redshift_conn_id="redshift",
-    table="users",
-    sql=SqlQueries.user_table_insert,
-    append_only=False
-)
-
-
-load_song_dimension_table = LoadDimensionOperator(
-    task_id='Load_song_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    table="songs",
-    sql=SqlQueries.song_table_insert,
-    append_only=False
-)
-
-load_artist_dimension_table = LoadDimensionOperator(
-    task_id='Load_artist_dim_table',
-    dag=dag,   
-    redshift_conn_id="redshift",
-    table="artists",
-    sql=SqlQueries.artist_table_insert,
-    append_only=False
-)
-
-load_time_dimension_table = LoadDimensionOperator(
-    task_id='Load_time_dim_table',
-    dag=dag,   
-    redshift_conn_id="redshift",
-    table="time",
-    sql=SqlQueries.time_table_insert,
-    append_only=False
-)
-
-run_quality_checks = DataQualityOperator(
-    task_id='Run_data_quality_checks',
-    dag=dag,
-    redshift_conn_id="redshift",
-    tables=[ "songplays", "songs", "artists",  "time", "users"]
-)
-
-end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
-
-start_operator >> [stage_events_to_redshift,stage_songs_to_redshift] \                >> load_songplays_table \
-               >>[load_user_dimension_table,\
-                  load_song_dimension_table,\
-                  load_artist_dimension_table,\
-                  load_time_dimension_table] \
-               >> end_operator
-
-
+# One entry per table, the DAG factory builds the stage, load and quality tasks from it.
+# Adding a table only needs a new entry here and its select in SqlQueries.
+sparkify_tables = [
+    {
+        'table': 'staging_events',
+        'kind': 'stage',
+        'task_id': 'Stage_events',
+        's3_key': "log_data/{{ execution_date.strftime('%Y/%m/%Y-%m-%d') }}-events.json",
+        'json_path': 's3://udacity-dend/log_json_path.json',
+        'partition_column': 'ts',
+        'partition_granularity': 'day',
+        # staging waits in the triggerer for the day's file and copies exactly the files that landed
+        'wait_for': {
+            'manifest_path': "{{ var.value.sparkify_manifest_path }}/staging_events/{{ ts_nodash }}.manifest",
+            'poke_interval': 300,
+            'timeout': 6 * 60 * 60,
+        },
+    },
+    {
+        'table': 'staging_songs',
+        'kind': 'stage',
+        'task_id': 'Stage_songs',
+        's3_key': 'song_data',
+        'json_path': 'auto',
+    },
+    {
+        'table': 'songplays',
+        'kind': 'fact',
+        'task_id': 'Load_songplays_fact_table',
+        'sql': SqlQueries.songplay_table_insert,
+        'load_strategy': 'upsert',
+        'primary_key': ['playid'],
+        'depends_on': ['staging_events', 'staging_songs'],
+        'checks': {
+            'min_rows': 1,
+            'null_ratio': {'userid': 0.0, 'start_time': 0.0},
+            'unique': ['playid'],
+            'references': {'userid': ('users', 'userid'),
+                           'songid': ('songs', 'songid'),
+                           'artistid': ('artists', 'artistid'),
+                           'start_time': ('time', 'start_time')},
+        },
+    },
+    {
+        'table': 'users',
+        'kind': 'dimension',
+        'task_id': 'Load_user_dim_table',
+        'sql': SqlQueries.user_table_insert,
+        'load_strategy': 'upsert',
+        'primary_key': ['userid'],
+        'depends_on': ['songplays'],
+        'checks': {'min_rows': 1, 'unique': ['userid'], 'null_ratio': {'first_name': 0.05}},
+    },
+    {
+        'table': 'songs',
+        'kind': 'dimension',
+        'task_id': 'Load_song_dim_table',
+        'sql': SqlQueries.song_table_insert,
+        'load_strategy': 'upsert',
+        'primary_key': ['songid'],
+        'depends_on': ['songplays'],
+        'checks': {'min_rows': 1, 'unique': ['songid'], 'null_ratio': {'title': 0.0}},
+    },
+    {
+        'table': 'artists',
+        'kind': 'dimension',
+        'task_id': 'Load_artist_dim_table',
+        'sql': SqlQueries.artist_table_insert,
+        'load_strategy': 'upsert',
+        'primary_key': ['artistid'],
+        'depends_on': ['songplays'],
+        'checks': {'min_rows': 1, 'unique': ['artistid'], 'null_ratio': {'name': 0.0}},
+    },
+    {
+        'table': 'time',
+        'kind': 'dimension',
+        'task_id': 'Load_time_dim_table',
+        'sql': SqlQueries.time_table_insert,
+        # the select only returns new start_times of the run's day, appending them keeps time unique
+        'load_strategy': 'append',
+        'depends_on': ['songplays'],
+        'checks': {'min_rows': 1, 'unique': ['start_time']},
+    },
+]
+
+dag = build_dag('udac_example_dag',
+                sparkify_tables,
+                redshift_conn_id="redshift",
+                aws_credentials_id="aws_credentials",
+                s3_path="s3://udacity-dend",
+                # loads and checks share one connection and transaction, a daily run publishes all tables or none
+                fused=True,
+                # durations and rowcounts of every statement, to spot the tables and hours trending slower
+                metrics_sink=TableSink("redshift"),
+                default_args=default_args,
+                description='Load and transform data in Redshift with Airflow',
+                schedule_interval='@daily',
+                catchup=False,
+                max_active_runs=8,
+               )
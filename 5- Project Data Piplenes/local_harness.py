@@ -0,0 +1,361 @@
+"""
+Runs the Sparkify DAG end to end without Redshift and S3, and reports the run time of every task.
+
+    python local_harness.py --days 2 --events-per-day 5000 --songs 2000 --variant both
+
+- synthetic song_data and log_data of the configured size are written to a local directory standing in for the bucket
+  (every tenth user upgrades from free to paid at noon, exercising the upsert of a user seen with two levels)
+- a local Postgres stands in for Redshift: `--postgres-uri`, or a throwaway server when pgserver is installed.
+  The COPY ... JSON statements of StageToRedshiftOperator are emulated from the local files (prefix or MANIFEST,
+  'auto' or a jsonpaths file), and the Redshift only SQL of SqlQueries is mapped to Postgres
+- the DAG of dags/udac_example_dag.py is built from its table specs and run with dag.test(), one run per day,
+  with the split operators, the fused operator or both
+
+Needs Airflow 2.5+ with the postgres and amazon providers and an initialized metadata database (airflow db migrate).
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'plugins'))
+sys.path.insert(0, os.path.join(HERE, 'dags'))
+
+import psycopg2
+from psycopg2.extensions import cursor as _cursor
+from psycopg2.extras import execute_values
+
+BUCKET = 's3://udacity-dend'
+
+# column order of staging_events, as in udacity's log_json_path.json
+LOG_JSON_PATHS = ["artist", "auth", "firstName", "gender", "itemInSession", "lastName", "length", "level",
+                  "location", "method", "page", "registration", "sessionId", "song", "status", "ts",
+                  "userAgent", "userId"]
+
+# Redshift functions and casts Postgres lacks
+POSTGRES_COMPAT_SQL = """
+    CREATE OR REPLACE FUNCTION redshift_concat(integer, timestamp) RETURNS text
+        AS 'SELECT $1::text || $2::text' LANGUAGE SQL IMMUTABLE;
+    DROP OPERATOR IF EXISTS || (integer, timestamp);
+    CREATE OPERATOR || (LEFTARG = integer, RIGHTARG = timestamp, FUNCTION = redshift_concat);
+"""
+
+SQL_REWRITES = [
+    (re.compile(r"extract\(dayofweek from", re.I), "extract(dow from"),
+]
+
+COPY_JSON = re.compile(r"^\s*COPY\s+(\S+)\s+FROM\s+'([^']+)'.*?\bJSON\s+'([^']+)'\s*(MANIFEST)?", re.I | re.S)
+
+
+def local_path(url, root):
+    """
+    Maps a url of the stand-in bucket to its local file
+    """
+    return os.path.join(root, url[len(BUCKET):].lstrip('/')) if url.startswith(BUCKET) else url
+
+
+def read_json_objects(path):
+    """
+    Returns the JSON objects of a file, concatenated or one per line like Redshift's COPY JSON reads them
+    """
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        text = f.read()
+    objects, position = [], 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            return objects
+        obj, position = decoder.raw_decode(text, position)
+        objects.append(obj)
+
+
+class CopyJsonCursor(_cursor):
+    """
+    Postgres cursor executing Redshift's COPY ... JSON from the local stand-in bucket, and answering the
+    COPY bytes query of helpers/load_metrics.py with the size of the files it read
+    """
+
+    bucket_root = None
+    copy_bytes_sql = None
+
+    def execute(self, query, vars=None):
+        if query == self.copy_bytes_sql:
+            # the bytes of the files the last emulated COPY read
+            return super(CopyJsonCursor, self).execute("SELECT %s", (getattr(self, '_copy_bytes', None),))
+        self._copy_rowcount = None
+        if isinstance(query, str):
+            match = COPY_JSON.match(query)
+            if match:
+                return self.copy_json(*match.groups())
+            for pattern, replacement in SQL_REWRITES:
+                query = pattern.sub(replacement, query)
+        return super(CopyJsonCursor, self).execute(query, vars)
+
+    @property
+    def rowcount(self):
+        if getattr(self, '_copy_rowcount', None) is not None:
+            return self._copy_rowcount
+        return super(CopyJsonCursor, self).rowcount
+
+    def source_files(self, source, manifest):
+        from operators.source_arrival import list_source_files
+        if manifest:
+            with open(local_path(source, self.bucket_root)) as f:
+                return [local_path(entry['url'], self.bucket_root) for entry in json.load(f)['entries']]
+        path = local_path(source, self.bucket_root)
+        return list_source_files(self.bucket_root, os.path.relpath(path, self.bucket_root))
+
+    def copy_json(self, table, source, json_path, manifest):
+        schema, _, name = table.rpartition('.')
+        super(CopyJsonCursor, self).execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s "
+            "ORDER BY ordinal_position", (schema or 'public', name.strip('"')))
+        columns = [row[0] for row in self.fetchall()]
+
+        if json_path == 'auto':
+            # auto matches the object keys to the column names, ignoring case
+            keys = columns
+        else:
+            with open(local_path(json_path, self.bucket_root)) as f:
+                keys = [re.sub(r"^\$\[?'?\.?|'?\]?$", "", path) for path in json.load(f)['jsonpaths']]
+
+        rows = []
+        self._copy_bytes = 0
+        for path in self.source_files(source, manifest):
+            self._copy_bytes += os.path.getsize(path)
+            for obj in read_json_objects(path):
+                lowered = {key.lower(): value for key, value in obj.items()}
+                rows.append(tuple(lowered.get(key.lower()) for key in keys))
+
+        if rows:
+            execute_values(self, "INSERT INTO {} ({}) VALUES %s".format(
+                table, ", ".join('"{}"'.format(column) for column in columns[:len(keys)])), rows, page_size=1000)
+        self._copy_rowcount = len(rows)
+
+
+def user_level(user, ts, day_start):
+    """
+    Level of a user at ts. Every tenth user upgrades at noon, free in the morning and paid after, so the users upsert
+    sees a user with both levels in a day and has to keep the latest one.
+    """
+    if user % 10 == 0:
+        return 'paid' if ts >= day_start + 12 * 3600 * 1000 else 'free'
+    return 'paid' if user % 3 else 'free'
+
+
+def generate_data(root, start, days, events_per_day, songs, seed=42):
+    """
+    Writes synthetic song_data, log_data and the log jsonpaths file under root
+    """
+    rng = random.Random(seed)
+    artists = max(songs // 3, 1)
+    catalog = [{
+        'num_songs': 1,
+        'artist_id': 'AR{:06d}'.format(i % artists),
+        'artist_name': 'Artist {}'.format(i % artists),
+        'artist_latitude': None,
+        'artist_longitude': None,
+        'artist_location': 'City {}'.format(i % artists % 50),
+        'song_id': 'SO{:08d}'.format(i),
+        'title': 'Song {}'.format(i),
+        'duration': float(120 + i % 240),
+        'year': 1970 + i % 50,
+    } for i in range(songs)]
+
+    for i in range(0, songs, 1000):
+        path = os.path.join(root, 'song_data', 'A', 'songs-{:05d}.json'.format(i // 1000))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write("\n".join(json.dumps(song) for song in catalog[i:i + 1000]))
+
+    for day in range(days):
+        date = start + timedelta(days=day)
+        day_start = int((date - datetime(1970, 1, 1)).total_seconds() * 1000)
+        events = []
+        for i in range(events_per_day):
+            # sessions of up to 20 consecutive plays, a few minutes apart like the real logs
+            item = i % 20
+            if item == 0:
+                user = rng.randint(1, 100)
+                session_id = (day + 1) * 100000 + i // 20
+                session_start = day_start + rng.randrange(20 * 3600 * 1000)
+            # about 3 in 4 plays match a song of the catalog
+            song = rng.choice(catalog) if rng.random() < 0.75 else {'artist_name': 'Unknown', 'title': 'Unknown',
+                                                                     'duration': 1.0}
+            ts = session_start + item * 200000 + rng.randrange(1000)
+            events.append({
+                'artist': song['artist_name'], 'auth': 'Logged In', 'firstName': 'First{}'.format(user),
+                'gender': 'F' if user % 2 else 'M', 'itemInSession': item, 'lastName': 'Last{}'.format(user),
+                'length': song['duration'], 'level': user_level(user, ts, day_start), 'location': 'City',
+                'method': 'PUT', 'page': 'NextSong' if rng.random() < 0.9 else 'Home',
+                'registration': 1540000000000.0, 'sessionId': session_id, 'song': song['title'],
+                'status': 200, 'ts': ts,
+                'userAgent': 'Mozilla/5.0', 'userId': str(user),
+            })
+        path = os.path.join(root, 'log_data', date.strftime('%Y/%m'), date.strftime('%Y-%m-%d') + '-events.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write("\n".join(json.dumps(event) for event in events))
+
+    with open(os.path.join(root, 'log_json_path.json'), 'w') as f:
+        json.dump({'jsonpaths': ["$['{}']".format(key) for key in LOG_JSON_PATHS]}, f, indent=2)
+
+
+def start_postgres(workdir):
+    """
+    Starts a throwaway Postgres with pgserver and returns its uri
+    """
+    try:
+        import pgserver
+    except ImportError:
+        raise SystemExit("pass --postgres-uri or pip install pgserver for a throwaway server")
+    return pgserver.get_server(os.path.join(workdir, 'pgdata'), cleanup_mode='stop').get_uri()
+
+
+def reset_database(uri):
+    conn = psycopg2.connect(uri)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public")
+        with open(os.path.join(HERE, 'create_tables.sql')) as f:
+            cur.execute(f.read())
+        cur.execute(POSTGRES_COMPAT_SQL)
+    conn.close()
+
+
+def install_copy_emulation(root):
+    """
+    Makes every PostgresHook connection use CopyJsonCursor
+    """
+    from airflow.hooks.postgres_hook import PostgresHook
+    from helpers.load_metrics import copy_bytes_sql
+    CopyJsonCursor.bucket_root = root
+    CopyJsonCursor.copy_bytes_sql = copy_bytes_sql
+    get_conn = PostgresHook.get_conn
+
+    def get_local_conn(self):
+        conn = get_conn(self)
+        conn.cursor_factory = CopyJsonCursor
+        return conn
+
+    PostgresHook.get_conn = get_local_conn
+
+
+# (dag_id, day, task_id): [started, finished] of the task runs, dag.test() leaves the task instance dates empty
+TASK_TIMES = {}
+
+
+def task_started(context):
+    # a deferred task starts again after its trigger fired, the first start counts
+    TASK_TIMES.setdefault((context['ti'].dag_id, context['ds'], context['ti'].task_id), [time.monotonic(), None])
+
+
+def task_finished(context):
+    TASK_TIMES[(context['ti'].dag_id, context['ds'], context['ti'].task_id)][1] = time.monotonic()
+
+
+def build_local_dag(dag_id, root, start, fused):
+    """
+    The DAG of udac_example_dag.py reading the stand-in bucket, scheduled daily like the staged log files
+    """
+    from helpers.dag_factory import build_dag
+    from helpers.load_metrics import TableSink
+    import udac_example_dag
+
+    tables = []
+    for spec in udac_example_dag.sparkify_tables:
+        spec = dict(spec)
+        if spec.get('json_path', '').startswith(BUCKET):
+            spec['json_path'] = local_path(spec['json_path'], root)
+        if spec.get('wait_for'):
+            spec['wait_for'] = dict(spec['wait_for'],
+                                    manifest_path=os.path.join(root, spec['table'] + '-{{ ts_nodash }}.manifest'),
+                                    poke_interval=5, timeout=60)
+        tables.append(spec)
+
+    return build_dag(dag_id, tables,
+                     redshift_conn_id='redshift',
+                     aws_credentials_id='aws_credentials',
+                     s3_path=root,
+                     fused=fused,
+                     metrics_sink=TableSink('redshift'),
+                     default_args={'on_execute_callback': task_started,
+                                   'on_success_callback': task_finished,
+                                   'on_failure_callback': task_finished},
+                     start_date=start,
+                     schedule_interval='@daily',
+                     catchup=False)
+
+
+def run(dag, start, days):
+    """
+    Runs the DAG once per day with dag.test() and returns the (day, task, seconds, state) of every task
+    """
+    import pendulum
+    try:
+        # dag.test() deletes the previous run of a day, the dag run notes reference the FAB user table
+        import airflow.providers.fab.auth_manager.models  # noqa: F401
+    except ImportError:
+        pass
+    timings = []
+    for day in range(days):
+        execution_date = pendulum.instance(start + timedelta(days=day), tz='UTC')
+        started = time.monotonic()
+        dag_run = dag.test(execution_date=execution_date)
+        total = time.monotonic() - started
+
+        ds = execution_date.strftime('%Y-%m-%d')
+        states = {ti.task_id: ti.state for ti in dag_run.get_task_instances()}
+        for (dag_id, day, task_id), (task_start, task_end) in sorted(TASK_TIMES.items(), key=lambda item: item[1][0]):
+            if dag_id == dag.dag_id and day == ds:
+                timings.append((ds, task_id, (task_end or task_start) - task_start, states.get(task_id)))
+        timings.append((ds, 'dag run', total, dag_run.state))
+    return timings
+
+
+def report(title, timings):
+    print("\n{}".format(title))
+    print("{:<12} {:<32} {:>10} {}".format('day', 'task', 'seconds', 'state'))
+    for day, task, seconds, state in timings:
+        print("{:<12} {:<32} {:>10.3f} {}".format(day, task, seconds, state))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--start', default='2018-11-01', help='first day of synthetic log_data')
+    parser.add_argument('--events-per-day', type=int, default=1000)
+    parser.add_argument('--songs', type=int, default=500)
+    parser.add_argument('--variant', choices=['split', 'fused', 'both'], default='both')
+    parser.add_argument('--postgres-uri', help='Postgres standing in for Redshift, its public schema is reset')
+    parser.add_argument('--workdir', help='directory of the stand-in bucket (default: a temporary directory)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sparkify-harness-')
+    root = os.path.join(workdir, 'udacity-dend')
+    start = datetime.strptime(args.start, '%Y-%m-%d')
+    generate_data(root, start, args.days, args.events_per_day, args.songs)
+
+    uri = args.postgres_uri or start_postgres(workdir)
+    os.environ['AIRFLOW_CONN_REDSHIFT'] = uri
+    os.environ.setdefault('AIRFLOW_CONN_AWS_CREDENTIALS', 'aws://harness:harness@')
+    install_copy_emulation(root)
+
+    variants = ['split', 'fused'] if args.variant == 'both' else [args.variant]
+    for variant in variants:
+        reset_database(uri)
+        dag = build_local_dag('udac_example_dag_local_{}'.format(variant), root, start, variant == 'fused')
+        report("{} operators, {} day(s) of {} events, {} songs".format(
+            variant, args.days, args.events_per_day, args.songs), run(dag, start, args.days))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,16 @@ import helpers
 # Defining the plugin class
 class UdacityPlugin(AirflowPlugin):
     name = "udacity_plugin"
+    # listed before `operators`, which shadows the package name in the class body
+    sensors = [
+        operators.SourceArrivalSensor
+    ]
     operators = [
         operators.StageToRedshiftOperator,
         operators.LoadFactOperator,
         operators.LoadDimensionOperator,
-        operators.DataQualityOperator
+        operators.DataQualityOperator,
+        operators.FusedLoadOperator
     ]
     helpers = [
         helpers.SqlQueries
@@ -0,0 +1,169 @@
+from airflow import DAG
+from airflow.operators.dummy_operator import DummyOperator
+
+from operators import (StageToRedshiftOperator, LoadFactOperator,
+                       LoadDimensionOperator, DataQualityOperator, FusedLoadOperator,
+                       SourceArrivalSensor)
+
+# Airflow pools of the tasks hitting Redshift, create them once:
+#   airflow pool -s redshift_copy 4 "Redshift COPY slots"
+#   airflow pool -s redshift_load 3 "Redshift INSERT slots"
+#   airflow pool -s redshift_publish 1 "Fused load, one run at a time"
+# The fused load of overlapping runs would insert the same new start_times into time and upsert the same keys
+# concurrently, its pool has a single slot so the runs publish one after the other.
+POOLS = {
+    'stage': 'redshift_copy',
+    'fact': 'redshift_load',
+    'dimension': 'redshift_load',
+    'quality': 'redshift_load',
+    'fused': 'redshift_publish',
+}
+
+# absolute priority weights: staging first, then the fact, then the dimensions
+PRIORITY_WEIGHTS = {
+    'stage': 30,
+    'fact': 20,
+    'dimension': 10,
+    'quality': 5,
+}
+
+# default task ids by kind, a table spec can set its own task_id
+TASK_IDS = {
+    'stage': 'Stage_{table}',
+    'fact': 'Load_{table}_fact_table',
+    'dimension': 'Load_{table}_dim_table',
+}
+
+# task id of the arrival sensor of a stage table with wait_for
+WAIT_TASK_ID = 'Wait_for_{table}'
+
+
+def _task_args(spec, kind, pools, priority_weights):
+    return {
+        'task_id': spec.get('task_id') or TASK_IDS[kind].format(table=spec['table']),
+        'pool': spec.get('pool', pools[kind]),
+        'priority_weight': spec.get('priority_weight', priority_weights[kind]),
+        'weight_rule': 'absolute',
+    }
+
+
+def build_dag(dag_id, tables, redshift_conn_id, aws_credentials_id, s3_path,
+              pools=POOLS, priority_weights=PRIORITY_WEIGHTS, fused=False, metrics_sink=None, **dag_kwargs):
+    """
+    Builds the Sparkify DAG from a list of table specs, one dict per table:
+        table          : target table
+        kind           : "stage", "fact" or "dimension"
+        depends_on     : tables loaded before this one (default: none, runs right after Begin_execution)
+        task_id, pool, priority_weight : overrides of the defaults of the kind
+      stage tables:
+        s3_key, json_path, partition_column, partition_granularity : see StageToRedshiftOperator
+        wait_for       : SourceArrivalSensor arguments (manifest_path, min_files, poke_interval, timeout),
+                         staging waits for the files under s3_key and copies exactly those
+      fact and dimension tables:
+        sql, load_strategy, primary_key : see LoadFactOperator / LoadDimensionOperator
+        checks         : DataQualityOperator rules of the table
+    The quality checks of all tables run in one task after the last loads.
+    With fused=True the loads and the checks run in a single FusedLoadOperator task, in one transaction,
+    after the staging tasks.
+    metrics_sink receives the statement metrics of every Redshift task, see helpers/load_metrics.py.
+    """
+    dag = DAG(dag_id, **dag_kwargs)
+    tasks = {}
+    sensors = {}
+
+    for spec in tables:
+        kind = spec['kind']
+        if kind not in TASK_IDS:
+            raise ValueError("Unknown kind {} of table {}".format(kind, spec['table']))
+        if spec['table'] in tasks:
+            raise ValueError("Table {} is declared twice".format(spec['table']))
+        task_args = _task_args(spec, kind, pools, priority_weights)
+
+        if kind == 'stage':
+            wait_for = dict(spec.get('wait_for') or {})
+            manifest_path = wait_for.pop('manifest_path', '')
+            if spec.get('wait_for'):
+                sensors[spec['table']] = SourceArrivalSensor(
+                    task_id=WAIT_TASK_ID.format(table=spec['table']),
+                    dag=dag,
+                    source_path=spec.get('s3_path', s3_path),
+                    prefix=spec['s3_key'],
+                    aws_credentials_id=aws_credentials_id,
+                    **wait_for)
+            tasks[spec['table']] = StageToRedshiftOperator(
+                dag=dag,
+                redshift_conn_id=redshift_conn_id,
+                aws_credentials_id=aws_credentials_id,
+                table=spec['table'],
+                s3_path=spec.get('s3_path', s3_path),
+                s3_key=spec['s3_key'],
+                json_path=spec.get('json_path', 'auto'),
+                partition_column=spec.get('partition_column', ''),
+                partition_granularity=spec.get('partition_granularity'),
+                manifest_task_id=sensors[spec['table']].task_id if spec['table'] in sensors else None,
+                manifest_path=manifest_path,
+                metrics_sink=metrics_sink,
+                **task_args)
+        elif fused:
+            # the load runs inside the fused task, the placeholder only resolves depends_on
+            tasks[spec['table']] = None
+        else:
+            operator = LoadFactOperator if kind == 'fact' else LoadDimensionOperator
+            tasks[spec['table']] = operator(
+                dag=dag,
+                redshift_conn_id=redshift_conn_id,
+                table=spec['table'],
+                sql=spec['sql'],
+                load_strategy=spec.get('load_strategy', 'delete-load'),
+                primary_key=spec.get('primary_key', ()),
+                metrics_sink=metrics_sink,
+                **task_args)
+
+    start_operator = DummyOperator(task_id='Begin_execution', dag=dag)
+    end_operator = DummyOperator(task_id='Stop_execution', dag=dag)
+
+    if fused:
+        run_quality_checks = FusedLoadOperator(
+            task_id='Load_and_check_tables',
+            dag=dag,
+            redshift_conn_id=redshift_conn_id,
+            tables=[spec for spec in tables if spec['kind'] != 'stage'],
+            metrics_sink=metrics_sink,
+            pool=pools['fused'],
+            priority_weight=priority_weights['fact'],
+            weight_rule='absolute')
+    else:
+        run_quality_checks = DataQualityOperator(
+            task_id='Run_data_quality_checks',
+            dag=dag,
+            redshift_conn_id=redshift_conn_id,
+            checks={spec['table']: spec['checks'] for spec in tables if spec.get('checks')},
+            metrics_sink=metrics_sink,
+            pool=pools['quality'],
+            priority_weight=priority_weights['quality'],
+            weight_rule='absolute')
+
+    upstream_tables = set()
+    for spec in tables:
+        task = tasks[spec['table']] or run_quality_checks
+        if spec['table'] in sensors:
+            # upstream tasks feed the sensor, staging starts once the files landed
+            sensors[spec['table']] >> task
+            task = sensors[spec['table']]
+        depends_on = spec.get('depends_on', [])
+        for table in depends_on:
+            if table not in tasks:
+                raise ValueError("Table {} depends on undeclared table {}".format(spec['table'], table))
+            upstream = tasks[table] or run_quality_checks
+            if upstream is not task:
+                upstream >> task
+            upstream_tables.add(table)
+        if not depends_on:
+            start_operator >> task
+
+    for table, task in tasks.items():
+        if task and table not in upstream_tables:
+            task >> run_quality_checks
+    run_quality_checks >> end_operator
+
+    return dag
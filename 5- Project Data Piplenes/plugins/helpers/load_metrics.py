@@ -0,0 +1,131 @@
+import socket
+import time
+
+from airflow.hooks.postgres_hook import PostgresHook
+
+# Redshift leaves the cursor rowcount of a COPY at -1, the loaded rows come from the session instead
+copy_count_sql = "SELECT pg_last_copy_count()"
+
+# bytes a COPY read from S3, summed over the slices of its query
+copy_bytes_sql = "SELECT SUM(transfer_size) FROM stl_s3client WHERE query = pg_last_copy_id()"
+
+
+class LoadMetricsMixin(object):
+    """
+    Times every SQL statement of a Sparkify operator and records the rows it affected.
+
+    Each record holds the table, the statement's first keyword as step (delete, copy, insert, ...),
+    the duration in seconds, the rowcount and for a COPY the bytes it loaded from S3. emit_metrics pushes the records of the task to XCom
+    under the key "load_metrics" and hands them to the operator's metrics_sink.
+    """
+
+    def init_metrics(self, metrics_sink=None):
+        self.metrics_sink = metrics_sink
+        self.metrics = []
+
+    def record_metric(self, table, step, seconds, rows=None, bytes=None):
+        self.metrics.append({'table': table, 'step': step, 'seconds': round(seconds, 3), 'rows': rows,
+                             'bytes': bytes})
+        self.log.info("{} {} took {:.3f}s, {} rows, {} bytes".format(step, table, seconds, rows, bytes))
+
+    def execute_measured(self, cursor, statement, table):
+        """
+        Runs one statement on the cursor and records its metric
+        """
+        step = statement.split(None, 1)[0].lower()
+        started = time.monotonic()
+        cursor.execute(statement)
+        rows = cursor.rowcount
+        loaded = None
+        if step == 'copy':
+            if rows < 0:
+                cursor.execute(copy_count_sql)
+                rows = cursor.fetchone()[0]
+            cursor.execute(copy_bytes_sql)
+            loaded = cursor.fetchone()[0]
+        self.record_metric(table, step, time.monotonic() - started, rows if rows >= 0 else None,
+                           int(loaded) if loaded is not None else None)
+
+    def run_measured(self, redshift, statements, table):
+        """
+        Runs the statements in one transaction like PostgresHook.run, recording each one
+        """
+        if isinstance(statements, str):
+            statements = [statements]
+        conn = redshift.get_conn()
+        try:
+            with conn.cursor() as cursor:
+                for statement in statements:
+                    self.log.info("Running sql: \n{}".format(statement))
+                    self.execute_measured(cursor, statement, table)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def emit_metrics(self, context):
+        records = [dict(record,
+                        dag_id=self.dag_id,
+                        task_id=self.task_id,
+                        execution_date=context['execution_date'].isoformat())
+                   for record in self.metrics]
+        context['ti'].xcom_push(key='load_metrics', value=records)
+        self.metrics = []
+        if self.metrics_sink is not None and records:
+            try:
+                self.metrics_sink.emit(records)
+            except Exception as e:
+                # a broken sink must not fail the load
+                self.log.warning("Emitting load metrics failed: {}".format(e))
+
+
+class StatsdSink(object):
+    """
+    Sends the records as StatsD lines over UDP:
+        <prefix>.<dag_id>.<table>.<step>.duration:<ms>|ms
+        <prefix>.<dag_id>.<table>.<step>.rows:<rows>|g
+        <prefix>.<dag_id>.<table>.<step>.bytes:<bytes>|g
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='sparkify'):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+
+    def lines(self, records):
+        lines = []
+        for record in records:
+            name = ".".join([self.prefix, record['dag_id'], record['table'], record['step']])
+            lines.append("{}.duration:{}|ms".format(name, int(record['seconds'] * 1000)))
+            if record['rows'] is not None:
+                lines.append("{}.rows:{}|g".format(name, record['rows']))
+            if record.get('bytes') is not None:
+                lines.append("{}.bytes:{}|g".format(name, record['bytes']))
+        return lines
+
+    def emit(self, records):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in self.lines(records):
+                sock.sendto(line.encode('utf-8'), (self.host, self.port))
+        finally:
+            sock.close()
+
+
+class TableSink(object):
+    """
+    Inserts the records into a metrics table, public.load_metrics of create_tables.sql by default
+    """
+
+    fields = ['dag_id', 'task_id', 'execution_date', 'table_name', 'step', 'seconds', 'row_count', 'byte_count']
+
+    def __init__(self, postgres_conn_id, table='public.load_metrics'):
+        self.postgres_conn_id = postgres_conn_id
+        self.table = table
+
+    def emit(self, records):
+        rows = [(r['dag_id'], r['task_id'], r['execution_date'], r['table'], r['step'], r['seconds'], r['rows'],
+                 r.get('bytes')) for r in records]
+        PostgresHook(postgres_conn_id=self.postgres_conn_id).insert_rows(self.table, rows, target_fields=self.fields)
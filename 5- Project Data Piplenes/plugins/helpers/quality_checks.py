@@ -0,0 +1,103 @@
+"""
+Rules of the data quality checks, shared by DataQualityOperator and FusedLoadOperator.
+
+A table's rules, all optional:
+    min_rows / max_rows : bounds of the row count
+    null_ratio          : {column: highest allowed ratio of NULLs}
+    unique              : [columns whose non NULL values must be unique]
+    references          : {column: (table, column)} every non NULL value must exist in the referenced table
+    freshness           : (timestamp column, timedelta) the newest value must not be older than
+                          the execution date minus the timedelta
+"""
+
+check_sql = """
+        SELECT {}
+        FROM {} t
+        {}"""
+
+reference_join_sql = "LEFT JOIN (SELECT DISTINCT {} AS ref_key FROM {}) {} ON t.{} = {}.ref_key"
+
+
+def compile_checks(table, rules):
+    """
+    Returns the aggregate query of a table's rules and the aliases of its result columns
+    """
+    columns = ["COUNT(*)"]
+    aliases = ["row_count"]
+    joins = []
+
+    for column in rules.get('null_ratio', {}):
+        columns.append("SUM(CASE WHEN t.{0} IS NULL THEN 1 ELSE 0 END)".format(column))
+        aliases.append("nulls:{}".format(column))
+
+    for column in rules.get('unique', []):
+        columns.append("COUNT(t.{0}) - COUNT(DISTINCT t.{0})".format(column))
+        aliases.append("duplicates:{}".format(column))
+
+    for i, (column, (ref_table, ref_column)) in enumerate(sorted(rules.get('references', {}).items())):
+        ref = "ref{}".format(i)
+        joins.append(reference_join_sql.format(ref_column, ref_table, ref, column, ref))
+        columns.append("SUM(CASE WHEN t.{} IS NOT NULL AND {}.ref_key IS NULL THEN 1 ELSE 0 END)".format(column, ref))
+        aliases.append("orphans:{}".format(column))
+
+    if 'freshness' in rules:
+        column = rules['freshness'][0]
+        columns.append("MAX(t.{})".format(column))
+        aliases.append("latest:{}".format(column))
+
+    sql = check_sql.format(",\n               ".join(columns), table, "\n        ".join(joins))
+    return sql, aliases
+
+
+def evaluate(rules, values, execution_date):
+    """
+    Returns the result of every rule of a table from its aggregate query values
+    """
+    row_count = values['row_count']
+    results = []
+
+    def result(check, column, value, threshold, passed):
+        results.append({'check': check, 'column': column, 'value': value,
+                        'threshold': threshold, 'passed': bool(passed)})
+
+    if 'min_rows' in rules:
+        result('min_rows', None, row_count, rules['min_rows'], row_count >= rules['min_rows'])
+    if 'max_rows' in rules:
+        result('max_rows', None, row_count, rules['max_rows'], row_count <= rules['max_rows'])
+
+    for column, threshold in rules.get('null_ratio', {}).items():
+        ratio = float(values['nulls:' + column] or 0) / row_count if row_count else 0.0
+        result('null_ratio', column, ratio, threshold, ratio <= threshold)
+
+    for column in rules.get('unique', []):
+        duplicates = int(values['duplicates:' + column] or 0)
+        result('unique', column, duplicates, 0, duplicates == 0)
+
+    for column, reference in rules.get('references', {}).items():
+        orphans = int(values['orphans:' + column] or 0)
+        result('references', column, orphans, "{}.{}".format(*reference), orphans == 0)
+
+    if 'freshness' in rules:
+        column, max_age = rules['freshness']
+        latest = values['latest:' + column]
+        oldest_allowed = (execution_date - max_age).replace(tzinfo=None)
+        passed = latest is not None and latest.replace(tzinfo=None) >= oldest_allowed
+        result('freshness', column, str(latest), str(oldest_allowed), passed)
+
+    return results
+
+
+def log_report(log, report):
+    """
+    Logs the results of a {table: results} report and returns the names of the failed checks
+    """
+    failures = []
+    for table, results in report.items():
+        for result in results:
+            check = " ".join(part for part in (table, result['check'], result['column']) if part)
+            if result['passed']:
+                log.info("Data quality check {} passed: {}".format(check, result['value']))
+            else:
+                log.error("Data quality check {} failed: {} (threshold {})".format(check, result['value'], result['threshold']))
+                failures.append(check)
+    return failures
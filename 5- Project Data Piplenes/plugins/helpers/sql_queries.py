@@ -1,4 +1,5 @@
 class SqlQueries:
+    # the songplays of the run's day (ds, rendered by Airflow), the day StageToRedshiftOperator staged
     songplay_table_insert = ("""
         SELECT
                 md5(events.sessionid || events.start_time) songplay_id,
@@ -12,34 +13,112 @@ class SqlQueries:
                 events.useragent
                 FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time, *
             FROM staging_events
-            WHERE page='NextSong') events
+            WHERE page='NextSong'
+                AND ts >= extract(epoch from TIMESTAMP '{{ ds }}') * 1000
+                AND ts < extract(epoch from TIMESTAMP '{{ macros.ds_add(ds, 1) }}') * 1000) events
             LEFT JOIN staging_songs songs
             ON events.song = songs.title
                 AND events.artist = songs.artist_name
                 AND events.length = songs.duration
     """)
 
+    # the dimension selects return one row per key, the upsert replaces a key with the single row staged for it:
+    # a user's latest level (a free user who upgrades during the day has events of both levels), one row of
+    # an artist listed on several songs.
+    # staging_events keeps the days staged before, the users are read from the run's day only like the songplays,
+    # users without plays that day keep their row
     user_table_insert = ("""
-        SELECT distinct userid, firstname, lastname, gender, level
-        FROM staging_events
-        WHERE page='NextSong'
+        SELECT userid, firstname, lastname, gender, level
+        FROM (SELECT userid, firstname, lastname, gender, level,
+                     ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS key_rank
+              FROM staging_events
+              WHERE page='NextSong' AND userid IS NOT NULL
+                  AND ts >= extract(epoch from TIMESTAMP '{{ ds }}') * 1000
+                  AND ts < extract(epoch from TIMESTAMP '{{ macros.ds_add(ds, 1) }}') * 1000) events
+        WHERE key_rank = 1
     """)
 
     song_table_insert = ("""
-        SELECT distinct song_id, title, artist_id, year, duration
-        FROM staging_songs
+        SELECT song_id, title, artist_id, year, duration
+        FROM (SELECT song_id, title, artist_id, year, duration,
+                     ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY title, year DESC) AS key_rank
+              FROM staging_songs
+              WHERE song_id IS NOT NULL) songs
+        WHERE key_rank = 1
     """)
 
     artist_table_insert = ("""
-        SELECT distinct artist_id, artist_name, artist_location, artist_latitude, artist_longitude
-        FROM staging_songs
+        SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+        FROM (SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
+                     ROW_NUMBER() OVER (PARTITION BY artist_id
+                                        ORDER BY artist_location, artist_latitude, artist_name) AS key_rank
+              FROM staging_songs
+              WHERE artist_id IS NOT NULL) artists
+        WHERE key_rank = 1
     """)
 
+    # incremental: only the distinct start_times of the run's day of songplays that are not in time yet,
+    # load it with the append strategy, the cost follows the day instead of the whole songplays history.
+    # Rendered by Airflow, ds is the execution date of the run.
     time_table_insert = ("""
-        SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time), 
-               extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
-        FROM songplays
+        SELECT DISTINCT sp.start_time, extract(hour from sp.start_time), extract(day from sp.start_time), extract(week from sp.start_time), 
+               extract(month from sp.start_time), extract(year from sp.start_time), extract(dayofweek from sp.start_time)
+        FROM songplays sp
+        LEFT JOIN "time" t
+        ON t.start_time = sp.start_time
+        WHERE sp.start_time >= '{{ ds }}' AND sp.start_time < '{{ macros.ds_add(ds, 1) }}'
+            AND t.start_time IS NULL
     """)
+
+    # upsert: load the select into a temp table, replace the rows with matching keys, in one transaction.
+    # The select must return one row per key, or the keys it repeats are inserted twice
+    upsert_staging_create = ("""
+        CREATE TEMP TABLE {staging} (LIKE {table})
+    """)
+
+    upsert_staging_insert = ("""
+        INSERT INTO {staging}
+        {sql}
+    """)
+
+    upsert_delete = ("""
+        DELETE FROM {table}
+        USING {staging}
+        WHERE {key_match}
+    """)
+
+    upsert_insert = ("""
+        INSERT INTO {table}
+        SELECT * FROM {staging}
+    """)
+
+    upsert_staging_drop = ("""
+        DROP TABLE {staging}
+    """)
+
+    @classmethod
+    def upsert_statements(cls, table, sql, primary_key):
+        staging = "stage_{}".format(table)
+        key_match = " AND ".join("{0}.{2} = {1}.{2}".format(table, staging, column) for column in primary_key)
+        return [
+            cls.upsert_staging_create.format(staging=staging, table=table),
+            cls.upsert_staging_insert.format(staging=staging, sql=sql),
+            cls.upsert_delete.format(table=table, staging=staging, key_match=key_match),
+            cls.upsert_insert.format(table=table, staging=staging),
+            cls.upsert_staging_drop.format(staging=staging),
+        ]
+
+    @classmethod
+    def load_statements(cls, table, sql, load_strategy, primary_key=()):
+        """
+        Statements of a fact or dimension load, see LoadFactOperator.load_strategies
+        """
+        if load_strategy == 'upsert':
+            return cls.upsert_statements(table, sql, primary_key)
+        statements = ["INSERT INTO {} \n{}".format(table, sql)]
+        if load_strategy == 'delete-load':
+            statements.insert(0, "DELETE FROM {}".format(table))
+        return statements
     
     
     create_tables_sql= ("""
@@ -119,4 +198,14 @@ class SqlQueries:
             gender varchar(256),
             "level" varchar(256),
             CONSTRAINT users_pkey PRIMARY KEY (userid));
+
+        CREATE TABLE public.load_metrics (
+            dag_id varchar(256),
+            task_id varchar(256),
+            execution_date timestamp,
+            table_name varchar(256),
+            step varchar(32),
+            seconds numeric(18,3),
+            row_count int8,
+            byte_count int8);
     """)
\ No newline at end of file
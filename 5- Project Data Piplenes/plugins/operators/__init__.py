@@ -2,10 +2,14 @@ from operators.stage_redshift import StageToRedshiftOperator
 from operators.load_fact import LoadFactOperator
 from operators.load_dimension import LoadDimensionOperator
 from operators.data_quality import DataQualityOperator
+from operators.fused_load import FusedLoadOperator
+from operators.source_arrival import SourceArrivalSensor
 
 __all__ = [
     'StageToRedshiftOperator',
     'LoadFactOperator',
     'LoadDimensionOperator',
-    'DataQualityOperator'
+    'DataQualityOperator',
+    'FusedLoadOperator',
+    'SourceArrivalSensor'
 ]
@@ -1,35 +1,65 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers import quality_checks
+from helpers.load_metrics import LoadMetricsMixin
+
+class DataQualityOperator(LoadMetricsMixin, BaseOperator):
+    """
+    Runs the data quality checks of every table as one aggregate query per table, tables in parallel.
 
-class DataQualityOperator(BaseOperator):
+    checks maps a table to its rules, see helpers/quality_checks.py.
+    Tables passed in `tables` only get the min_rows=1 check.
+    """
 
     ui_color = '#89DA59'
 
     @apply_defaults
     def __init__(self,
-                 conn_id = "",#connection-name
+                 redshift_conn_id = "",#connection-name
                  tables = [],
+                 checks = None,
+                 max_workers = 4,
+                 metrics_sink = None,
                  *args, **kwargs):
 
         super(DataQualityOperator, self).__init__(*args, **kwargs)
-        self.conn_id = conn_id
-        self.tables = tables
+        self.redshift_conn_id = redshift_conn_id
+        self.checks = {table: {'min_rows': 1} for table in tables}
+        self.checks.update(checks or {})
+        self.max_workers = max_workers
+        self.init_metrics(metrics_sink)
+
+    def check_table(self, redshift, table, rules, execution_date):
+        sql, aliases = quality_checks.compile_checks(table, rules)
+        self.log.info("Running data quality checks of {}: \n{}".format(table, sql))
+        started = time.monotonic()
+        record = redshift.get_first(sql)
+        if not record:
+            raise ValueError("Data quality check failed. {} returned no results".format(table))
+        self.record_metric(table, 'check', time.monotonic() - started, record[0])
+        return quality_checks.evaluate(rules, dict(zip(aliases, record)), execution_date)
 
     def execute(self, context):
-        self.log.info('DataQuality for {} is started'.format(table))
-        redshift = PostgresHook(postgres_conn_id=self.conn_id)  
-        
-        for table in self.tables:
-            records = redshift.get_records("SELECT COUNT(*) FROM {}".format(table))  
-            
-            if len(records) < 1 or len(records[0]) < 1:
-                self.log.error("{} returned no results".format(table))
-                raise ValueError("Data quality check failed. {} returned no results".format(table))
-                
-            num_records = records[0][0]
-            if num_records == 0:
-                self.log.error("No records present in destination table: {}".format(table))
-                raise ValueError("No records present in destination {}".format(table))
-                
-            self.log.info("Data quality on table {} check passed with {} records".format(table, num_records))
+        self.log.info('DataQuality for {} is started'.format(', '.join(self.checks)))
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+        execution_date = context['execution_date']
+
+        # the durations of the checks that ran are emitted even when a check query fails
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {table: executor.submit(self.check_table, redshift, table, rules, execution_date)
+                           for table, rules in self.checks.items()}
+                report = {table: future.result() for table, future in futures.items()}
+        finally:
+            self.emit_metrics(context)
+        failures = quality_checks.log_report(self.log, report)
+
+        if failures:
+            raise ValueError("Data quality checks failed: {}".format("; ".join(failures)))
+
+        # the report is pushed to XCom as the return value
+        return report
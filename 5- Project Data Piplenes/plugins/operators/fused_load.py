@@ -0,0 +1,129 @@
+import time
+
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from helpers import SqlQueries, quality_checks
+from helpers.load_metrics import LoadMetricsMixin
+
+class FusedLoadOperator(LoadMetricsMixin, BaseOperator):
+    """
+    Runs the fact load, the dimension loads and the data quality checks over one connection, in one transaction.
+
+    At a daily cadence every load task pays scheduling, worker startup and a new connection for a single
+    INSERT, this operator replaces them with one task. A load or a check failing rolls back every load,
+    so a run either publishes all its tables or none.
+
+    tables is a list of table specs as taken by helpers/dag_factory.build_dag:
+        table, sql, load_strategy, primary_key : the load of the table, see LoadFactOperator
+        depends_on                             : tables loaded before this one, tables outside the list are ignored
+        checks                                 : data quality rules of the table, see helpers/quality_checks.py
+    The time of each step is pushed to XCom under the key "step_timings", the metrics of each statement under
+    "load_metrics" and the quality report is the return value.
+    """
+
+    ui_color = '#F9B486'
+
+    # the sql of the table specs is rendered with the run context
+    template_fields = ("tables",)
+
+    load_strategies = ('delete-load', 'append', 'upsert')
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id = "",
+                 tables = (),
+                 metrics_sink = None,
+                 *args, **kwargs):
+
+        super(FusedLoadOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.tables = list(tables)
+        self.init_metrics(metrics_sink)
+
+        for spec in self.tables:
+            if spec.get('load_strategy', 'delete-load') not in self.load_strategies:
+                raise ValueError("load_strategy must be one of {}".format(self.load_strategies))
+            if spec.get('load_strategy') == 'upsert' and not spec.get('primary_key'):
+                raise ValueError("primary_key is required for the upsert load strategy of {}".format(spec['table']))
+        # fails early on circular depends_on, execute sorts the rendered specs again
+        self.sort_tables(self.tables)
+
+    @staticmethod
+    def sort_tables(tables):
+        """
+        Returns the table specs in dependency order, keeping the declared order between independent tables
+        """
+        specs = {spec['table']: spec for spec in tables}
+        ordered, visiting = [], set()
+
+        def visit(table):
+            if table in visiting:
+                raise ValueError("Tables {} depend on each other".format(sorted(visiting)))
+            if table not in specs or specs[table] in ordered:
+                return
+            visiting.add(table)
+            for upstream in specs[table].get('depends_on', []):
+                visit(upstream)
+            visiting.discard(table)
+            ordered.append(specs[table])
+
+        for spec in tables:
+            visit(spec['table'])
+        return ordered
+
+    def run_step(self, cursor, timings, name, table, statements):
+        started = time.monotonic()
+        for statement in statements:
+            self.log.info("Running sql: \n{}".format(statement))
+            self.execute_measured(cursor, statement, table)
+        seconds = round(time.monotonic() - started, 3)
+        timings.append({'step': name, 'seconds': seconds})
+        self.log.info("{} took {}s".format(name, seconds))
+
+    def execute(self, context):
+        load_order = self.sort_tables(self.tables)
+        self.log.info('Fused load of {} is started'.format(', '.join(spec['table'] for spec in load_order)))
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+        execution_date = context['execution_date']
+        timings = []
+        report = {}
+
+        conn = redshift.get_conn()
+        try:
+            # nothing is committed before the last check passed
+            with conn.cursor() as cursor:
+                for spec in load_order:
+                    statements = SqlQueries.load_statements(spec['table'], spec['sql'],
+                                                            spec.get('load_strategy', 'delete-load'),
+                                                            spec.get('primary_key', ()))
+                    self.run_step(cursor, timings, "load {}".format(spec['table']), spec['table'], statements)
+
+                # the checks see the uncommitted loads of this transaction
+                for spec in load_order:
+                    if not spec.get('checks'):
+                        continue
+                    sql, aliases = quality_checks.compile_checks(spec['table'], spec['checks'])
+                    self.run_step(cursor, timings, "check {}".format(spec['table']), spec['table'], [sql])
+                    record = cursor.fetchone()
+                    if not record:
+                        raise ValueError("Data quality check failed. {} returned no results".format(spec['table']))
+                    report[spec['table']] = quality_checks.evaluate(spec['checks'], dict(zip(aliases, record)), execution_date)
+
+            failures = quality_checks.log_report(self.log, report)
+            if failures:
+                raise ValueError("Data quality checks failed: {}".format("; ".join(failures)))
+
+            started = time.monotonic()
+            conn.commit()
+            timings.append({'step': 'commit', 'seconds': round(time.monotonic() - started, 3)})
+        except Exception:
+            self.log.error("Rolling back the fused load")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+            context['ti'].xcom_push(key='step_timings', value=timings)
+            self.emit_metrics(context)
+
+        return report
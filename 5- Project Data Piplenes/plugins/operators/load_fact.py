@@ -1,41 +1,69 @@
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers import SqlQueries
+from helpers.load_metrics import LoadMetricsMixin
 
-class LoadFactOperator(BaseOperator):
+class LoadFactOperator(LoadMetricsMixin, BaseOperator):
 
     ui_color = '#F98866'
 
+    # sql is rendered with the run context, e.g. SqlQueries.time_table_insert selects the run's day
+    template_fields = ("sql",)
+
+    # delete-load: empty the table and insert the select, append: insert only,
+    # upsert: replace the rows whose primary_key is in the select
+    load_strategies = ('delete-load', 'append', 'upsert')
+
     @apply_defaults
     def __init__(self,
                 # define params
-                 conn_id = "",
+                 redshift_conn_id = "",
                  table = "",
                  sql = "",        
                  append_only = False,
+                 load_strategy = None,
+                 primary_key = (),
+                 metrics_sink = None,
                  *args, **kwargs):
 
         super(LoadFactOperator, self).__init__(*args, **kwargs)
         # Map params
-        self.conn_id = conn_id
+        self.redshift_conn_id = redshift_conn_id
         self.table = table
         self.sql = sql
-        self.append_only = append_only
+        self.load_strategy = load_strategy or ('append' if append_only else 'delete-load')
+        self.primary_key = list(primary_key)
+        self.init_metrics(metrics_sink)
 
+        if self.load_strategy not in self.load_strategies:
+            raise ValueError("load_strategy must be one of {}".format(self.load_strategies))
+        if self.load_strategy == 'upsert' and not self.primary_key:
+            raise ValueError("primary_key is required for the upsert load strategy")
 
     def execute(self, context):
         self.log.info('loading fact data process is started')
         
-        redshift = PostgresHook(postgres_conn_id=self.conn_id)
-        
-        if not self.append_only:
-            self.log.info("Delete {} fact table".format(self.table))
-            redshift.run("DELETE FROM {}".format(self.table))  
-            
-        self.log.info("Insert data from staging tables into {} fact table".format(self.table))
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
         
-        insert_statement = f"INSERT INTO {self.table} \n{self.sql}"
-        self.log.info(f"Running sql: \n{insert_statement}")
-        redshift.run(insert_statement)
-        self.log.info(f"Successfully completed insert into {self.table}")
+        # the durations of the statements that ran are emitted even when a load fails
+        try:
+            if self.load_strategy == 'upsert':
+                self.log.info("Upsert data from staging tables into {} fact table on {}".format(self.table, self.primary_key))
+                # statements of one run_measured() call commit together
+                self.run_measured(redshift, SqlQueries.upsert_statements(self.table, self.sql, self.primary_key), self.table)
+                self.log.info(f"Successfully completed upsert into {self.table}")
+                return
+
+            if self.load_strategy == 'delete-load':
+                self.log.info("Delete {} fact table".format(self.table))
+                self.run_measured(redshift, "DELETE FROM {}".format(self.table), self.table)
+
+            self.log.info("Insert data from staging tables into {} fact table".format(self.table))
+
+            insert_statement = f"INSERT INTO {self.table} \n{self.sql}"
+            self.run_measured(redshift, insert_statement, self.table)
+            self.log.info(f"Successfully completed insert into {self.table}")
+        finally:
+            self.emit_metrics(context)
 
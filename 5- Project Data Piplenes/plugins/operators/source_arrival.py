@@ -0,0 +1,138 @@
+import asyncio
+import os
+from datetime import timedelta
+
+from airflow.hooks.S3_hook import S3Hook
+from airflow.sensors.base_sensor_operator import BaseSensorOperator
+from airflow.utils.decorators import apply_defaults
+
+try:
+    from airflow.triggers.base import BaseTrigger, TriggerEvent
+except ImportError:
+    # Airflow 1.10 has no triggerer, the sensor falls back to reschedule mode
+    BaseTrigger = None
+
+
+def list_source_files(source_path, prefix, aws_conn_id=None):
+    """
+    Returns the sorted urls of the files under source_path whose key starts with prefix.
+    source_path is an s3 url (s3://udacity-dend) or a local directory standing in for the bucket.
+    """
+    if source_path.startswith('s3://') or source_path.startswith('s3a://'):
+        bucket = source_path.split('://', 1)[1].strip('/')
+        keys = S3Hook(aws_conn_id=aws_conn_id).list_keys(bucket_name=bucket, prefix=prefix) or []
+        return sorted("s3://{}/{}".format(bucket, key) for key in keys if not key.endswith('/'))
+
+    root = source_path[len('file://'):] if source_path.startswith('file://') else source_path
+    # only the directory of the prefix is walked, not the whole stand-in bucket
+    start = os.path.join(root, os.path.dirname(prefix))
+    files = []
+    for directory, _, names in os.walk(start):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.relpath(path, root).startswith(prefix):
+                files.append(os.path.abspath(path))
+    return sorted(files)
+
+
+if BaseTrigger is not None:
+    class SourceArrivalTrigger(BaseTrigger):
+        """
+        Polls the source prefix from the triggerer until min_files objects landed, then fires with their urls
+        """
+
+        def __init__(self, source_path, prefix, aws_conn_id=None, min_files=1, poke_interval=60):
+            super(SourceArrivalTrigger, self).__init__()
+            self.source_path = source_path
+            self.prefix = prefix
+            self.aws_conn_id = aws_conn_id
+            self.min_files = min_files
+            self.poke_interval = poke_interval
+
+        def serialize(self):
+            return ("operators.source_arrival.SourceArrivalTrigger", {
+                'source_path': self.source_path,
+                'prefix': self.prefix,
+                'aws_conn_id': self.aws_conn_id,
+                'min_files': self.min_files,
+                'poke_interval': self.poke_interval,
+            })
+
+        async def run(self):
+            loop = asyncio.get_event_loop()
+            while True:
+                # listing is blocking io, it runs in a thread so the triggerer keeps serving other triggers
+                files = await loop.run_in_executor(None, list_source_files,
+                                                   self.source_path, self.prefix, self.aws_conn_id)
+                if len(files) >= self.min_files:
+                    yield TriggerEvent({'files': files})
+                    return
+                self.log.info("{} file(s) under {}/{}, waiting".format(len(files), self.source_path, self.prefix))
+                await asyncio.sleep(self.poke_interval)
+
+
+class SourceArrivalSensor(BaseSensorOperator):
+    """
+    Waits for the source files of a run to land and pushes their urls to XCom under the key "manifest",
+    StageToRedshiftOperator(manifest_task_id=...) then copies exactly those files.
+
+    With deferrable=True the wait is handed to the triggerer and holds no worker slot, on Airflow versions
+    without a triggerer the sensor runs in reschedule mode instead.
+    """
+
+    ui_color = '#E8C547'
+
+    # prefix is rendered with the run context like StageToRedshiftOperator.s3_key
+    template_fields = ("prefix",)
+
+    @apply_defaults
+    def __init__(self,
+                 source_path = "",
+                 prefix = "",
+                 aws_credentials_id = None,
+                 min_files = 1,
+                 deferrable = True,
+                 *args, **kwargs):
+        """
+        source_path : bucket url, e.g. s3://udacity-dend, or a local directory standing in for it
+        prefix      : templated key prefix of the run's files
+        min_files   : number of files the run needs before staging starts
+        """
+        if deferrable and BaseTrigger is None:
+            kwargs.setdefault('mode', 'reschedule')
+
+        super(SourceArrivalSensor, self).__init__(*args, **kwargs)
+        self.source_path = source_path
+        self.prefix = prefix
+        self.aws_credentials_id = aws_credentials_id
+        self.min_files = min_files
+        self.deferrable = deferrable and BaseTrigger is not None
+
+    def poke(self, context):
+        files = list_source_files(self.source_path, self.prefix, self.aws_credentials_id)
+        self.log.info("{} file(s) under {}/{}".format(len(files), self.source_path, self.prefix))
+        if len(files) < self.min_files:
+            return False
+        context['ti'].xcom_push(key='manifest', value=files)
+        return True
+
+    def execute(self, context):
+        if not self.deferrable:
+            return super(SourceArrivalSensor, self).execute(context)
+
+        # a first poke saves the round trip through the triggerer when the files are already there
+        if self.poke(context):
+            return
+
+        self.defer(trigger=SourceArrivalTrigger(source_path=self.source_path,
+                                                prefix=self.prefix,
+                                                aws_conn_id=self.aws_credentials_id,
+                                                min_files=self.min_files,
+                                                poke_interval=self.poke_interval),
+                   method_name='execute_complete',
+                   timeout=timedelta(seconds=self.timeout))
+
+    def execute_complete(self, context, event=None):
+        files = event['files']
+        self.log.info("{} file(s) landed under {}/{}".format(len(files), self.source_path, self.prefix))
+        context['ti'].xcom_push(key='manifest', value=files)
@@ -1,26 +1,46 @@
+import json
+from datetime import timedelta
+
+from airflow.contrib.hooks.aws_hook import AwsHook
+from airflow.hooks.S3_hook import S3Hook
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers.load_metrics import LoadMetricsMixin
 
-class StageToRedshiftOperator(BaseOperator):
+class StageToRedshiftOperator(LoadMetricsMixin, BaseOperator):
     ui_color = '#358140'
-    
-    copy_sql_date = """
-            COPY {} 
-            FROM '{}/{}/{}/'
-            ACCESS_KEY_ID '{}'
-            SECRET_ACCESS_KEY '{}'
-            JSON '{}'; """
-    
+
+    # s3_key is rendered with the run context, e.g. "log_data/{{ execution_date.strftime('%Y/%m') }}/"
+    template_fields = ("s3_key", "manifest_path")
+
     copy_sql = """
-        COPY {} 
+        COPY {}
         FROM '{}'
         ACCESS_KEY_ID '{}'
         SECRET_ACCESS_KEY '{}'
         JSON '{}'; """
 
-    
-    
+    # copies exactly the files listed in the manifest file
+    manifest_copy_sql = """
+        COPY {}
+        FROM '{}'
+        ACCESS_KEY_ID '{}'
+        SECRET_ACCESS_KEY '{}'
+        JSON '{}'
+        MANIFEST; """
+
+    delete_sql = "DELETE FROM {}"
+
+    delete_partition_sql = "DELETE FROM {} WHERE {} >= {} AND {} < {}"
+
+    # length of the partition a run loads, by partition_granularity
+    partition_lengths = {
+        'hour': timedelta(hours=1),
+        'day': timedelta(days=1),
+    }
+
+
     @apply_defaults
     def __init__(self,
                  # Define your operators params (with defaults) here
@@ -28,58 +48,108 @@ class StageToRedshiftOperator(BaseOperator):
                  aws_credentials_id="",
                  table = "",
                  s3_path = "",
+                 s3_key = "",
                  json_path = "",
+                 partition_column = "",
+                 partition_granularity = None,
+                 manifest_task_id = None,
+                 manifest_path = "",
+                 metrics_sink = None,
                  *args, **kwargs):
+        """
+        s3_path               : bucket url, e.g. s3://udacity-dend
+        s3_key                : templated prefix of the files a run loads, appended to s3_path
+        partition_column      : epoch milliseconds column of the staged rows (ts for log_data)
+        partition_granularity : "hour" or "day" to load only the execution date's partition,
+                                None to reload the whole table from the prefix
+        manifest_task_id      : SourceArrivalSensor whose "manifest" XCom lists the files to copy
+        manifest_path         : templated s3 url the run's COPY manifest is written to
+        metrics_sink          : StatsdSink / TableSink of helpers/load_metrics.py the statement metrics go to
+        """
 
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
         # Map params here
         self.redshift_conn_id = redshift_conn_id
         self.aws_credentials_id = aws_credentials_id
-        self.table = table           
+        self.table = table
         self.s3_path = s3_path
+        self.s3_key = s3_key
         self.json_path = json_path
-        self.execution_date = kwargs.get('execution_date')
-               
+        self.partition_column = partition_column
+        self.partition_granularity = partition_granularity
+        self.manifest_task_id = manifest_task_id
+        self.manifest_path = manifest_path
+        self.init_metrics(metrics_sink)
+
+        if partition_granularity and partition_granularity not in self.partition_lengths:
+            raise ValueError("partition_granularity must be one of {}".format(sorted(self.partition_lengths)))
+        if partition_granularity and not partition_column:
+            raise ValueError("partition_column is required with partition_granularity")
+        if manifest_task_id and not manifest_path:
+            raise ValueError("manifest_path is required with manifest_task_id")
 
+    def partition_window(self, execution_date):
+        """
+        Returns the [start, end) epoch milliseconds of the partition of an execution date
+        """
+        start = execution_date.replace(minute=0, second=0, microsecond=0)
+        if self.partition_granularity == 'day':
+            start = start.replace(hour=0)
+        end = start + self.partition_lengths[self.partition_granularity]
+        return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+    def write_manifest(self, files):
+        """
+        Writes the COPY manifest of the files to manifest_path, a local path when testing without S3
+        """
+        manifest = json.dumps({'entries': [{'url': url, 'mandatory': True} for url in files]}, indent=2)
+        if self.manifest_path.startswith('s3://'):
+            S3Hook(aws_conn_id=self.aws_credentials_id).load_string(manifest, key=self.manifest_path, replace=True)
+        else:
+            with open(self.manifest_path, 'w') as f:
+                f.write(manifest)
 
     def execute(self, context):
-        self.log.info('Stagging data To Redshift for {} is started'.format(table))
-        
+        self.log.info('Stagging data To Redshift for {} is started'.format(self.table))
+
         aws_hook = AwsHook(self.aws_credentials_id)
         credentials = aws_hook.get_credentials()
-        
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-
-        self.log.info("Clearing data from destination Redshift table")
-        redshift.run("DELETE FROM {}".format(self.table))
-
-        self.log.info("Copying data from S3 to Redshift")      
-        # Backfill a specific date
-        if self.execution_date:
-            formatted_sql = StageToRedshiftOperator.copy_sql_time.format(
-                self.table, 
-                self.s3_path, 
-                self.execution_date.strftime("%Y"),
-                self.execution_date.strftime("%d"),
-                credentials.access_key,
-                credentials.secret_key, 
-                self.json_path,
-                self.execution_date
-            )
-        else:
-            formatted_sql = StageToRedshiftOperator.copy_sql.format(
-                self.table, 
-                self.s3_path, 
-                credentials.access_key,
-                credentials.secret_key, 
-                self.json_path,
-                self.execution_date
-            )
-            
-        redshift.run(formatted_sql)
 
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
 
+        s3_path = "{}/{}".format(self.s3_path.rstrip('/'), self.s3_key.lstrip('/')) if self.s3_key else self.s3_path
 
+        # Only the rows of this run's partition are replaced, so reruns and parallel backfills don't duplicate data
+        if self.partition_granularity:
+            start, end = self.partition_window(context['execution_date'])
+            self.log.info("Clearing {} partition [{}, {}) of {}".format(self.partition_granularity, start, end, self.table))
+            delete_sql = StageToRedshiftOperator.delete_partition_sql.format(
+                self.table, self.partition_column, start, self.partition_column, end)
+        else:
+            self.log.info("Clearing data from destination Redshift table")
+            delete_sql = StageToRedshiftOperator.delete_sql.format(self.table)
 
+        copy_sql = StageToRedshiftOperator.copy_sql
+        if self.manifest_task_id:
+            files = context['ti'].xcom_pull(task_ids=self.manifest_task_id, key='manifest')
+            if not files:
+                raise ValueError("{} pushed no manifest for {}".format(self.manifest_task_id, self.table))
+            self.log.info("Writing the manifest of {} file(s) to {}".format(len(files), self.manifest_path))
+            self.write_manifest(files)
+            copy_sql = StageToRedshiftOperator.manifest_copy_sql
+            s3_path = self.manifest_path
 
+        self.log.info("Copying data from {} to Redshift".format(s3_path))
+        formatted_sql = copy_sql.format(
+            self.table,
+            s3_path,
+            credentials.access_key,
+            credentials.secret_key,
+            self.json_path
+        )
 
+        # delete and copy commit together
+        try:
+            self.run_measured(redshift, [delete_sql, formatted_sql], self.table)
+        finally:
+            self.emit_metrics(context)
@@ -0,0 +1,125 @@
+"""
+Times month filtered queries over the date partitioned immigration fact and checks that spark prunes its partitions.
+
+    python benchmark_partitions.py --output output/ --months 2016-04 2016-05
+
+Every month is counted twice: filtered on the year and month partition columns, and filtered on an arrival_date
+range, which spark can't turn into a partition filter. For both the partition filters of the scan, the bytes
+and tasks read (from the spark metrics) and the seconds are printed, and the partition count is checked against
+the rows of immigration/_partitions.json.
+"""
+import argparse
+import re
+import time
+from datetime import date
+
+from pyspark.sql import functions as sf
+from pyspark.sql.functions import col
+
+from capstone_pipeline import create_spark_session, metrics_collector
+from table_layout import load_stats
+
+OUTPUT_PATH = 'output/'
+FACT = 'immigration'
+
+
+def partition_filters(df):
+    """
+    Description: This function is responsible for reading the partition filters of the file scans of a query plan
+
+    Returns:
+            list of the non empty partition filters, empty when every partition is read
+    """
+    plan = df._jdf.queryExecution().executedPlan().toString()
+    return [match for match in re.findall(r'PartitionFilters: \[([^\]]*)\]', plan) if match]
+
+
+def month_filters(year, month):
+    """
+    Description: This function is responsible for the two filters of the same month: on the partition columns
+                 and on the arrival date
+
+    Returns:
+            dictionary of filter name to spark column
+    """
+    first = date(year, month, 1)
+    last = date(year + month // 12, month % 12 + 1, 1)
+    return {'partition': (col('year') == year) & (col('month') == month),
+            'arrival_date': (col('arrival_date') >= sf.lit(first)) & (col('arrival_date') < sf.lit(last))}
+
+
+def run_query(metrics, df, name):
+    """
+    Description: This function is responsible for running a count under a metrics step
+
+    Returns:
+            dictionary of rows, seconds and the partition filters of the scan
+    """
+    counted = df.agg(sf.count(sf.lit(1)).alias('rows'))
+    started = time.perf_counter()
+    with metrics.track(name):
+        rows = counted.collect()[0]['rows']
+    return {'rows': rows, 'seconds': time.perf_counter() - started, 'partition_filters': partition_filters(counted)}
+
+
+def benchmark(spark, output_path, months):
+    """
+    Description: This function is responsible for running the month queries of both filters and printing how much
+                 of the fact each one read
+
+    Returns:
+            True when every partition filtered query had partition filters and matched the recorded rows
+    """
+    stats = load_stats(output_path, FACT)
+    fact = spark.read.parquet(output_path + FACT)
+    metrics = metrics_collector(spark)
+
+    results = []
+    for year, month in months:
+        for name, condition in month_filters(year, month).items():
+            result = run_query(metrics, fact.where(condition), '{}-{:02d} {}'.format(year, month, name))
+            expected = None if stats is None else sum(
+                p['rows'] for p in stats['partitions'] if p.get('year') == year and p.get('month') == month)
+            results.append(dict(result, month='{}-{:02d}'.format(year, month), filter=name, expected=expected))
+
+    steps = {step['name']: step for step in metrics.report()['steps']}
+
+    print("{:<8} {:<13} {:>10} {:>8} {:>12} {:>6} {:>8}  {}".format(
+        'month', 'filter', 'rows', 'expected', 'input bytes', 'tasks', 'seconds', 'pruned'))
+    passed = True
+    for result in results:
+        name = '{} {}'.format(result['month'], result['filter'])
+        tasks = sum(stage.get('num_tasks', 0) for job in steps[name]['jobs'] for stage in job['stages'])
+        pruned = bool(result['partition_filters'])
+        print("{:<8} {:<13} {:>10} {:>8} {:>12} {:>6} {:>7.2f}s  {}".format(
+            result['month'], result['filter'], result['rows'],
+            '-' if result['expected'] is None else result['expected'],
+            steps[name]['totals']['input_bytes'], tasks, result['seconds'], pruned))
+        if result['filter'] == 'partition':
+            passed = passed and pruned and result['expected'] in (None, result['rows'])
+    return passed
+
+
+def parse_month(value):
+    """
+    Description: This function is responsible for turning a YYYY-MM argument into (year, month)
+    """
+    year, month = value.split('-')
+    return int(year), int(month)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=OUTPUT_PATH, help='path of the written tables')
+    parser.add_argument('--months', nargs='+', type=parse_month, default=[(2016, 4)], help='months as YYYY-MM')
+    args = parser.parse_args()
+
+    spark = create_spark_session(sas=False)
+    passed = benchmark(spark, args.output.rstrip('/') + '/', args.months)
+    spark.stop()
+    if not passed:
+        raise SystemExit("A month query read every partition of the fact or its rows don't match the stats")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+"""
+Builds the immigration star schema of the capstone notebook: the calendar, visa, state and country dimensions
+and the immigration fact, written as parquet.
+
+    python convert_immigration.py --input ../../data/18-83510-I94-Data-2016
+    python capstone_pipeline.py --immigration i94_parquet --temperatures GlobalLandTemperaturesByCity.csv
+
+The cleaned immigration data is cached once and the four dimensions are written concurrently, each in its own
+FAIR scheduler pool, then the fact, which references them by surrogate key, and the immigration cube.
+The duration of every step is printed and a spark metrics run report is written to metrics/.
+
+Needs Spark 3.0+ built with Scala 2.12 (the default pyspark builds up to 3.5): the surrogate keys use xxhash64 and
+the sas7bdat reader is its Spark 3 / Scala 2.12 release, SAS_PACKAGE.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as sf
+from pyspark.sql.functions import col, upper, dayofmonth, dayofweek, month, year, weekofyear
+
+from climate import TEMPERATURE_SCHEMA, load_climate
+from demographics import CITIES_SCHEMA, aggregate_states, pivot_cities
+from immigration_cube import create_immigration_cube
+from data_profile import profile, count_check, unique_key_check
+from sas_labels import load_lookups
+from surrogate_keys import with_hash_key
+from table_layout import write_table
+
+# spark_metrics.py is shared with the data lake, in the common directory of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from spark_metrics import metrics_collector
+
+# the monthly sas7bdat files converted by convert_immigration.py
+IMMIGRATION_PATH = 'i94_parquet'
+CITIES_PATH = 'us-cities-demographics.csv'
+TEMPERATURES_PATH = '../../data2/GlobalLandTemperaturesByCity.csv'
+LABELS_PATH = 'I94_SAS_Labels_Descriptions.SAS'
+OUTPUT_PATH = 'output/'
+METRICS_DIR = 'metrics'
+
+# reader of the sas7bdat files, the Scala 2.12 build for Spark 3 (2.0.0-s_2.11 only runs on Spark 2)
+SAS_PACKAGE = 'saurfang:spark-sas7bdat:3.0.0-s_2.12'
+
+# tables written concurrently, also the names of their FAIR scheduler pools
+MAX_WORKERS = 6
+
+# dimensions the fact references: table, surrogate key and natural key columns of the fact -> of the dimension
+FACT_LOOKUPS = [
+    ('country', 'country_id', {'country_code': 'country_code'}),
+    ('state', 'state_id', {'State_Code': 'State_Code'}),
+    ('visa', 'visa_id', {'visapost': 'visapost', 'visatype': 'visatype', 'visa_code': 'visa_code',
+                         'city_code': 'admission_port'}),
+    ('calendar', 'time_id', {'arrival_date': 'arrival_date'}),
+]
+# natural keys also left on the fact, the date filters and the cube's arrival month read arrival_date
+FACT_KEPT_COLUMNS = ['arrival_date']
+# numeric codes of the fact cast to the smallest integer type of their range
+FACT_INTEGER_COLUMNS = ['id', 'count_of_arrivals', 'admnum']
+INTEGER_TYPES = [('byte', 2 ** 7 - 1), ('short', 2 ** 15 - 1), ('int', 2 ** 31 - 1), ('long', 2 ** 63 - 1)]
+
+
+def create_spark_session(sas=True):
+    """
+    Description: This function is responsible for creating the spark session with the FAIR scheduler,
+                 so jobs submitted from different threads share the executors, and attaching its metrics
+                 collector (see spark_metrics.metrics_collector)
+
+    Arguments:
+            sas : add the sas7bdat reader package, not needed for the parquet copy of the data.
+
+    Returns:
+            spark session
+    """
+    builder = SparkSession.builder.config("spark.scheduler.mode", "FAIR")
+    if sas:
+        builder = builder.\
+            config("spark.jars.repositories", "https://repos.spark-packages.org/").\
+            config("spark.jars.packages", SAS_PACKAGE)
+    spark = builder.getOrCreate()
+    metrics_collector(spark)
+    return spark
+
+
+def read_immigration(spark, path):
+    """
+    Description: This function is responsible for reading the I94 immigration data, a sas7bdat file, the same
+                 data as parquet (sas_data/) or csv, or the partitioned dataset of convert_immigration.py
+
+    Arguments:
+            spark : spark session.
+            path  : path of the immigration data.
+
+    Returns:
+            spark dataframe of the raw immigration data
+    """
+    if path.endswith('.sas7bdat'):
+        return spark.read.format('com.github.saurfang.sas.spark').load(path)
+    if path.endswith('.csv'):
+        return spark.read.csv(path, header=True, inferSchema=True).drop('_c0')
+    return spark.read.parquet(path)
+
+
+def clean_immigration(df):
+    """
+    Description: This function is responsible for dropping the mostly empty columns of the immigration data,
+                 renaming its columns and converting the SAS arrival and departure dates. Data cleaned already
+                 (convert_immigration.py) is returned unchanged.
+
+    Arguments:
+            df : spark dataframe of the raw immigration data.
+
+    Returns:
+            spark dataframe of the cleaned immigration data
+    """
+    # to avoid conflict between count of duplicates and count of arrivals
+    df = df.withColumnRenamed('count', 'count_of_arrivals')
+
+    # Drop columns that contains significant missing data
+    df = df.drop('occup', 'entdepu', 'insnum')
+
+    #remove i94 from columns names
+    replacements = {c: c.replace('i94', '') for c in df.columns if 'i94' in c}
+    df = df.select([col(c).alias(replacements.get(c, c)) for c in df.columns])
+
+    #rename multiple columns
+    mapping_im = dict(zip(['cicid', 'res', 'yr', 'mon', 'port', 'addr', 'arrdate', 'depdate', 'visa'],
+                          ['id', 'country_code', 'year', 'month', 'city_code', 'State_Code', 'arrival_date',
+                           'departure_date', 'visa_code']))
+    df = df.select([col(c).alias(mapping_im.get(c, c)) for c in df.columns])
+
+    # SAS dates are days since 1960-01-01, converted natively instead of a python udf (0 stays empty)
+    for column in ('arrival_date', 'departure_date'):
+        if dict(df.dtypes)[column] == 'date':
+            continue
+        df = df.withColumn(column, sf.when(col(column) != 0,
+                                           sf.date_add(sf.lit('1960-01-01').cast('date'), col(column).cast('int'))))
+    return df
+
+
+def read_cities(spark, path):
+    """
+    Description: This function is responsible for reading the US cities demographics and pivoting their race
+                 rows, see demographics.pivot_cities
+
+    Arguments:
+            spark : spark session.
+            path  : path of us-cities-demographics.csv.
+
+    Returns:
+            spark dataframe of the cities, one row per city and state
+    """
+    df = spark.read.csv(path, sep=";", header=True, schema=CITIES_SCHEMA)
+    # Drop rows that contains missing data
+    df = df.dropna(how='all')
+    return pivot_cities(df)
+
+
+def read_temperatures(spark, path):
+    """
+    Description: This function is responsible for reading and cleaning the global land temperatures by city
+
+    Arguments:
+            spark : spark session.
+            path  : path of GlobalLandTemperaturesByCity.csv.
+
+    Returns:
+            spark dataframe of the temperatures
+    """
+    df = spark.read.csv(path, header=True, schema=TEMPERATURE_SCHEMA)
+    # Drop rows that contains missing data
+    df = df.dropna(how='all')
+    df = df.withColumn("City", upper(col('City')))
+    df = df.withColumn("Country", upper(col('Country')))
+
+    replacements = {c: c.replace(' ', '_') for c in df.columns if ' ' in c}
+    return df.select([col(c).alias(replacements.get(c, c)) for c in df.columns])
+
+
+def read_labels(spark, path):
+    """
+    Description: This function is responsible for the country, port and visa labels of
+                 I94_SAS_Labels_Descriptions.SAS, parsed once and cached as parquet by sas_labels.load_lookups
+
+    Arguments:
+            spark : spark session.
+            path  : path of the SAS labels file.
+
+    Returns:
+            countries, cities and visas spark dataframes, with a broadcast hint
+    """
+    lookups = load_lookups(spark, path)
+    return lookups['country'], lookups['port'], lookups['visa']
+
+
+def calendar_rows(df):
+    """
+    Description: This function is responsible for the rows of the calendar dimension, one per arrival date of
+                 immigration
+
+    Arguments:
+            df : spark dataframe of immigration.
+
+    Returns:
+            spark dataframe of the calendar rows with their time_id
+    """
+    # create initial calendar df from arrdate column, without a row for a missing date (see state_rows)
+    time_df = df.select(['arrival_date']).distinct().where(col('arrival_date').isNotNull())
+
+    #create columns from date
+    time_df = time_df.withColumn('day', dayofmonth('arrival_date'))
+    time_df = time_df.withColumn('week', weekofyear('arrival_date'))
+    time_df = time_df.withColumn('month', month('arrival_date'))
+    time_df = time_df.withColumn('year', year('arrival_date'))
+    time_df = time_df.withColumn('weekday', dayofweek('arrival_date'))
+
+    # create an id field, a hash of the natural key so it is stable across runs
+    return with_hash_key(time_df, 'time_id', ['arrival_date'])
+
+
+def create_time_dimension(df, output_path):
+    """
+    Description: This function creates time_dimension based on arrival date
+
+    Arguments:
+            df          : spark dataframe of immigration.
+            output_path : path to save dimension table.
+
+    Returns:
+            spark dataframe representing calendar dimension
+    """
+    # write the calendar dimension to parquet file
+    return write_table(calendar_rows(df), output_path, "calendar")
+
+
+def visa_rows(df, visas_desc):
+    """
+    Description: This function is responsible for the rows of the visa dimension, selecting 'visapost',
+                 'visatype','visa_code' from immigration and join with visa_desc
+
+    Arguments:
+            df         : spark dataframe of immigration.
+            visas_desc : spark dataframe of the visa categories.
+
+    Returns:
+            spark dataframe of the visa rows with their visa_id
+    """
+    visa_df = df.select('visapost', 'visatype', 'visa_code', 'city_code').distinct().join(visas_desc, 'visa_code', "inner")
+    visa_df = visa_df.withColumnRenamed('city_code', 'admission_port')
+
+    # create an id field, a hash of the natural key so it is stable across runs
+    return with_hash_key(visa_df, 'visa_id', ['visapost', 'visatype', 'visa_code', 'admission_port'])
+
+
+def create_visa_dimension(df, visas_desc, output_path):
+    """
+    Description: This function creates visa_dimension by selecting 'visapost','visatype','visa_code' from
+                 immigration and join with visa_desc
+
+    Arguments:
+            df          : spark dataframe of immigration.
+            visas_desc  : spark dataframe of the visa categories.
+            output_path : path to save dimension table.
+
+    Returns:
+            spark dataframe representing visa dimension
+    """
+    return write_table(visa_rows(df, visas_desc), output_path, "visa")
+
+
+def state_rows(df_cities, df_im):
+    """
+    Description: This function is responsible for the rows of the state dimension, the demographics of the
+                 states immigrants arrive to
+
+    Arguments:
+            df_cities : spark dataframe of the cities demographics, one row per city.
+            df_im     : spark dataframe of immigration.
+
+    Returns:
+            spark dataframe of the state rows with their state_id
+    """
+    state_df = aggregate_states(df_cities).dropna()
+
+    # no row for a null State_Code: its hash would be a real state_id, and the fact rows without a state would
+    # join it, which the natural key join State_Code = State_Code never did
+    state_dim = df_im.select('State_Code').distinct().where(col('State_Code').isNotNull()).\
+        join(state_df, 'State_Code', "left")
+
+    # create an id field, a hash of the natural key so it is stable across runs
+    state_dim = with_hash_key(state_dim, 'state_id', ['State_Code'])
+    return state_dim.fillna(0)
+
+
+def create_state_dimension(df_cities, df_im, output_path):
+    """
+    Description: This function creates state_dimension from the demographics of the states immigrants arrive to
+
+    Arguments:
+            df_cities   : spark dataframe of the cities demographics, one row per city.
+            df_im       : spark dataframe of immigration.
+            output_path : path to save dimension table.
+
+    Returns:
+            spark dataframe representing state dimension
+    """
+    return write_table(state_rows(df_cities, df_im), output_path, "state")
+
+
+def create_country_dimension(countries_desc, climate, output_path):
+    """
+    Description: This function creates country_dimension from the country labels and their average temperatures
+
+    Arguments:
+            countries_desc : spark dataframe of the country labels.
+            climate        : spark dataframe of the per country climate, see climate.load_climate.
+            output_path    : path to save dimension table.
+
+    Returns:
+            spark dataframe representing country dimension
+    """
+    country_dim = countries_desc.join(climate, 'Country', "left")
+    # create an id field, a hash of the natural key so it is stable across runs
+    country_dim = with_hash_key(country_dim, 'country_id', ['country_code'])
+    country_dim = country_dim.fillna(0)
+    # write the dimension to a parquet file
+    return write_table(country_dim, output_path, "country")
+
+
+def lookup_keys(df, dimension, key, columns, keep=()):
+    """
+    Description: This function is responsible for replacing natural key columns by the surrogate key of a
+                 dimension, a broadcast left join so rows without a dimension row keep a null key. The join
+                 is null safe for the visa key, whose dimension has rows with an empty visapost; the dimensions
+                 keyed by a single column have no null key row, rows with a null natural key keep a null key.
+
+    Arguments:
+            df        : spark dataframe of immigration.
+            dimension : spark dataframe of the dimension.
+            key       : name of the surrogate key column.
+            columns   : dictionary of natural key column of df -> column of the dimension.
+            keep      : natural key columns left on df next to the key.
+
+    Returns:
+            spark dataframe with the key column instead of the natural key columns
+    """
+    types = dict(df.dtypes)
+    # null safe, the visa natural key has an empty visapost on most rows
+    lookup = dimension.select(key, *[col(d).cast(types[f]).alias('lookup_' + f) for f, d in columns.items()])
+    condition = [col(f).eqNullSafe(col('lookup_' + f)) for f in columns]
+    df = df.join(sf.broadcast(lookup), condition, "left")
+    return df.drop(*[f for f in columns if f not in keep]).drop(*['lookup_' + f for f in columns])
+
+
+def downcast(df, columns):
+    """
+    Description: This function is responsible for casting numeric columns holding whole numbers (the SAS codes
+                 are doubles) to the smallest integer type their range fits, one aggregation for all columns
+
+    Arguments:
+            df      : spark dataframe.
+            columns : names of the columns to downcast, other than numeric ones are left as they are.
+
+    Returns:
+            spark dataframe with the downcast columns
+    """
+    types = dict(df.dtypes)
+    columns = [c for c in columns if types[c] in ('double', 'float', 'bigint', 'int', 'smallint')]
+    if not columns:
+        return df
+    aggregations = []
+    for c in columns:
+        aggregations += [sf.min(c), sf.max(c), sf.sum(sf.when(col(c) != sf.floor(col(c)), 1))]
+    stats = df.agg(*aggregations).first()
+
+    casts = {}
+    for i, c in enumerate(columns):
+        low, high, fractions = stats[3 * i], stats[3 * i + 1], stats[3 * i + 2]
+        if fractions:
+            continue
+        for name, bound in INTEGER_TYPES:
+            if low is None or (-bound - 1 <= low and high <= bound):
+                casts[c] = name
+                break
+    return df.select([col(c).cast(casts[c]).alias(c) if c in casts else col(c) for c in df.columns])
+
+
+def build_fact(df_im, dimensions):
+    """
+    Description: This function is responsible for the rows of the immigration fact, the natural keys of the
+                 cleaned immigration data replaced by the surrogate keys of the dimensions
+
+    Arguments:
+            df_im      : spark dataframe of immigration.
+            dimensions : dictionary of table name -> spark dataframe of the dimensions of FACT_LOOKUPS.
+
+    Returns:
+            spark dataframe of the fact rows, before downcasting
+    """
+    df = df_im.select(['id', 'country_code', 'city_code', 'arrival_date', 'State_Code', 'visa_code', 'visapost',
+                       'visatype', 'count_of_arrivals', 'dtadfile', 'matflag', 'dtaddto', 'gender', 'airline',
+                       'admnum', 'fltno'])
+
+    for table, key, columns in FACT_LOOKUPS:
+        df = lookup_keys(df, dimensions[table], key, columns, keep=FACT_KEPT_COLUMNS)
+    return df
+
+
+def create_fact_dimension(df_im, dimensions, output_path):
+    """
+    Description: This function creates the immigration fact table, referencing the dimensions by their surrogate
+                 keys and with its numeric codes downcast, written dictionary encoded and partitioned by arrival
+                 year, month and day
+
+    Arguments:
+            df_im       : spark dataframe of immigration.
+            dimensions  : dictionary of table name -> spark dataframe of the dimensions of FACT_LOOKUPS.
+            output_path : path to save the fact table.
+
+    Returns:
+            spark dataframe representing the immigration fact
+    """
+    df = downcast(build_fact(df_im, dimensions), FACT_INTEGER_COLUMNS)
+
+    # airline, fltno and the flags have a few thousand distinct values, kept as dictionary encoded strings
+    return write_table(df, output_path, "immigration")
+
+
+def run_concurrently(spark, metrics, steps, max_workers=MAX_WORKERS):
+    """
+    Description: This function is responsible for running pipeline steps from a thread pool, every step in the
+                 FAIR scheduler pool of its name and tracked by the metrics collector
+
+    Arguments:
+            spark       : spark session.
+            metrics     : metrics collector of the session.
+            steps       : list of (name, function, arguments).
+            max_workers : number of steps submitted at the same time.
+
+    Returns:
+            dictionary of the step results by name
+    """
+    sc = spark.sparkContext
+
+    def run(name, function, args):
+        # local properties are per thread, the jobs of the step land in its pool and job group
+        sc.setLocalProperty('spark.scheduler.pool', name)
+        try:
+            with metrics.track(name):
+                return function(*args)
+        finally:
+            sc.setLocalProperty('spark.scheduler.pool', None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {name: executor.submit(run, name, function, args) for name, function, args in steps}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def run_quality_checks(spark, output_path):
+    """
+    Description: This function is responsible for the count and unique key checks of the written tables,
+                 one profiling pass per table. The keys are counted exactly, the other columns of the
+                 dimensions too (they are small) and those of the fact with distinct estimates.
+
+    Returns:
+            True when every check passed
+    """
+    tables = [
+        ['country_dim', 'country', 'country_id', True],
+        ['visa_dim', 'visa', 'visa_id', True],
+        ['time_dim', 'calendar', 'time_id', True],
+        ['states_dim', 'state', 'state_id', True],
+        ['immigration_fact', 'immigration', 'id', False]]
+
+    passed = True
+    for table_name, path, column, exact in tables:
+        report = profile(spark.read.parquet(output_path + path), keys=[column], exact=exact)
+        passed = count_check(report, table_name) and passed
+        passed = unique_key_check(report, column, table_name) and passed
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--immigration', default=IMMIGRATION_PATH,
+                        help='output of convert_immigration.py, or a sas7bdat file or parquet/csv of it')
+    parser.add_argument('--cities', default=CITIES_PATH)
+    parser.add_argument('--temperatures', default=TEMPERATURES_PATH)
+    parser.add_argument('--labels', default=LABELS_PATH)
+    parser.add_argument('--output', default=OUTPUT_PATH)
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help='tables written at the same time')
+    args = parser.parse_args()
+    output_path = args.output.rstrip('/') + '/'
+
+    spark = create_spark_session(sas=args.immigration.endswith('.sas7bdat'))
+    metrics = metrics_collector(spark)
+
+    with metrics.track('load_sources'):
+        # every table reads the cleaned immigration data, it is scanned and converted once
+        df_im = clean_immigration(read_immigration(spark, args.immigration)).cache()
+        df_im.count()
+        df_cities = read_cities(spark, args.cities)
+        climate = load_climate(spark, args.temperatures)
+        countries_desc, cities_desc, visas_desc = read_labels(spark, args.labels)
+
+    run_concurrently(spark, metrics, [
+        ('create_time_dimension', create_time_dimension, (df_im, output_path)),
+        ('create_visa_dimension', create_visa_dimension, (df_im, visas_desc, output_path)),
+        ('create_state_dimension', create_state_dimension, (df_cities, df_im, output_path)),
+        ('create_country_dimension', create_country_dimension, (countries_desc, climate, output_path)),
+    ], max_workers=args.workers)
+    # the fact looks its keys up in the written dimensions, small parquet reads instead of their lineage
+    dimensions = {table: spark.read.parquet(output_path + table) for table, _, _ in FACT_LOOKUPS}
+    run_concurrently(spark, metrics, [
+        ('create_fact_dimension', create_fact_dimension, (df_im, dimensions, output_path)),
+        ('create_immigration_cube', create_immigration_cube, (df_im, dimensions, output_path)),
+    ], max_workers=args.workers)
+    df_im.unpersist()
+
+    with metrics.track('quality_checks'):
+        passed = run_quality_checks(spark, output_path)
+
+    for step in metrics.steps:
+        print("{:<28} {:>8.1f}s".format(step['name'], step['duration_s']))
+    print('Run report written to', metrics.write_report(METRICS_DIR))
+
+    if not passed:
+        raise SystemExit("Data quality checks failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Checks that immigration_cube.query gives the same answers from the cube and from the fact.
+
+    python check_cube.py --sample immigration_data_sample.csv
+
+The sample arrivals are cleaned like the batch pipeline, some of them are given a null State_Code, and the
+dimensions, the fact and the cube are written to a temporary directory. Every question is then answered from
+the cube and from the fact (use_cube=False), and the two results are compared. The temperatures of the country
+dimension are made up from the country labels, the check is about the joins, not the climate.
+"""
+import argparse
+import shutil
+import tempfile
+
+from pyspark.sql import functions as sf
+from pyspark.sql.functions import col
+
+from capstone_pipeline import (CITIES_PATH, FACT_LOOKUPS, LABELS_PATH, clean_immigration, create_country_dimension,
+                               create_fact_dimension, create_spark_session, create_state_dimension,
+                               create_time_dimension, create_visa_dimension, read_cities, read_immigration)
+from immigration_cube import create_immigration_cube, query
+from sas_labels import load_lookups
+
+SAMPLE_PATH = 'immigration_data_sample.csv'
+
+# one arrival in NULL_STATE_EVERY loses its state
+NULL_STATE_EVERY = 5
+
+QUESTIONS = [
+    dict(aggregate='count', join='country', filters=[('AverageTemperature', '>=', 20)]),
+    dict(aggregate='count', join='state', filters=[('foreign_born', '<=', 600000)]),
+    dict(aggregate='avg', column='median_age', join='state', filters=[('foreign_born', '<=', 600000)]),
+    dict(aggregate='count', group_by=['State_Code']),
+    dict(aggregate='sum', column='count_of_arrivals', group_by=['country_code', 'gender']),
+    dict(aggregate='count', filters=[('visa_code', '=', 2)], group_by=['arrival_month']),
+    dict(aggregate='count', join='state', group_by=['State_Code']),
+]
+
+
+def build_tables(spark, sample_path, output_path, cache_dir):
+    """
+    Description: This function is responsible for writing the dimensions, the fact and the cube of the sample
+                 arrivals, some of them without a state
+    """
+    df_im = clean_immigration(read_immigration(spark, sample_path))
+    df_im = df_im.withColumn('State_Code', sf.when(col('id') % NULL_STATE_EVERY != 0, col('State_Code')))
+
+    lookups = load_lookups(spark, LABELS_PATH, cache_dir)
+    countries_desc = lookups['country']
+    climate = countries_desc.select('Country', (sf.length('Country') % 30).cast('double').alias('AverageTemperature'),
+                                    sf.lit(0.5).alias('AverageTemperatureUncertainty'))
+
+    create_time_dimension(df_im, output_path)
+    create_visa_dimension(df_im, lookups['visa'], output_path)
+    create_state_dimension(read_cities(spark, CITIES_PATH), df_im, output_path)
+    create_country_dimension(countries_desc, climate, output_path)
+    dimensions = {table: spark.read.parquet(output_path + table) for table, _, _ in FACT_LOOKUPS}
+    create_fact_dimension(df_im, dimensions, output_path)
+    create_immigration_cube(df_im, dimensions, output_path)
+    return df_im.where(col('State_Code').isNull()).count()
+
+
+def same_result(cube, fact):
+    """
+    Description: This function is responsible for comparing two query results, in any row order and with the
+                 averages rounded
+
+    Returns:
+            True when both have the same rows
+    """
+    if list(cube.columns) != list(fact.columns) or len(cube) != len(fact):
+        return False
+    columns = list(cube.columns)
+    cube, fact = cube.round(6).fillna(-1), fact.round(6).fillna(-1)
+    return cube.sort_values(columns).values.tolist() == fact.sort_values(columns).values.tolist()
+
+
+def check(spark, output_path):
+    """
+    Description: This function is responsible for answering every question from the cube and from the fact
+
+    Returns:
+            True when all the answers match and the cube answered the questions
+    """
+    passed = True
+    for question in QUESTIONS:
+        cube = query(spark, output_path, use_cube=True, **question)
+        fact = query(spark, output_path, use_cube=False, **question)
+        matched = cube['source'] == 'cube' and same_result(cube['result'], fact['result'])
+        print("{:<5} {}".format('ok' if matched else 'FAIL', question))
+        if not matched:
+            print(cube['result'], fact['result'], sep='\n')
+        passed = passed and matched
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sample', default=SAMPLE_PATH, help='arrivals the tables are built from')
+    args = parser.parse_args()
+
+    spark = create_spark_session(sas=False)
+    work_dir = tempfile.mkdtemp(prefix='check_cube_')
+    try:
+        output_path = work_dir + '/output/'
+        nulls = build_tables(spark, args.sample, output_path, work_dir + '/labels_cache')
+        print("{} arrivals without a state".format(nulls))
+        passed = nulls > 0 and check(spark, output_path)
+    finally:
+        spark.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if not passed:
+        raise SystemExit("The cube and the fact answer a question differently")
+
+
+if __name__ == "__main__":
+    main()
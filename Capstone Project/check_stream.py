@@ -0,0 +1,104 @@
+"""
+Checks that stream_immigration.py gives the arrivals of a daily drop their keys when the drop has dates and visas
+the written dimensions don't have yet.
+
+    python check_stream.py --sample immigration_data_sample.csv
+
+The tables are built from the sample arrivals (see check_cube.build_tables). A drop of the same arrivals moved
+DAYS_LATER days after the last sampled date, with a new visa post, is streamed into the fact, and the check
+fails unless every streamed fact row has a time_id and a visa_id, the calendar got one row for the new date and
+the dimension rows are not appended twice when the same batch is looked up again.
+"""
+import argparse
+import shutil
+import tempfile
+
+from pyspark.sql import functions as sf
+from pyspark.sql.functions import col
+
+from capstone_pipeline import CITIES_PATH, LABELS_PATH, clean_immigration, create_spark_session, read_cities
+from check_cube import build_tables
+from sas_labels import load_lookups
+from stream_immigration import run_stream, source_schema, update_dimensions
+
+SAMPLE_PATH = 'immigration_data_sample.csv'
+
+# the drop arrives this many days after the last arrival of the sample, a date the calendar doesn't have
+DAYS_LATER = 30
+NEW_VISAPOST = 'ZZZ'
+
+
+def write_drop(spark, sample_path, landing_path):
+    """
+    Description: This function is responsible for writing the daily drop, the sample arrivals moved to a date
+                 and a visa post the dimensions don't have
+
+    Returns:
+            the SAS arrival date of the drop
+    """
+    sample = spark.read.csv(sample_path, header=True, inferSchema=True)
+    arrdate = sample.agg(sf.max('arrdate')).first()[0] + DAYS_LATER
+    drop = sample.withColumn('arrdate', sf.lit(arrdate).cast(dict(sample.dtypes)['arrdate'])).\
+        withColumn('visapost', sf.lit(NEW_VISAPOST))
+    drop.coalesce(1).write.csv(landing_path, header=True, mode='overwrite')
+    return arrdate
+
+
+def check(spark, output_path, sources, drop_date, dropped):
+    """
+    Description: This function is responsible for the keys of the streamed rows and the new dimension rows
+
+    Returns:
+            True when the streamed rows have their keys and the dimensions got the new rows once
+    """
+    fact = spark.read.parquet(output_path + 'immigration').where(col('arrival_date') == drop_date)
+    counts = fact.agg(sf.count(sf.lit(1)).alias('rows'), sf.count('time_id').alias('time_ids'),
+                      sf.count('visa_id').alias('visa_ids')).first()
+    calendar = spark.read.parquet(output_path + 'calendar')
+    new_dates = calendar.where(col('arrival_date') == drop_date).count()
+    new_visas = spark.read.parquet(output_path + 'visa').where(col('visapost') == NEW_VISAPOST).count()
+    print("{} streamed rows, {} with a time_id, {} with a visa_id, {} calendar rows and {} visa rows added".format(
+        counts['rows'], counts['time_ids'], counts['visa_ids'], new_dates, new_visas))
+
+    # the same batch looked up again, as when it is replayed, finds its rows in the dimensions
+    calendar_count, visa_count = calendar.count(), spark.read.parquet(output_path + 'visa').count()
+    update_dimensions(spark, dropped, output_path, sources)
+    replayed = (spark.read.parquet(output_path + 'calendar').count() == calendar_count and
+                spark.read.parquet(output_path + 'visa').count() == visa_count)
+    print("replayed batch appended no dimension rows: {}".format(replayed))
+
+    return (counts['rows'] == dropped.count() and counts['time_ids'] == counts['rows'] and
+            counts['visa_ids'] == counts['rows'] and new_dates == 1 and new_visas > 0 and replayed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sample', default=SAMPLE_PATH, help='arrivals the tables and the drop are built from')
+    args = parser.parse_args()
+
+    spark = create_spark_session(sas=False)
+    work_dir = tempfile.mkdtemp(prefix='check_stream_')
+    try:
+        output_path = work_dir + '/output/'
+        landing_path = work_dir + '/landing/'
+        build_tables(spark, args.sample, output_path, work_dir + '/labels_cache')
+        arrdate = write_drop(spark, args.sample, landing_path)
+
+        sources = {'visa': load_lookups(spark, LABELS_PATH, work_dir + '/labels_cache')['visa'],
+                   'cities': read_cities(spark, CITIES_PATH)}
+        run_stream(spark, landing_path, 'csv', source_schema(spark, args.sample, 'csv'), sources, output_path,
+                   work_dir + '/checkpoint', once=True)
+
+        dropped = clean_immigration(spark.read.csv(landing_path, header=True, inferSchema=True).drop('_c0'))
+        drop_date = dropped.select('arrival_date').first()[0]
+        print("drop of SAS date {} ({})".format(arrdate, drop_date))
+        passed = check(spark, output_path, sources, drop_date, dropped)
+    finally:
+        spark.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if not passed:
+        raise SystemExit("Streamed arrivals of a new date or visa didn't get their keys")
+
+
+if __name__ == "__main__":
+    main()
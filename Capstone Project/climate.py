@@ -0,0 +1,63 @@
+import os
+
+from pyspark.sql import functions as sf
+from pyspark.sql.functions import broadcast, col, mean, round, upper
+from pyspark.sql.types import DateType, DoubleType, StringType, StructField, StructType
+
+from sas_labels import file_hash
+
+CLIMATE_CACHE_DIR = 'climate_cache'
+
+# GlobalLandTemperaturesByCity.csv, declared so the 8.6M rows are not read twice to infer it
+TEMPERATURE_SCHEMA = StructType([
+    StructField('dt', DateType()),
+    StructField('AverageTemperature', DoubleType()),
+    StructField('AverageTemperatureUncertainty', DoubleType()),
+    StructField('City', StringType()),
+    StructField('Country', StringType()),
+    StructField('Latitude', StringType()),
+    StructField('Longitude', StringType()),
+])
+
+
+def aggregate_climate(temp_df, by_decade=False):
+    """
+    Description: This function is responsible for averaging the temperatures per country, or per country and
+                 decade
+
+    Arguments:
+            temp_df   : spark dataframe of the temperatures.
+            by_decade : add the decade (1990, 2000, ...) to the grouping.
+
+    Returns:
+            spark dataframe of Country (upper case), [decade,] AverageTemperature, AverageTemperatureUncertainty
+    """
+    groups = [upper(col('Country')).alias('Country')]
+    if by_decade:
+        groups.append((sf.floor(sf.year('dt') / 10) * 10).cast('int').alias('decade'))
+    return temp_df.groupBy(*groups).agg(
+        round(mean('AverageTemperature'), 2).alias("AverageTemperature"),
+        round(mean("AverageTemperatureUncertainty"), 2).alias("AverageTemperatureUncertainty")).dropna()
+
+
+def load_climate(spark, path, cache_dir=CLIMATE_CACHE_DIR, by_decade=False):
+    """
+    Description: This function is responsible for the per country climate of the temperatures file. It is
+                 aggregated once and cached as a small parquet file under cache_dir/<file hash>/, the cache is
+                 rebuilt only when the content of the file changes. The dataframe carries a broadcast hint,
+                 joining it to the country labels doesn't shuffle.
+
+    Arguments:
+            spark     : spark session.
+            path      : path of GlobalLandTemperaturesByCity.csv.
+            cache_dir : directory of the parquet cache.
+            by_decade : the per country and decade climate instead.
+
+    Returns:
+            spark dataframe of the climate, see aggregate_climate
+    """
+    table = os.path.join(cache_dir, file_hash(path)[:16], 'country_decade' if by_decade else 'country')
+    if not os.path.exists(os.path.join(table, '_SUCCESS')):
+        temp_df = spark.read.csv(path, header=True, schema=TEMPERATURE_SCHEMA)
+        aggregate_climate(temp_df, by_decade).coalesce(1).write.parquet(table, mode='overwrite')
+    return broadcast(spark.read.parquet(table))
@@ -0,0 +1,132 @@
+"""
+Converts the monthly I94 sas7bdat files to one parquet dataset partitioned by year and month, cleaned once
+(column renames and SAS dates, see capstone_pipeline.clean_immigration) so the pipeline reads only parquet.
+
+    python convert_immigration.py --input ../../data/18-83510-I94-Data-2016 --output i94_parquet
+
+Files are converted in parallel, each in its own FAIR scheduler pool. The sha256 of every converted file is
+kept in <output>/_conversions.json and a file whose hash didn't change is skipped, a changed file replaces
+only its month's partition.
+"""
+import argparse
+import glob
+import json
+import os
+import threading
+from datetime import datetime
+
+from pyspark.sql.functions import col
+
+from capstone_pipeline import create_spark_session, metrics_collector, read_immigration, clean_immigration, \
+    run_concurrently
+from sas_labels import file_hash
+
+SOURCE_PATH = '../../data/18-83510-I94-Data-2016'
+SOURCE_PATTERN = '*.sas7bdat'
+OUTPUT_PATH = 'i94_parquet'
+STATE_FILE = '_conversions.json'
+MAX_WORKERS = 4
+
+
+def load_state(output_path):
+    """
+    Description: This function is responsible for reading the record of the converted files
+
+    Returns:
+            dictionary of source file name to {sha256, converted_at}
+    """
+    path = os.path.join(output_path, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(output_path, state):
+    """
+    Description: This function is responsible for writing the record of the converted files, replaced atomically
+    """
+    os.makedirs(output_path, exist_ok=True)
+    path = os.path.join(output_path, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def convert_file(spark, path, output_path):
+    """
+    Description: This function is responsible for converting one monthly file: it is read, cleaned and written
+                 to its year/month partition, replacing only the partitions present in the file
+
+    Arguments:
+            spark       : spark session.
+            path        : path of the sas7bdat (or csv/parquet) file.
+            output_path : root of the partitioned parquet dataset.
+
+    Returns:
+            None
+    """
+    df = clean_immigration(read_immigration(spark, path))
+    # integer partition values, year=2016/month=4 rather than year=2016.0/month=4.0
+    df = df.withColumn('year', col('year').cast('int')).withColumn('month', col('month').cast('int'))
+    df.write.partitionBy('year', 'month').option('partitionOverwriteMode', 'dynamic').\
+        parquet(output_path, mode='overwrite')
+
+
+def convert_all(spark, metrics, sources, output_path, max_workers=MAX_WORKERS):
+    """
+    Description: This function is responsible for converting the source files not converted yet, in parallel
+
+    Arguments:
+            spark       : spark session.
+            metrics     : metrics collector of the session.
+            sources     : paths of the monthly files.
+            output_path : root of the partitioned parquet dataset.
+            max_workers : number of files converted at the same time.
+
+    Returns:
+            names of the converted files
+    """
+    state = load_state(output_path)
+    lock = threading.Lock()
+
+    def convert(path):
+        name = os.path.basename(path)
+        digest = file_hash(path)
+        if state.get(name, {}).get('sha256') == digest:
+            print("Skipping {}, already converted".format(name))
+            return False
+        convert_file(spark, path, output_path)
+        with lock:
+            state[name] = {'sha256': digest, 'converted_at': datetime.utcnow().isoformat()}
+            save_state(output_path, state)
+        return True
+
+    results = run_concurrently(spark, metrics, [('convert_' + os.path.basename(path), convert, (path,))
+                                                for path in sources], max_workers)
+    return [name[len('convert_'):] for name, converted in results.items() if converted]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default=SOURCE_PATH, help='directory of the monthly files')
+    parser.add_argument('--pattern', default=SOURCE_PATTERN)
+    parser.add_argument('--output', default=OUTPUT_PATH)
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help='files converted at the same time')
+    args = parser.parse_args()
+
+    sources = sorted(glob.glob(os.path.join(args.input, args.pattern)))
+    if not sources:
+        raise SystemExit("No {} files in {}".format(args.pattern, args.input))
+
+    spark = create_spark_session(sas=args.pattern.endswith('.sas7bdat'))
+    metrics = metrics_collector(spark)
+    converted = convert_all(spark, metrics, sources, args.output, args.workers)
+
+    for step in metrics.steps:
+        print("{:<36} {:>8.1f}s".format(step['name'], step['duration_s']))
+    print("Converted {} of {} files to {}".format(len(converted), len(sources), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import pandas as pd
+from pyspark.sql import functions as sf
+from pyspark.sql.types import ArrayType, DoubleType, FloatType, MapType, StructType
+
+# relative standard deviation of the HyperLogLog distinct estimates, a lower one needs more registers and each
+# register word is a field of the aggregation buffer, below ~0.01 the buffer no longer fits a local executor
+APPROX_RSD = 0.01
+
+
+def _key_name(key):
+    return key if isinstance(key, str) else ','.join(key)
+
+
+def profile(df, keys=(), exact=False, rsd=APPROX_RSD):
+    """
+    Description: This function is responsible for profiling a spark dataframe in a single aggregation pass:
+                 the row count, and for every column the null (and NaN) count, the distinct count, min and max,
+                 and the number of duplicated values of every key.
+
+                 Distinct counts are HyperLogLog estimates (approx_count_distinct) unless exact is set, exact
+                 distinct counts need a shuffle per column and are meant for small tables. Keys are always
+                 counted exactly, an estimate can't tell a unique key from one with a few duplicates.
+
+    Arguments:
+            df      : spark dataframe.
+            keys    : key columns to count duplicates of, a column name or a list of column names.
+            exact   : count the distinct values of every column exactly, not only of the keys.
+            rsd     : relative standard deviation of the estimates.
+
+    Returns:
+            dictionary report, see the checks below for its use
+                rows           : row count
+                exact          : whether the distinct counts are exact
+                rsd            : error of the estimates, 0 when exact
+                columns        : column -> {nulls, distinct, min, max}
+                duplicate_keys : key -> non null keys minus distinct keys, exact in both modes
+    """
+    def distinct(column):
+        return sf.countDistinct(column) if exact else sf.approx_count_distinct(column, rsd)
+
+    exprs = [sf.count(sf.lit(1)).alias('rows')]
+    for i, field in enumerate(df.schema.fields):
+        column = sf.col('`{}`'.format(field.name))
+        missing = column.isNull()
+        if isinstance(field.dataType, (DoubleType, FloatType)):
+            missing = missing | sf.isnan(column)
+        exprs.append(sf.count(sf.when(missing, 1)).alias('nulls_{}'.format(i)))
+        exprs.append(distinct(column).alias('distinct_{}'.format(i)))
+        if not isinstance(field.dataType, (ArrayType, MapType, StructType)):
+            exprs.append(sf.min(column).alias('min_{}'.format(i)))
+            exprs.append(sf.max(column).alias('max_{}'.format(i)))
+
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    for i, key in enumerate(keys):
+        columns = [key] if isinstance(key, str) else list(key)
+        key_column = sf.col('`{}`'.format(columns[0])) if len(columns) == 1 \
+            else sf.struct(*['`{}`'.format(c) for c in columns])
+        # null keys are neither counted nor distinct, they are the nulls of the column and not duplicates
+        exprs.append(sf.count(key_column).alias('key_rows_{}'.format(i)))
+        exprs.append(sf.countDistinct(key_column).alias('key_{}'.format(i)))
+
+    values = df.agg(*exprs).first().asDict()
+    rows = values['rows']
+    report = {'rows': rows, 'exact': exact, 'rsd': 0 if exact else rsd, 'columns': {}, 'duplicate_keys': {}}
+    for i, field in enumerate(df.schema.fields):
+        report['columns'][field.name] = {'nulls': values['nulls_{}'.format(i)],
+                                         'distinct': values['distinct_{}'.format(i)],
+                                         'min': values.get('min_{}'.format(i)),
+                                         'max': values.get('max_{}'.format(i))}
+    for i, key in enumerate(keys):
+        report['duplicate_keys'][_key_name(key)] = values['key_rows_{}'.format(i)] - values['key_{}'.format(i)]
+    return report
+
+
+def report_frame(report):
+    """
+    Description: This function is responsible for the per column part of a profile as a pandas dataframe,
+                 for display in the notebook
+
+    Returns:
+            pandas dataframe with one row per column
+    """
+    frame = pd.DataFrame.from_dict(report['columns'], orient='index')
+    frame['null_pct'] = (100.0 * frame['nulls'] / report['rows']).round(2) if report['rows'] else 0.0
+    return frame
+
+
+def count_check(report, table_name):
+    if report['rows'] == 0:
+        print(f"Failed for {table_name}, it contains {report['rows']} records.")
+        return False
+    print(f"Check passed for {table_name}, it contains {report['rows']} records.")
+    return True
+
+
+def unique_key_check(report, column, table_name):
+    duplicates = report['duplicate_keys'][_key_name(column)]
+    if duplicates:
+        print(f"Failed, column {column} in table {table_name} contains {duplicates} duplicated values.")
+        return False
+    print(f"Check passed for column {column} in table {table_name}.")
+    return True
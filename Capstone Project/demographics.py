@@ -0,0 +1,73 @@
+from pyspark.sql import functions as sf
+from pyspark.sql.functions import col, mean, round, upper
+from pyspark.sql.types import DoubleType, IntegerType, StringType, StructField, StructType
+
+# us-cities-demographics.csv, declared so the file is read once and the columns get their final names
+CITIES_SCHEMA = StructType([
+    StructField('City', StringType()),
+    StructField('State', StringType()),
+    StructField('Median_Age', DoubleType()),
+    StructField('Male_Population', IntegerType()),
+    StructField('Female_Population', IntegerType()),
+    StructField('Total_Population', IntegerType()),
+    StructField('Number_of_Veterans', IntegerType()),
+    StructField('Foreign_Born', IntegerType()),
+    StructField('Average_Household_Size', DoubleType()),
+    StructField('State_Code', StringType()),
+    StructField('Race', StringType()),
+    StructField('count_of_race', IntegerType()),
+])
+
+# values of Race -> pivoted column, listed so the pivot doesn't need a pass to find them
+RACES = {
+    'American Indian and Alaska Native': 'american_indian_and_alaska_native',
+    'Asian': 'asian',
+    'Black or African-American': 'black_or_african_american',
+    'Hispanic or Latino': 'hispanic_or_latino',
+    'White': 'white',
+}
+
+# columns of a city, repeated on each of its race rows
+CITY_COLUMNS = ['City', 'State', 'State_Code', 'Median_Age', 'Male_Population', 'Female_Population',
+                'Total_Population', 'Number_of_Veterans', 'Foreign_Born', 'Average_Household_Size']
+
+
+def pivot_cities(df):
+    """
+    Description: This function is responsible for turning the one row per city and race of the demographics into
+                 one row per city, the count of every race in its own column
+
+    Arguments:
+            df : spark dataframe of us-cities-demographics.csv read with CITIES_SCHEMA.
+
+    Returns:
+            spark dataframe of the cities, one row per city and state
+    """
+    df = df.withColumn("City", upper(col('City')))
+    cities = df.groupBy(*CITY_COLUMNS).pivot('Race', list(RACES)).agg(sf.max('count_of_race'))
+    cities = cities.select(*CITY_COLUMNS, *[col('`{}`'.format(race)).alias(name) for race, name in RACES.items()])
+    # a race missing from a city counts no one
+    cities = cities.fillna(0, subset=list(RACES.values()))
+    #combine city name with city state
+    return cities.withColumn("City_State", sf.concat(col('City'), sf.lit(', '), col('State_Code')))
+
+
+def aggregate_states(cities):
+    """
+    Description: This function is responsible for the demographics of every state, summed over its cities
+
+    Arguments:
+            cities : spark dataframe of the cities, see pivot_cities.
+
+    Returns:
+            spark dataframe of the states
+    """
+    return cities.groupBy(col("State_Code"), col("State")).agg(
+        round(mean('Median_Age'), 2).alias("median_age"),
+        sf.sum("Total_Population").alias("total_population"),
+        sf.sum("Male_Population").alias("male_population"),
+        sf.sum("Female_Population").alias("female_population"),
+        sf.sum("Foreign_Born").alias("foreign_born"),
+        round(mean("Average_Household_Size"), 2).alias("average_household_size"),
+        *[sf.sum(name).alias(name) for name in RACES.values()]
+    )
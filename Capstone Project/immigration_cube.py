@@ -0,0 +1,173 @@
+import time
+
+from pyspark.sql import functions as sf
+from pyspark.sql.functions import col
+
+from table_layout import write_table
+
+# grouping columns of the cube, arrival_month is derived from arrival_date (first day of the month)
+CUBE_COLUMNS = ['country_code', 'State_Code', 'visa_code', 'arrival_month', 'gender']
+DERIVED_COLUMNS = {'arrival_month': lambda: sf.trunc('arrival_date', 'month').alias('arrival_month')}
+
+# measures of the cube: fact rows, and the sum and non null count of count_of_arrivals for sum/avg of it
+FACT_MEASURES = {'count_of_arrivals'}
+
+# dimensions a question can join, with the cube column they are keyed by (one row per key)
+DIMENSIONS = {'country': 'country_code', 'state': 'State_Code'}
+
+# natural keys of the cube, read on the fact through the surrogate key of their dimension
+FACT_KEYS = {'country_code': ('country', 'country_id'), 'State_Code': ('state', 'state_id'),
+             'visa_code': ('visa', 'visa_id')}
+
+OPERATORS = {
+    '=': lambda c, v: c == v,
+    '!=': lambda c, v: c != v,
+    '<': lambda c, v: c < v,
+    '<=': lambda c, v: c <= v,
+    '>': lambda c, v: c > v,
+    '>=': lambda c, v: c >= v,
+    'in': lambda c, v: c.isin(list(v)),
+}
+
+
+def with_fact_keys(df_im, dimensions):
+    """
+    Description: This function is responsible for the natural keys of the cube as the fact holds them: the fact
+                 only has the surrogate key, so a code without a row in its dimension (or null) reads back as
+                 null there, and is nulled here too. Both paths of query then group, filter and join the same
+                 values.
+
+    Arguments:
+            df_im      : spark dataframe of immigration.
+            dimensions : dictionary of table name -> spark dataframe of the dimensions of FACT_KEYS.
+
+    Returns:
+            spark dataframe with the codes the fact knows
+    """
+    types = dict(df_im.dtypes)
+    for name, (table, _) in FACT_KEYS.items():
+        known = dimensions[table].select(col(name).cast(types[name]).alias('known_' + name)).distinct()
+        df_im = df_im.join(sf.broadcast(known), col(name) == col('known_' + name), "left").\
+            withColumn(name, col('known_' + name)).drop('known_' + name)
+    return df_im
+
+
+def create_immigration_cube(df_im, dimensions, output_path):
+    """
+    Description: This function creates the immigration cube, the fact rolled up by country_code, State_Code,
+                 visa_code, arrival month and gender
+
+    Arguments:
+            df_im       : spark dataframe of immigration.
+            dimensions  : dictionary of table name -> spark dataframe of the dimensions of FACT_KEYS.
+            output_path : path to save the cube.
+
+    Returns:
+            spark dataframe representing the cube
+    """
+    df_im = with_fact_keys(df_im, dimensions)
+    cube = df_im.select(*[DERIVED_COLUMNS[c]() if c in DERIVED_COLUMNS else col(c) for c in CUBE_COLUMNS],
+                        'count_of_arrivals').\
+        groupBy(*CUBE_COLUMNS).agg(sf.count(sf.lit(1)).alias('arrivals'),
+                                   sf.sum('count_of_arrivals').alias('count_of_arrivals'),
+                                   sf.count('count_of_arrivals').alias('count_of_arrivals_rows'))
+
+    # a few thousand rows, one file
+    return write_table(cube, output_path, "immigration_cube")
+
+
+def _routable(aggregate, column, columns, dimension_columns):
+    """
+    Description: This function is responsible for deciding whether the cube can answer a question, the filter
+                 and grouping columns must be cube columns or columns of the joined dimension, the summed or
+                 averaged column may also be a measure
+    """
+    available = set(CUBE_COLUMNS) | set(dimension_columns)
+    if any(c not in available for c in columns):
+        return False
+    return aggregate == 'count' or column in available or column in FACT_MEASURES
+
+
+def _aggregate_cube(aggregate, column):
+    """
+    Description: This function is responsible for the aggregation of a question over the cube, weighted by the
+                 fact rows of every cube row
+    """
+    if aggregate == 'count':
+        return sf.sum('arrivals')
+    if column in FACT_MEASURES:
+        total, rows = sf.sum(column), sf.sum(column + '_rows')
+    else:
+        # a dimension attribute repeats on every fact row of its key
+        total = sf.sum(col(column) * col('arrivals'))
+        rows = sf.sum(sf.when(col(column).isNotNull(), col('arrivals')))
+    return total if aggregate == 'sum' else total / rows
+
+
+def _aggregate_fact(aggregate, column):
+    if aggregate == 'count':
+        return sf.count(sf.lit(1))
+    return sf.sum(column) if aggregate == 'sum' else sf.avg(column)
+
+
+def query(spark, output_path, aggregate, column=None, join=None, filters=(), group_by=(), use_cube=True):
+    """
+    Description: This function is responsible for answering a count, sum or avg question over the immigration
+                 fact, optionally joined to the country or state dimension. It is answered from the cube when
+                 every column it uses is in the cube or the joined dimension, from the fact otherwise.
+
+                 query(spark, 'output/', 'count', join='country', filters=[('AverageTemperature', '>=', 20)])
+
+    Arguments:
+            spark       : spark session.
+            output_path : path of the written tables.
+            aggregate   : count, sum or avg.
+            column      : column summed or averaged.
+            join        : country or state, the dimension joined on its key.
+            filters     : list of (column, operator, value), operators =, !=, <, <=, >, >=, in.
+            group_by    : columns of the result.
+            use_cube    : False always reads the fact, to compare both.
+
+    Returns:
+            dictionary of result (pandas dataframe), source (cube or fact) and seconds (latency)
+    """
+    if aggregate not in ('count', 'sum', 'avg'):
+        raise ValueError("aggregate must be count, sum or avg")
+    if aggregate != 'count' and column is None:
+        raise ValueError("{} needs a column".format(aggregate))
+    if join is not None and join not in DIMENSIONS:
+        raise ValueError("join must be one of {}".format(sorted(DIMENSIONS)))
+
+    started = time.perf_counter()
+    dimension = spark.read.parquet(output_path + join) if join else None
+    dimension_columns = [c for c in dimension.columns if c != DIMENSIONS[join]] if join else []
+    columns = [c for c, _, _ in filters] + list(group_by)
+    routed = use_cube and _routable(aggregate, column, columns, dimension_columns)
+
+    if routed:
+        df = spark.read.parquet(output_path + "immigration_cube")
+        value = _aggregate_cube(aggregate, column)
+    else:
+        df = spark.read.parquet(output_path + "immigration")
+        for name in DERIVED_COLUMNS:
+            if name in columns:
+                df = df.withColumn(name, DERIVED_COLUMNS[name]())
+        for name, (table, key) in FACT_KEYS.items():
+            if name in columns and table != join:
+                natural = spark.read.parquet(output_path + table).select(key, name).distinct()
+                df = df.join(sf.broadcast(natural), key, "left")
+        value = _aggregate_fact(aggregate, column)
+
+    if join:
+        # the cube holds the natural key of the dimension, the fact its surrogate key. Both are inner joins and
+        # drop the same rows, a null key or one without a dimension row, see with_fact_keys
+        key = DIMENSIONS[join] if routed else FACT_KEYS[DIMENSIONS[join]][1]
+        df = df.join(sf.broadcast(dimension), key)
+    for name, operator, operand in filters:
+        df = df.where(OPERATORS[operator](col(name), operand))
+    name = aggregate if column is None else '{}({})'.format(aggregate, column)
+    result = df.groupBy(*group_by).agg(value.alias(name)).toPandas()
+
+    seconds = round(time.perf_counter() - started, 3)
+    print("{} answered from the {} in {}s".format(name, 'cube' if routed else 'fact', seconds))
+    return {'result': result, 'source': 'cube' if routed else 'fact', 'seconds': seconds}
@@ -0,0 +1,163 @@
+"""
+Runs SQL over the parquet tables of output/ with an embedded DuckDB, no spark session needed.
+
+    python local_query.py "SELECT COUNT(*) FROM country c JOIN fact f ON f.country_id = c.country_id"
+    python local_query.py --benchmark
+
+Every table directory is a view of the same name (fact is the immigration table, like the notebook's temp view).
+Partitioned tables are read with hive partitioning, so a filter on visatype or year/month only opens the files
+of the matching partitions, and the other filters are pushed down to the parquet row groups.
+"""
+import argparse
+import os
+import time
+
+import duckdb
+
+OUTPUT_PATH = 'output/'
+
+# view name -> table directory, fact is the name the notebook's questions use
+VIEW_ALIASES = {'fact': 'immigration'}
+
+# the analytic questions of the notebook
+QUESTIONS = {
+    'warm_countries': """
+        SELECT COUNT(*)
+        FROM country c
+        join fact f
+        on f.country_id=c.country_id
+        where c.AverageTemperature >= 20""",
+    'japan': """
+        SELECT COUNT(*)
+        FROM country c
+        join fact f
+        on f.country_id=c.country_id
+        where c.Country= 'JAPAN'""",
+    'foreign_born_states': """
+        SELECT COUNT(*)
+        FROM state s
+        join fact f
+        on f.state_id = s.state_id
+        where s.foreign_born <= 600000""",
+    'foreign_born_median_age': """
+        SELECT avg(median_age)
+        FROM state s
+        join fact f
+        on f.state_id = s.state_id
+        where s.foreign_born <= 600000""",
+}
+
+
+def list_tables(output_path):
+    """
+    Description: This function is responsible for finding the table directories written by the pipeline
+
+    Returns:
+            dictionary of table name to directory
+    """
+    return {name: os.path.join(output_path, name) for name in sorted(os.listdir(output_path))
+            if os.path.isdir(os.path.join(output_path, name)) and not name.startswith(('.', '_'))}
+
+
+def connect(output_path=OUTPUT_PATH):
+    """
+    Description: This function is responsible for an in-memory DuckDB connection with a view per table of
+                 output_path, plus the aliases of VIEW_ALIASES
+
+    Arguments:
+            output_path : path of the written tables.
+
+    Returns:
+            duckdb connection
+    """
+    con = duckdb.connect()
+    tables = list_tables(output_path)
+    views = dict(tables)
+    views.update({alias: tables[table] for alias, table in VIEW_ALIASES.items() if table in tables})
+    for view, directory in views.items():
+        files = os.path.join(directory, '**', '*.parquet')
+        con.execute("CREATE VIEW \"{}\" AS SELECT * FROM read_parquet('{}', hive_partitioning = true, "
+                    "union_by_name = true)".format(view, files.replace("'", "''")))
+    return con
+
+
+def run_sql(con, sql):
+    """
+    Description: This function is responsible for running a query and timing it
+
+    Returns:
+            pandas dataframe of the result and the seconds it took
+    """
+    started = time.perf_counter()
+    result = con.execute(sql).df()
+    return result, time.perf_counter() - started
+
+
+def run_spark(output_path, questions):
+    """
+    Description: This function is responsible for the same questions through spark, the notebook's way:
+                 session, temp views and spark.sql. The first timing includes the session startup.
+
+    Returns:
+            dictionary of question name to (pandas dataframe, seconds)
+    """
+    started = time.perf_counter()
+    from pyspark.sql import SparkSession
+    spark = SparkSession.builder.getOrCreate()
+    views = dict(list_tables(output_path))
+    views.update({alias: views[table] for alias, table in VIEW_ALIASES.items() if table in views})
+    for view, directory in views.items():
+        spark.read.parquet(directory).createOrReplaceTempView(view)
+    startup = time.perf_counter() - started
+
+    results = {}
+    for name, sql in questions.items():
+        started = time.perf_counter()
+        result = spark.sql(sql).toPandas()
+        results[name] = (result, time.perf_counter() - started)
+    spark.stop()
+    return startup, results
+
+
+def benchmark(output_path):
+    """
+    Description: This function is responsible for running the notebook's questions with DuckDB and with spark,
+                 printing the time of every question and whether the answers agree
+    """
+    started = time.perf_counter()
+    con = connect(output_path)
+    duck_startup = time.perf_counter() - started
+    duck = {name: run_sql(con, sql) for name, sql in QUESTIONS.items()}
+    spark_startup, spark = run_spark(output_path, QUESTIONS)
+
+    print("{:<26} {:>10} {:>10}  {}".format('question', 'duckdb', 'spark', 'same answer'))
+    print("{:<26} {:>9.2f}s {:>9.2f}s".format('startup', duck_startup, spark_startup))
+    for name in QUESTIONS:
+        duck_result, duck_seconds = duck[name]
+        spark_result, spark_seconds = spark[name]
+        same = abs(float(duck_result.iloc[0, 0]) - float(spark_result.iloc[0, 0])) < 1e-6
+        print("{:<26} {:>9.2f}s {:>9.2f}s  {}".format(name, duck_seconds, spark_seconds, same))
+    print("{:<26} {:>9.2f}s {:>9.2f}s".format(
+        'total', duck_startup + sum(s for _, s in duck.values()), spark_startup + sum(s for _, s in spark.values())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sql', nargs='?', help='query to run, a name of QUESTIONS runs that question')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='path of the written tables')
+    parser.add_argument('--benchmark', action='store_true', help='compare the notebook questions with spark')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.output)
+        return
+    if not args.sql:
+        parser.error("a query or --benchmark is required")
+
+    result, seconds = run_sql(connect(args.output), QUESTIONS.get(args.sql, args.sql))
+    print(result.to_string(index=False))
+    print("{:.3f}s".format(seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import re
+
+from pyspark.sql.functions import broadcast
+from pyspark.sql.types import IntegerType, StringType, StructField, StructType
+
+LABELS_CACHE_DIR = 'labels_cache'
+
+# SAS format blocks of I94_SAS_Labels_Descriptions.SAS and the lookup table each one becomes:
+# format name -> (table, code column, label column), a $ format has character codes, the others numeric codes
+LOOKUPS = {
+    'i94cntyl': ('country', 'country_code', 'Country'),
+    '$i94prtl': ('port', 'city_code', 'City_State'),
+    'i94model': ('mode', 'mode_code', 'mode'),
+    'i94addrl': ('state', 'State_Code', 'State'),
+    # not a format block, the visa categories are only listed in the I94VISA comment
+    'i94visa': ('visa', 'visa_code', 'visa_category'),
+}
+
+# character formats whose name lacks the $ of the SAS convention
+CHARACTER_FORMATS = {'i94addrl'}
+
+_VALUE = re.compile(r"^\s*value\s+(\$?\w+)\s*$", re.IGNORECASE)
+_COMMENT = re.compile(r"^\s*/\*\s*(\w+)\s*-")
+# 'ALC'	=	'ALCAN, AK   '    or    582 =  'MEXICO ...' ;
+_PAIR = re.compile(r"^\s*(?:'([^']*)'|([^\s=']+))\s*=\s*'((?:[^']|'')*)'\s*(;)?\s*$")
+
+
+def file_hash(path):
+    """
+    Description: This function is responsible for hashing the content of the labels file, the key of its cache
+
+    Arguments:
+            path : path of the SAS labels file.
+
+    Returns:
+            sha256 hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_labels(path):
+    """
+    Description: This function is responsible for parsing the value blocks of the SAS proc format file
+                 (value i94cntyl, value $i94prtl, ...) and the code lists in its comments (I94VISA)
+                 into code to label pairs
+
+    Arguments:
+            path : path of the SAS labels file.
+
+    Returns:
+            dictionary of format name (lower case, with the $ of character formats) to a list of (code, label),
+            codes are int for numeric formats and str for character formats
+    """
+    formats = {}
+    current = None
+    in_comment = False
+    with open(path) as f:
+        for line in f:
+            if not in_comment and current is None:
+                value = _VALUE.match(line)
+                if value:
+                    current = value.group(1).lower()
+                    formats[current] = []
+                    continue
+                comment = _COMMENT.match(line)
+                if comment and '*/' not in line:
+                    # a comment listing codes, e.g. "/* I94VISA - ... \n 1 = Business \n */"
+                    in_comment = True
+                    current = comment.group(1).lower()
+                continue
+
+            if in_comment:
+                if '*/' in line:
+                    in_comment = False
+                    current = None
+                    continue
+                pair = re.match(r"^\s*(\d+)\s*=\s*(.+?)\s*$", line)
+                if pair:
+                    formats.setdefault(current, []).append((pair.group(1), pair.group(2)))
+                continue
+
+            pair = _PAIR.match(line)
+            if pair:
+                quoted, bare, label, end = pair.groups()
+                # '' is an escaped quote, INT''L FALLS
+                formats[current].append((quoted if quoted is not None else bare, label.replace("''", "'").strip()))
+                if end:
+                    current = None
+            elif line.strip() == ';':
+                current = None
+
+    return {name: [(code if name.startswith('$') or name in CHARACTER_FORMATS else int(code), label)
+                   for code, label in pairs]
+            for name, pairs in formats.items() if pairs}
+
+
+def lookup_schema(name):
+    """
+    Description: This function is responsible for the typed schema of the lookup table of a format
+
+    Returns:
+            StructType of the code and label columns
+    """
+    _, code_column, label_column = LOOKUPS[name]
+    code_type = StringType() if name.startswith('$') or name in CHARACTER_FORMATS else IntegerType()
+    return StructType([StructField(code_column, code_type, False), StructField(label_column, StringType(), True)])
+
+
+def load_lookups(spark, path, cache_dir=LABELS_CACHE_DIR):
+    """
+    Description: This function is responsible for the lookup tables of the labels file. They are parsed once and
+                 cached as small parquet files under cache_dir/<file hash>/, a changed labels file gets a new
+                 cache directory. The dataframes carry a broadcast hint, so a join to a lookup never shuffles
+                 the other side.
+
+    Arguments:
+            spark     : spark session.
+            path      : path of the SAS labels file.
+            cache_dir : directory of the parquet cache.
+
+    Returns:
+            dictionary of table name (country, port, mode, state, visa) to spark dataframe
+    """
+    directory = os.path.join(cache_dir, file_hash(path)[:16])
+    tables = {name: table for name, (table, _, _) in LOOKUPS.items()}
+
+    if not all(os.path.exists(os.path.join(directory, table, '_SUCCESS')) for table in tables.values()):
+        formats = parse_labels(path)
+        missing = set(LOOKUPS) - set(formats)
+        if missing:
+            raise ValueError("Formats {} not found in {}".format(sorted(missing), path))
+        for name, table in tables.items():
+            spark.createDataFrame(formats[name], lookup_schema(name)).coalesce(1).\
+                write.parquet(os.path.join(directory, table), mode='overwrite')
+
+    return {table: broadcast(spark.read.schema(lookup_schema(name)).parquet(os.path.join(directory, table)))
+            for name, table in tables.items()}
@@ -0,0 +1,330 @@
+"""
+Appends the daily I94 arrival drops to the immigration fact with spark structured streaming, instead of rebuilding
+it with capstone_pipeline.py.
+
+    python capstone_pipeline.py --immigration i94_parquet
+    python stream_immigration.py --landing landing/ --format csv --once
+
+Every new file of the landing directory is cleaned and renamed, the arrival dates, visas and states the written
+dimensions don't have yet are appended to them, and its keys are looked up in the dimensions like the batch fact
+(capstone_pipeline.build_fact). It is cast to the column types of the written fact and appended to its
+year/month/day partitions. The checkpoint tracks the files already read, and a micro batch is written to a
+staging directory before its files are moved into the fact, so a batch replayed after a failure is neither lost
+nor appended twice. The latency and throughput of every micro batch are printed and written to metrics/.
+The immigration cube is not updated, it is rebuilt by the batch pipeline.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+
+from pyspark.sql.functions import col
+
+from capstone_pipeline import (CITIES_PATH, FACT_LOOKUPS, LABELS_PATH, build_fact, calendar_rows, clean_immigration,
+                               create_spark_session, read_cities, state_rows, visa_rows)
+from sas_labels import load_lookups
+from table_layout import LAYOUTS, layout_writer, record_stats
+
+LANDING_PATH = 'landing/'
+SAMPLE_PATH = 'immigration_data_sample.csv'
+OUTPUT_PATH = 'output/'
+CHECKPOINT_PATH = 'checkpoints/immigration_stream'
+METRICS_DIR = 'metrics'
+FACT = 'immigration'
+COMMITS_FILE = '_committed_batches.json'
+TOUCHED_FILE = '_touched_partitions.json'
+MAX_FILES_PER_TRIGGER = 4
+TRIGGER_INTERVAL = '1 minute'
+
+# dimensions a daily drop can bring new rows to, built like the batch ones from the batch and the sources (the
+# visa labels and the cities), the country dimension already has a row for every country label
+DIMENSION_ROWS = {
+    'calendar': lambda df, sources: calendar_rows(df),
+    'visa': lambda df, sources: visa_rows(df, sources['visa']),
+    'state': lambda df, sources: state_rows(sources['cities'], df),
+}
+
+
+def source_schema(spark, path, file_format):
+    """
+    Description: This function is responsible for the schema of the arrival files, read from a sample of them.
+                 A file stream needs its schema up front.
+
+    Arguments:
+            spark       : spark session.
+            path        : path of a sample file, immigration_data_sample.csv for csv drops.
+            file_format : csv or parquet.
+
+    Returns:
+            spark schema
+    """
+    if file_format == 'csv':
+        return spark.read.csv(path, header=True, inferSchema=True).schema
+    return spark.read.parquet(path).schema
+
+
+def load_commits(checkpoint_path):
+    """
+    Description: This function is responsible for reading the ids of the micro batches appended to the fact
+
+    Returns:
+            set of batch ids
+    """
+    path = os.path.join(checkpoint_path, COMMITS_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(json.load(f))
+
+
+def save_commits(checkpoint_path, commits):
+    """
+    Description: This function is responsible for writing the ids of the appended micro batches, replaced atomically
+    """
+    os.makedirs(checkpoint_path, exist_ok=True)
+    path = os.path.join(checkpoint_path, COMMITS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(sorted(commits), f)
+    os.replace(path + '.tmp', path)
+
+
+def publish(staging, root, batch_id):
+    """
+    Description: This function is responsible for moving the parquet files of a staged micro batch into the fact,
+                 keeping their partition directories. A file is either still staged or already moved, so a
+                 publish interrupted half way is finished by running it again.
+
+    Arguments:
+            staging  : directory of the staged micro batch.
+            root     : directory of the fact.
+            batch_id : id of the micro batch, prefixed to the moved file names.
+
+    Returns:
+            number of moved files
+    """
+    moved = 0
+    for directory, _, names in os.walk(staging):
+        for name in names:
+            if not name.endswith('.parquet'):
+                continue
+            target = os.path.join(root, os.path.relpath(directory, staging))
+            os.makedirs(target, exist_ok=True)
+            os.replace(os.path.join(directory, name), os.path.join(target, 'batch-{}-{}'.format(batch_id, name)))
+            moved += 1
+    return moved
+
+
+def update_dimensions(spark, df, output_path, sources):
+    """
+    Description: This function is responsible for appending to the dimensions of DIMENSION_ROWS the rows of a
+                 batch they don't have yet, a new arrival date for instance, so the fact rows of the batch get
+                 their keys. The keys are the hashes of the batch dimensions, the natural key columns are cast
+                 to the types of the written dimensions first so they hash alike. Rows already appended are not
+                 appended again when a batch is replayed.
+
+    Arguments:
+            spark       : spark session.
+            df          : spark dataframe of the cleaned batch.
+            output_path : path of the written tables.
+            sources     : dictionary of visa -> visa labels, cities -> cities demographics.
+
+    Returns:
+            the batch with its natural keys cast, and the dictionary of table name -> spark dataframe of the
+            dimensions of FACT_LOOKUPS
+    """
+    dimensions = {table: spark.read.parquet(output_path + table) for table, _, _ in FACT_LOOKUPS}
+    for table, _, columns in FACT_LOOKUPS:
+        types = dict(dimensions[table].dtypes)
+        df = df.select([col(c).cast(types[columns[c]]).alias(c) if c in columns else col(c) for c in df.columns])
+
+    for table, key, _ in FACT_LOOKUPS:
+        if table not in DIMENSION_ROWS:
+            continue
+        dimension = dimensions[table]
+        missing = DIMENSION_ROWS[table](df, sources).join(dimension.select(key), key, "left_anti")
+        missing = missing.select([col(c).cast(t).alias(c) for c, t in dimension.dtypes])
+        if not missing.take(1):
+            continue
+        missing, writer = layout_writer(missing, table)
+        writer.parquet(output_path + table, mode='append')
+        record_stats(missing, output_path, table, appended=True)
+        dimensions[table] = spark.read.parquet(output_path + table)
+    return df, dimensions
+
+
+def batch_writer(spark, output_path, checkpoint_path, sources, fact_types):
+    """
+    Description: This function is responsible for the foreachBatch function appending a micro batch to the fact:
+                 the new dimension rows of the batch are appended, the batch is staged, the partitions it touches
+                 are noted, its files are moved into the fact and the batch id is committed. A replayed batch
+                 resumes from the step it stopped at.
+
+    Arguments:
+            spark           : spark session.
+            output_path     : path of the written tables.
+            checkpoint_path : checkpoint directory of the query, also holding the staged batches.
+            sources         : dictionary of visa -> visa labels, cities -> cities demographics.
+            fact_types      : dictionary of column -> type of the written fact.
+
+    Returns:
+            function of (batch dataframe, batch id)
+    """
+    root = os.path.join(output_path, FACT)
+    partition_by = LAYOUTS[FACT]['partition_by']
+    commits = load_commits(checkpoint_path)
+
+    def append_batch(batch, batch_id):
+        staging = os.path.join(checkpoint_path, 'staging', 'batch={}'.format(batch_id))
+        # the checkpoint commits a batch after this returns, a failure in between replays it
+        if batch_id in commits:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        if not os.path.exists(os.path.join(staging, '_SUCCESS')):
+            # read by the new dimension rows and by the fact rows
+            cleaned = clean_immigration(batch.drop('_c0')).cache()
+            df, dimensions = update_dimensions(spark, cleaned, output_path, sources)
+            df = build_fact(df, dimensions)
+            df = df.select([col(c).cast(fact_types[c]) if c in fact_types else col(c) for c in df.columns])
+            df, writer = layout_writer(df, FACT)
+            writer.parquet(staging, mode='overwrite')
+            cleaned.unpersist()
+
+        touched_path = os.path.join(staging, TOUCHED_FILE)
+        if not os.path.exists(touched_path):
+            staged = []
+            if any(name.endswith('.parquet') for _, _, names in os.walk(staging) for name in names):
+                staged = spark.read.parquet(staging).select(*partition_by).distinct().collect()
+            with open(touched_path, 'w') as f:
+                json.dump([list(row) for row in staged], f)
+        with open(touched_path) as f:
+            touched = [tuple(values) for values in json.load(f)]
+
+        publish(staging, root, batch_id)
+        if touched:
+            keys = spark.createDataFrame(touched, ', '.join('{} int'.format(c) for c in partition_by))
+            record_stats(keys, output_path, FACT, appended=True)
+        commits.add(batch_id)
+        save_commits(checkpoint_path, commits)
+        shutil.rmtree(staging)
+
+    return append_batch
+
+
+def report_progress(progress):
+    """
+    Description: This function is responsible for the latency and throughput of a micro batch
+
+    Returns:
+            dictionary of the batch metrics
+    """
+    return {'batch_id': progress['batchId'],
+            'timestamp': progress['timestamp'],
+            'input_rows': progress['numInputRows'],
+            'latency_ms': progress['durationMs'].get('triggerExecution'),
+            'input_rows_per_s': round(progress.get('inputRowsPerSecond') or 0.0, 1),
+            'processed_rows_per_s': round(progress.get('processedRowsPerSecond') or 0.0, 1)}
+
+
+def run_stream(spark, landing_path, file_format, schema, sources, output_path, checkpoint_path, once=False,
+               interval=TRIGGER_INTERVAL, max_files=MAX_FILES_PER_TRIGGER):
+    """
+    Description: This function is responsible for running the streaming query until it stops (after the available
+                 files with once) and printing every micro batch as it completes
+
+    Arguments:
+            spark           : spark session.
+            landing_path    : directory watched for arrival files.
+            file_format     : csv or parquet.
+            schema          : schema of the arrival files.
+            sources         : dictionary of visa -> visa labels, cities -> cities demographics.
+            output_path     : path of the written tables, the dimensions and the fact.
+            checkpoint_path : checkpoint directory of the query.
+            once            : process the files available now and stop.
+            interval        : processing time trigger otherwise.
+            max_files       : files read per micro batch.
+
+    Returns:
+            list of the batch metrics
+    """
+    fact_path = output_path + FACT
+    if not os.path.isdir(fact_path):
+        raise SystemExit("No fact in {}, run capstone_pipeline.py first".format(output_path))
+    fact_types = dict(spark.read.parquet(fact_path).dtypes)
+
+    reader = spark.readStream.schema(schema).option('maxFilesPerTrigger', max_files)
+    if file_format == 'csv':
+        reader = reader.option('header', True)
+    stream = reader.format(file_format).load(landing_path)
+
+    append_batch = batch_writer(spark, output_path, checkpoint_path, sources, fact_types)
+    writer = stream.writeStream.foreachBatch(append_batch).option('checkpointLocation', checkpoint_path)
+    writer = writer.trigger(once=True) if once else writer.trigger(processingTime=interval)
+    query = writer.start()
+
+    batches = {}
+
+    def print_new_batches():
+        for progress in query.recentProgress:
+            if progress['batchId'] in batches or not progress['numInputRows']:
+                continue
+            metrics = batches[progress['batchId']] = report_progress(progress)
+            print("{batch_id:>6} {input_rows:>10} {latency_ms:>8}ms {input_rows_per_s:>12} "
+                  "{processed_rows_per_s:>16}".format(**metrics))
+
+    print("{:>6} {:>10} {:>10} {:>12} {:>16}".format('batch', 'rows', 'latency', 'input rows/s', 'processed rows/s'))
+    try:
+        while query.isActive:
+            query.awaitTermination(5)
+            print_new_batches()
+    except KeyboardInterrupt:
+        query.stop()
+    print_new_batches()
+    return [batches[batch_id] for batch_id in sorted(batches)]
+
+
+def write_report(batches, report_dir):
+    """
+    Description: This function is responsible for writing the batch metrics of the run as a JSON file
+
+    Returns:
+            path of the written report
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, 'stream_{}.json'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+    rows = sum(batch['input_rows'] for batch in batches)
+    latency = sum(batch['latency_ms'] or 0 for batch in batches)
+    with open(path, 'w') as f:
+        json.dump({'batches': batches,
+                   'rows': rows,
+                   'rows_per_s': round(1000.0 * rows / latency, 1) if latency else None}, f, indent=2)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--landing', default=LANDING_PATH, help='directory the arrival files are dropped in')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--sample', default=SAMPLE_PATH, help='file of the same schema as the arrival files')
+    parser.add_argument('--labels', default=LABELS_PATH, help='SAS labels, for the visa categories of new visas')
+    parser.add_argument('--cities', default=CITIES_PATH, help='cities demographics, for the rows of new states')
+    parser.add_argument('--output', default=OUTPUT_PATH)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--once', action='store_true', help='append the files available now and stop')
+    parser.add_argument('--interval', default=TRIGGER_INTERVAL, help='trigger interval of the micro batches')
+    parser.add_argument('--max-files', type=int, default=MAX_FILES_PER_TRIGGER, help='files read per micro batch')
+    args = parser.parse_args()
+
+    spark = create_spark_session(sas=False)
+    sources = {'visa': load_lookups(spark, args.labels)['visa'], 'cities': read_cities(spark, args.cities).cache()}
+    started = time.perf_counter()
+    batches = run_stream(spark, args.landing, args.format, source_schema(spark, args.sample, args.format), sources,
+                         args.output.rstrip('/') + '/', args.checkpoint, args.once, args.interval, args.max_files)
+    print("{} rows in {} micro batches, {:.1f}s".format(
+        sum(batch['input_rows'] for batch in batches), len(batches), time.perf_counter() - started))
+    print('Stream report written to', write_report(batches, METRICS_DIR))
+
+
+if __name__ == "__main__":
+    main()
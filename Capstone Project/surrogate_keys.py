@@ -0,0 +1,53 @@
+from pyspark.sql.functions import col, xxhash64
+
+
+def hash_key(*columns):
+    """
+    Description: This function is responsible for deriving a stable 64 bit surrogate key from natural key columns.
+                 The columns are hashed as strings with xxhash64, so the same natural key gets the same id on every
+                 run regardless of partitioning (unlike monotonically_increasing_id). Requires Spark 3.0+.
+
+    Arguments:
+            columns : names of the natural key columns.
+
+    Returns:
+            spark column of the signed 64 bit key
+    """
+    return xxhash64(*[col(name).cast('string') for name in columns])
+
+
+def check_collisions(df, key, columns):
+    """
+    Description: This function is responsible for failing when two different natural keys got the same surrogate key
+
+    Arguments:
+            df      : spark dataframe holding the key and the natural key columns.
+            key     : name of the surrogate key column.
+            columns : names of the natural key columns.
+
+    Returns:
+            None
+    """
+    collisions = df.select(key, *columns).distinct().groupBy(key).count().filter(col('count') > 1)
+    if collisions.limit(1).count():
+        raise ValueError("Surrogate key {} collides for different values of {}".format(key, columns))
+
+
+def with_hash_key(df, key, columns, check=True):
+    """
+    Description: This function is responsible for adding a hash surrogate key column to a spark dataframe
+
+    Arguments:
+            df      : spark dataframe.
+            key     : name of the surrogate key column.
+            columns : names of the natural key columns.
+            check   : run check_collisions, costs one aggregation over the table.
+
+    Returns:
+            spark dataframe with the key column
+    """
+    df = df.withColumn(key, hash_key(*columns))
+    if check:
+        check_collisions(df, key, columns)
+    return df
+
@@ -0,0 +1,162 @@
+import json
+import os
+from datetime import datetime
+
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as sf
+from pyspark.sql.functions import col
+
+STATS_FILE = '_partitions.json'
+
+# how every capstone table is written: the fact partitioned by its arrival day, so a date filter opens only
+# the matching directories, the dimensions and the cube (a few thousand rows at most) as a single file each
+LAYOUTS = {
+    'immigration': {'partition_by': ['year', 'month', 'day'],
+                    'options': {'parquet.enable.dictionary': 'true'}},
+    'calendar': {'files': 1},
+    'visa': {'files': 1},
+    'state': {'files': 1},
+    'country': {'files': 1},
+    'immigration_cube': {'files': 1},
+}
+
+# partition columns derived from the arrival date when the table doesn't carry them
+DATE_PARTITIONS = {'year': sf.year, 'month': sf.month, 'day': sf.dayofmonth}
+
+
+def with_partition_columns(df, columns, date_column='arrival_date'):
+    """
+    Description: This function is responsible for adding the year, month and day partition columns from the
+                 arrival date, the columns df already has are kept
+
+    Returns:
+            spark dataframe with the partition columns
+    """
+    for column in columns:
+        if column not in df.columns:
+            df = df.withColumn(column, DATE_PARTITIONS[column](col(date_column)))
+    return df
+
+
+def layout_writer(df, table):
+    """
+    Description: This function is responsible for the writer of a table with the layout of LAYOUTS. A partitioned
+                 table is repartitioned by its partition columns first, one file per partition instead of one per
+                 task and partition.
+
+    Arguments:
+            df    : spark dataframe of the table.
+            table : name of the table.
+
+    Returns:
+            spark dataframe with its partition columns, and its DataFrameWriter
+    """
+    layout = LAYOUTS[table]
+    partition_by = layout.get('partition_by', [])
+    if partition_by:
+        df = with_partition_columns(df, partition_by)
+        writer = df.repartition(*partition_by).write.partitionBy(*partition_by)
+    else:
+        writer = df.coalesce(layout.get('files', 1)).write
+    for key, value in layout.get('options', {}).items():
+        writer = writer.option(key, value)
+    return df, writer
+
+
+def write_table(df, output_path, table):
+    """
+    Description: This function is responsible for writing a table with the layout of LAYOUTS and recording its
+                 partition stats
+
+    Arguments:
+            df          : spark dataframe of the table.
+            output_path : path of the written tables.
+            table       : name of the table, its directory under output_path.
+
+    Returns:
+            spark dataframe as written, with its partition columns
+    """
+    df, writer = layout_writer(df, table)
+    writer.parquet(output_path + table, mode="overwrite")
+
+    record_stats(df, output_path, table)
+    return df
+
+
+def _partition_directory(root, values):
+    return os.path.join(root, *['{}={}'.format(c, '__HIVE_DEFAULT_PARTITION__' if v is None else v)
+                                for c, v in values.items()])
+
+
+def _has_parquet(root):
+    return any(name.endswith('.parquet') for _, _, names in os.walk(root) for name in names)
+
+
+def record_stats(df, output_path, table, appended=False):
+    """
+    Description: This function is responsible for writing <table>/_partitions.json, the rows of every partition
+                 with the files and bytes of its directory. The rows are counted from the written parquet (from
+                 its footers for the most part), not from df, whose lineage would be computed a second time.
+                 For rows appended to a table, only the partitions df touched are counted again and replace
+                 their previous stats, so recording the same append twice gives the same stats.
+
+    Arguments:
+            df          : spark dataframe as written, or as appended (its partition columns are enough).
+            output_path : path of the written tables, a local directory for the file counts.
+            table       : name of the table.
+            appended    : df was appended to the table.
+
+    Returns:
+            dictionary of the stats
+    """
+    spark = SparkSession.getActiveSession()
+    partition_by = LAYOUTS[table].get('partition_by', [])
+    root = os.path.join(output_path, table)
+
+    previous = load_stats(output_path, table) if appended else None
+    partitions = {}
+    if previous:
+        partitions = {tuple(p[c] for c in partition_by): p for p in previous['partitions']}
+    if appended and partition_by:
+        touched = [_partition_directory(root, row.asDict())
+                   for row in df.select(*partition_by).distinct().collect()]
+        written = spark.read.option('basePath', root).parquet(*touched) if touched else None
+    else:
+        written = spark.read.parquet(root) if _has_parquet(root) else None
+    rows = {} if written is None else {tuple(row[c] for c in partition_by): row['count']
+                                       for row in written.groupBy(*partition_by).count().collect()}
+
+    for key, count in rows.items():
+        values = dict(zip(partition_by, key))
+        directory = _partition_directory(root, values)
+        files = [os.path.join(directory, name) for name in os.listdir(directory)
+                 if name.endswith('.parquet')] if os.path.isdir(directory) else []
+        partitions[key] = dict(values, rows=count, files=len(files),
+                               bytes=sum(os.path.getsize(path) for path in files))
+    partitions = [partitions[key] for key in sorted(partitions, key=lambda k: [(v is not None, v) for v in k])]
+
+    stats = {'table': table,
+             'partition_by': partition_by,
+             'written_at': datetime.utcnow().isoformat(),
+             'rows': sum(p['rows'] for p in partitions),
+             'files': sum(p['files'] for p in partitions),
+             'bytes': sum(p['bytes'] for p in partitions),
+             'partitions': partitions}
+    if os.path.isdir(root):
+        with open(os.path.join(root, STATS_FILE), 'w') as f:
+            json.dump(stats, f, indent=2, default=str)
+    return stats
+
+
+def load_stats(output_path, table):
+    """
+    Description: This function is responsible for reading the partition stats written with a table
+
+    Returns:
+            dictionary of the stats, None when the table was written without them
+    """
+    path = os.path.join(output_path, table, STATS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
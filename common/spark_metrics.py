@@ -0,0 +1,204 @@
+"""
+Per job and per stage spark metrics of the ETL steps, shared by the data lake (4- Project Data Lake/etl.py) and
+the capstone pipelines, which put this directory on their path.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.request import urlopen
+
+# task duration quantiles fetched per stage, the skew of a stage is max / median
+TASK_QUANTILES = '0.5,0.95,1.0'
+
+
+class SparkMetricsCollector:
+    """
+    Description: Collects per job and per stage metrics (input/shuffle/output bytes, spill, GC time and
+                 task duration skew) of the ETL steps run on a spark session and writes them as a JSON run report.
+
+                 Metrics are read from the spark status REST api (the same listener data the spark UI shows),
+                 so it works in local mode. When the UI is disabled only the task counts of the status tracker
+                 are reported.
+    """
+
+    def __init__(self, spark):
+        """
+        Arguments:
+                spark : spark session to instrument.
+        """
+        self.sc = spark.sparkContext
+        self.started = datetime.utcnow()
+        self.steps = []
+
+    @contextmanager
+    def track(self, name):
+        """
+        Description: This function is responsible for tagging every spark job run inside the block with a job group,
+                     so that the jobs and stages can be attributed to an ETL step
+
+        Arguments:
+                name : name of the ETL step, e.g. process_song_data.
+
+        Returns:
+                None
+        """
+        group = '{}-{}'.format(name, len(self.steps))
+        self.sc.setJobGroup(group, name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append({'name': name,
+                               'group': group,
+                               'duration_s': round(time.perf_counter() - start, 3)})
+            self.sc.setLocalProperty('spark.jobGroup.id', None)
+            self.sc.setLocalProperty('spark.job.description', None)
+
+    def _api(self, path):
+        """
+        Description: This function is responsible for calling the spark status REST api of the running application
+
+        Returns:
+                decoded json, None when the UI is not available
+        """
+        if not self.sc.uiWebUrl:
+            return None
+        url = '{}/api/v1/applications/{}/{}'.format(self.sc.uiWebUrl, self.sc.applicationId, path)
+        try:
+            with urlopen(url, timeout=10) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def _stage_metrics(self, stage_id):
+        """
+        Description: This function is responsible for reading the metrics of all the attempts of a stage
+
+        Returns:
+                list of stage metrics dictionaries
+        """
+        attempts = self._api('stages/{}'.format(stage_id))
+        if attempts is None:
+            info = self.sc.statusTracker().getStageInfo(stage_id)
+            if info is None:
+                return []
+            return [{'stage_id': stage_id,
+                     'attempt': info.currentAttemptId,
+                     'name': info.name,
+                     'num_tasks': info.numTasks,
+                     'num_failed_tasks': info.numFailedTasks}]
+
+        stages = []
+        for stage in attempts:
+            metrics = {'stage_id': stage_id,
+                       'attempt': stage.get('attemptId', 0),
+                       'name': stage.get('name'),
+                       'status': stage.get('status'),
+                       'num_tasks': stage.get('numTasks', 0),
+                       'num_failed_tasks': stage.get('numFailedTasks', 0),
+                       'executor_run_time_ms': stage.get('executorRunTime', 0),
+                       'gc_time_ms': stage.get('jvmGcTime', 0),
+                       'input_bytes': stage.get('inputBytes', 0),
+                       'input_records': stage.get('inputRecords', 0),
+                       'output_bytes': stage.get('outputBytes', 0),
+                       'output_records': stage.get('outputRecords', 0),
+                       'shuffle_read_bytes': stage.get('shuffleReadBytes', 0),
+                       'shuffle_write_bytes': stage.get('shuffleWriteBytes', 0),
+                       'memory_spilled_bytes': stage.get('memoryBytesSpilled', 0),
+                       'disk_spilled_bytes': stage.get('diskBytesSpilled', 0)}
+
+            summary = self._api('stages/{}/{}/taskSummary?quantiles={}'.format(
+                stage_id, metrics['attempt'], TASK_QUANTILES))
+            if summary and summary.get('duration'):
+                median, p95, maximum = summary['duration']
+                metrics['task_duration_ms'] = {'median': median, 'p95': p95, 'max': maximum}
+                metrics['task_skew'] = round(maximum / median, 2) if median else None
+                if 'jvmGcTime' in summary and not metrics['gc_time_ms']:
+                    metrics['gc_time_ms'] = summary['jvmGcTime'][-1]
+            stages.append(metrics)
+        return stages
+
+    def _step_jobs(self, group):
+        """
+        Description: This function is responsible for collecting the jobs of a job group with their stage metrics
+
+        Returns:
+                list of job dictionaries
+        """
+        tracker = self.sc.statusTracker()
+        jobs = []
+        for job_id in sorted(tracker.getJobIdsForGroup(group)):
+            info = tracker.getJobInfo(job_id)
+            if info is None:
+                continue
+            stages = []
+            for stage_id in sorted(info.stageIds):
+                stages.extend(self._stage_metrics(stage_id))
+            jobs.append({'job_id': job_id, 'status': info.status, 'stages': stages})
+        return jobs
+
+    def report(self):
+        """
+        Description: This function is responsible for building the run report of all the tracked steps
+
+        Returns:
+                dictionary of the run report
+        """
+        steps = []
+        for step in self.steps:
+            jobs = self._step_jobs(step['group'])
+            stages = [stage for job in jobs for stage in job['stages']]
+            totals = {key: sum(stage.get(key, 0) for stage in stages)
+                      for key in ('input_bytes', 'output_bytes', 'shuffle_read_bytes', 'shuffle_write_bytes',
+                                  'memory_spilled_bytes', 'disk_spilled_bytes', 'gc_time_ms', 'executor_run_time_ms')}
+            skews = [stage['task_skew'] for stage in stages if stage.get('task_skew')]
+            totals['max_task_skew'] = max(skews) if skews else None
+            steps.append({'name': step['name'], 'duration_s': step['duration_s'], 'totals': totals, 'jobs': jobs})
+
+        return {'application_id': self.sc.applicationId,
+                'application_name': self.sc.appName,
+                'master': self.sc.master,
+                'started': self.started.isoformat(),
+                'finished': datetime.utcnow().isoformat(),
+                'steps': steps}
+
+    def write_report(self, report_dir):
+        """
+        Description: This function is responsible for writing the run report as a JSON file
+
+        Arguments:
+                report_dir : local directory of the run reports.
+
+        Returns:
+                path of the written report
+        """
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(report_dir, 'run_{}_{}.json'.format(
+            self.started.strftime('%Y%m%dT%H%M%S'), self.sc.applicationId))
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+# collector of every spark application, created with its session
+_COLLECTORS = {}
+
+
+def metrics_collector(spark):
+    """
+    Description: This function is responsible for the metrics collector of a spark session, attached by the
+                 create_spark_session functions of the pipelines when the session is created, so every job of
+                 the session can be tracked and reported by the same collector
+
+    Arguments:
+            spark : spark session.
+
+    Returns:
+            SparkMetricsCollector of the session
+    """
+    application_id = spark.sparkContext.applicationId
+    if application_id not in _COLLECTORS:
+        _COLLECTORS[application_id] = SparkMetricsCollector(spark)
+    return _COLLECTORS[application_id]